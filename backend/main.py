@@ -3,6 +3,8 @@ Sistema de Triagem de Currículos - Backend FastAPI
 Autor: ODQ Sistemas
 """
 
+import asyncio
+import contextlib
 import os
 import shutil
 import sys
@@ -16,7 +18,7 @@ from fastapi import FastAPI, UploadFile, File, HTTPException, Depends, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
+from pydantic import BaseModel, Field
 
 # Importar o sistema de triagem existente
 parent_dir = str(Path(__file__).parent.parent)
@@ -24,9 +26,11 @@ sys.path.insert(0, parent_dir)
 
 try:
     from confidential_client_secret_sample import (
-        extract_text_any, _has_exact_phrase,
-        list_attachments, download_attachment, candidato_aprovado,
-        save_bytes, safe_name
+        compile_criteria, NormalizedDocument,
+        candidato_aprovado, save_bytes, safe_name, CVIndex, content_hash,
+        RelevanceRanking, ExtractionEngine, default_cache, expand_attachment,
+        AsyncGraphClient, DeltaState, added_messages, DELTA_FOLDER,
+        token_provider
     )
     print("✅ Módulo confidential_client_secret_sample importado com sucesso")
 except ImportError as e:
@@ -42,7 +46,20 @@ except ImportError as e:
         print(f"   ❌ Erro ao listar: {ex}")
     sys.exit(1)
 
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Um único cliente httpx do Graph por processo: as conexões (TLS)
+    sobrevivem entre as chamadas de /triagem-email."""
+    app.state.graph_http = AsyncGraphClient.http_client()
+    try:
+        yield
+    finally:
+        await app.state.graph_http.aclose()
+
+
 app = FastAPI(
+    lifespan=lifespan,
     title="Sistema de Triagem ODQ",
     description="API para triagem automática de currículos",
     version="1.0.0",
@@ -74,6 +91,9 @@ class TriagemRequest(BaseModel):
     palavras_negativas: List[str] = []
     data_inicio: Optional[str] = None
     data_fim: Optional[str] = None
+    top_k: Optional[int] = Field(None, ge=1)
+    tolerancia_ocr: int = 0
+    parar_cedo: bool = False
 
 
 class TriagemEmailRequest(BaseModel):
@@ -83,6 +103,11 @@ class TriagemEmailRequest(BaseModel):
     palavras_negativas: List[str] = []
     usar_ocr: bool = True
     max_emails: int = 500
+    top_k: Optional[int] = Field(None, ge=1)
+    tolerancia_ocr: int = 0
+    parar_cedo: bool = False
+    # Só as mensagens recebidas desde a última triagem incremental
+    incremental: bool = False
 
 
 class TriagemResponse(BaseModel):
@@ -93,6 +118,8 @@ class TriagemResponse(BaseModel):
     percentual_aprovacao: float
     arquivos_aprovados: List[dict]
     detalhes_usuarios: Optional[List[dict]] = []
+    # Documentos que estouraram o tempo ou a memória da extração
+    arquivos_ignorados: Optional[List[dict]] = []
 
 
 class StatusResponse(BaseModel):
@@ -101,29 +128,14 @@ class StatusResponse(BaseModel):
     timestamp: str
 
 
-def get_token_from_env(client_id, client_secret, authority, scope):
-    """Função para obter token usando variáveis de ambiente"""
+def get_token_provider_from_env(client_id, client_secret, authority,
+                                scope):
+    """Provedor de token do processo (um app MSAL com cache, reusado
+    entre as chamadas) ou None se a autenticação falhar"""
     try:
-        from msal import ConfidentialClientApplication
-
-        app_client = ConfidentialClientApplication(
-            client_id=client_id,
-            client_credential=client_secret,
-            authority=authority
-        )
-
-        result = app_client.acquire_token_silent(scopes=scope, account=None)
-
-        if not result:
-            result = app_client.acquire_token_for_client(scopes=scope)
-
-        if "access_token" in result:
-            return result["access_token"]
-        else:
-            error_desc = result.get('error_description', 'Erro desconhecido')
-            print(f"Erro ao obter token: {error_desc}")
-            return None
-
+        tokens = token_provider(client_id, authority, client_secret, scope)
+        tokens.token()
+        return tokens
     except Exception as e:
         print(f"Erro ao obter token: {str(e)}")
         return None
@@ -135,6 +147,205 @@ APROVADOS_DIR = Path("../aprovados")
 UPLOAD_DIR.mkdir(exist_ok=True)
 APROVADOS_DIR.mkdir(exist_ok=True)
 
+# Pool de processos para extração (TRIAGEM_WORKERS define o tamanho) com
+# cache em disco compartilhado com o CLI (TRIAGEM_CACHE)
+ENGINE = ExtractionEngine(cache=default_cache())
+
+# Índice dos CVs já extraídos (permite refazer a triagem sem OCR)
+INDICE = CVIndex(os.getenv("INDICE_CVS_PATH", "../indice_cvs.sqlite3"))
+
+# deltaLink de cada caixa para a triagem incremental
+DELTA = DeltaState(os.getenv("DELTA_STATE_PATH", "../delta_caixas.sqlite3"))
+
+
+def indexar_documento(data, nome, doc, ocr_usado, meta=None, sha=None):
+    """Grava o CV no índice sem interromper a triagem em caso de erro"""
+    try:
+        INDICE.add(sha or content_hash(data), nome, doc, ocr_usado, meta)
+    except Exception as e:
+        print(f"⚠️ Falha ao indexar {nome}: {e}")
+
+
+def destino_aprovado(nome):
+    """Caminho livre em aprovados: CVs homônimos do mesmo lote viram
+    "curriculo.pdf", "curriculo_2.pdf"..."""
+    destino = APROVADOS_DIR / nome
+    base, ext = os.path.splitext(nome)
+    n = 1
+    while destino.exists():
+        n += 1
+        destino = APROVADOS_DIR / f"{base}_{n}{ext}"
+    return destino
+
+
+def mover_ranking(ranking):
+    """Move os K melhores do ranking para aprovados, em ordem"""
+    aprovados_info = []
+    for score, formacoes, (caminho, info) in ranking.results():
+        destino = destino_aprovado(caminho.name)
+        caminho.rename(destino)
+        info["arquivo"] = destino.name
+        info["formacoes_encontradas"] = formacoes
+        info["pontuacao"] = round(score, 4)
+        aprovados_info.append(info)
+    return aprovados_info
+
+
+DOMINIO_EMAILS = "@odequadroservicos.com.br"
+
+
+async def mensagens_da_caixa(graph, user_email, max_per_user, incremental):
+    """Mensagens da caixa e, no modo incremental, o estado a salvar
+    depois da triagem.
+
+    A primeira sincronização de uma caixa fica, como no modo normal, com
+    as ``max_per_user`` mensagens mais recentes; as incompletas da rodada
+    anterior (``DELTA.pending``) voltam junto com as novas.
+    """
+    if not incremental:
+        return await graph.messages(user_email, max_per_user), None
+    delta_link, desde = DELTA.get(user_email)
+    alteradas, novo_link = await graph.messages_delta(user_email, delta_link)
+    novas, recebido_ate = added_messages(alteradas, desde)
+    if delta_link is None:
+        novas.sort(key=lambda m: m.get("receivedDateTime", ""),
+                   reverse=True)
+        del novas[max_per_user:]
+
+    vistas = {m["id"] for m in novas}
+    pendentes = [i for i in DELTA.pending(user_email) if i not in vistas]
+    relidas = await asyncio.gather(*(
+        graph.message(user_email, msg_id) for msg_id in pendentes
+    ), return_exceptions=True)
+    nao_relidas = []
+    for msg_id, msg in zip(pendentes, relidas):
+        if isinstance(msg, Exception):
+            print(f"  ⚠️ Erro ao reler a mensagem {msg_id}: {msg}")
+            nao_relidas.append(msg_id)
+        elif msg is not None:
+            novas.append(msg)
+    return novas, (user_email, DELTA_FOLDER, novo_link, recebido_ate,
+                   nao_relidas)
+
+
+def salvar_sincronizacao(sincronizacoes, falhas=()):
+    """Avança o deltaLink das caixas cuja triagem terminou; as mensagens
+    em ``falhas`` (``(caixa, id)``) ficam pendentes para a próxima"""
+    for caixa, pasta, delta_link, recebido_ate, nao_relidas in sincronizacoes:
+        if delta_link:
+            incompletas = set(nao_relidas)
+            incompletas.update(m for c, m in falhas if c == caixa)
+            DELTA.set(caixa, pasta, delta_link, recebido_ate, incompletas)
+
+
+async def coletar_emails(graph, max_per_user, incremental=False):
+    """Mensagens de todas as caixas do domínio, buscadas em paralelo"""
+    domain_users = [
+        u for u in await graph.domain_users(DOMINIO_EMAILS)
+        if u.get("userPrincipalName")
+    ]
+    print(f"👥 Encontrados {len(domain_users)} usuários no domínio")
+
+    respostas = await asyncio.gather(*(
+        mensagens_da_caixa(
+            graph, u["userPrincipalName"], max_per_user, incremental
+        )
+        for u in domain_users
+    ), return_exceptions=True)
+
+    all_emails = []
+    processed_users = []
+    sincronizacoes = []
+    for user, resposta in zip(domain_users, respostas):
+        user_email = user["userPrincipalName"]
+        display_name = user.get("displayName", "")
+        if isinstance(resposta, Exception):
+            print(f"  ⚠️ Erro ao acessar emails de {user_email}: "
+                  f"{resposta}")
+            continue
+        user_emails, sincronizacao = resposta
+        if sincronizacao:
+            sincronizacoes.append(sincronizacao)
+
+        print(f"  ✅ {len(user_emails)} emails para {user_email}")
+        # Adicionar informação do usuário a cada email
+        for email in user_emails:
+            email["source_user"] = user_email
+            email["source_user_name"] = display_name
+        all_emails.extend(user_emails)
+        processed_users.append({
+            "email": user_email,
+            "name": display_name,
+            "emails_count": len(user_emails)
+        })
+    return all_emails, processed_users, sincronizacoes
+
+
+# Mensagens já baixadas à espera da extração: limita os anexos em memória
+FILA_ANEXOS = int(os.getenv("TRIAGEM_FILA_ANEXOS") or 16)
+
+# O ENGINE atende uma triagem por vez, seja no event loop (arquivos
+# enviados) ou numa thread (emails)
+EXTRACAO = asyncio.Lock()
+
+
+async def baixar_anexos(graph, mensagens, falhas, fila):
+    """Baixa os anexos de arquivo das mensagens em paralelo e os põe em
+    ``fila`` (``asyncio.Queue``) assim que cada mensagem termina, para a
+    extração começar sem esperar o lote inteiro.
+
+    No máximo ``FILA_ANEXOS`` mensagens ficam baixadas à espera de vaga
+    na fila. As mensagens cujo download falhou entram em ``falhas``; um
+    ``None`` fecha a fila.
+    """
+    vagas = asyncio.Semaphore(FILA_ANEXOS)
+
+    async def baixar(msg):
+        async with vagas:
+            try:
+                baixados = await graph.file_attachments(
+                    msg["source_user"], msg["id"], msg.get("attachments")
+                )
+            except Exception as e:
+                print(f"  ⚠️ Erro ao baixar anexos de {msg['id']}: {e}")
+                falhas.add((msg["source_user"], msg["id"]))
+                return
+            for anexo in baixados:
+                await fila.put((msg, *anexo))
+
+    await asyncio.gather(*(baixar(msg) for msg in mensagens))
+    await fila.put(None)
+
+
+def ler_fila(fila, loop):
+    """Itera numa thread os itens de ``fila``, que pertence ao event loop
+    ``loop``, até o ``None`` final"""
+    while True:
+        item = asyncio.run_coroutine_threadsafe(fila.get(), loop).result()
+        if item is None:
+            return
+        yield item
+
+
+async def varrer_dominio(graph, max_emails, incremental=False):
+    """Busca as mensagens do domínio e separa as ``max_emails``
+    primeiras que têm anexo (os anexos vêm depois, ``baixar_anexos``).
+
+    No modo incremental entram todas as mensagens novas de cada caixa
+    (o limite deixaria mensagens para trás) e o estado a salvar no fim
+    volta junto.
+    """
+    all_emails, processed_users, sincronizacoes = await coletar_emails(
+        graph, min(max_emails, 100), incremental
+    )
+    emails_com_anexos = [
+        e for e in all_emails if e.get("hasAttachments", False)
+    ]
+    if not incremental:
+        emails_com_anexos = emails_com_anexos[:max_emails]
+    return all_emails, processed_users, emails_com_anexos, sincronizacoes
+
+
 # Security
 security = HTTPBearer()
 
@@ -228,45 +439,75 @@ async def executar_triagem(
         total_processados = 0
         total_aprovados = 0
         aprovados_info = []
+        ignorados_info = []
+
+        # Compilar critérios uma única vez para todos os arquivos
+        criterios = compile_criteria(
+            [request.vaga_descricao] + request.palavras_chave,
+            request.palavras_negativas,
+            request.formacoes,
+            fuzzy=request.tolerancia_ocr
+        )
+        # Com top_k os arquivos são ordenados por relevância (BM25)
+        ranking = (
+            RelevanceRanking(criterios, request.top_k)
+            if request.top_k else None
+        )
 
-        # Processar cada arquivo
-        for arquivo in arquivos:
-            if arquivo.is_file():
+        def ler_arquivos():
+            for arquivo in arquivos:
+                if arquivo.is_file():
+                    # ZIP/EML/MSG: um documento por arquivo interno
+                    for caminho, tipo, conteudo, formato in (
+                            expand_attachment(arquivo.name, "",
+                                              arquivo.read_bytes())):
+                        yield arquivo, caminho, tipo, conteudo, None, formato
+
+        # Parar de ler o PDF cedo não combina com o ranking (BM25), e o
+        # texto parcial não vai para o índice
+        parar_cedo = request.parar_cedo and ranking is None
+
+        # Extrair os arquivos em paralelo e processar conforme terminam,
+        # numa thread: esperar o pool não pode travar o loop de eventos
+        def triar():
+            nonlocal total_processados, total_aprovados
+            for job, resultado in ENGINE.map_unordered(
+                    ler_arquivos(), criterios if parar_cedo else None):
+                arquivo, caminho, _, data, _, _ = job
+                texto, ocr_usado = resultado
                 total_processados += 1
 
-                # Extrair texto do arquivo
-                with open(arquivo, "rb") as f:
-                    data = f.read()
-
-                texto, ocr_usado = extract_text_any(
-                    arquivo.name,
-                    "",
-                    data
-                )
-
+                if "status" in resultado.detalhes:
+                    # Estourou o tempo ou a memória; o lote segue
+                    ignorados_info.append({
+                        "arquivo": caminho,
+                        "status": resultado.detalhes["status"]
+                    })
+                    continue
                 if not texto:
                     continue
+                if caminho != arquivo.name:
+                    # Documento de dentro de um contêiner enviado: vira um
+                    # arquivo próprio para poder ir para aprovados
+                    arquivo = save_bytes(UPLOAD_DIR, caminho, data)
 
-                # Verificar critérios positivos
-                palavras_positivas = ([request.vaga_descricao] +
-                                      request.palavras_chave)
-                pos_hit = any(
-                    _has_exact_phrase(texto, palavra)
-                    for palavra in palavras_positivas
-                )
+                doc = NormalizedDocument(texto)
+                if not parar_cedo:
+                    indexar_documento(data, arquivo.name, doc, ocr_usado)
 
-                # Verificar critérios negativos
-                neg_hit = any(
-                    _has_exact_phrase(texto, palavra)
-                    for palavra in request.palavras_negativas
-                ) if request.palavras_negativas else False
+                if ranking is not None:
+                    ranking.add(doc, (arquivo, {
+                        "arquivo": arquivo.name,
+                        "caminho": caminho,
+                        "tamanho_texto": len(texto),
+                        "ocr_usado": ocr_usado,
+                        **resultado.detalhes
+                    }))
+                    continue
 
-                # Verificar formações
-                formacoes_encontradas = []
-                if request.formacoes:
-                    for formacao in request.formacoes:
-                        if _has_exact_phrase(texto, formacao):
-                            formacoes_encontradas.append(formacao)
+                # Verificar positivas, negativas e formações numa passada
+                pos_hit, neg_hit, formacoes_encontradas = \
+                    criterios.evaluate(doc)
 
                 # Critério de aprovação
                 aprovado = pos_hit and not neg_hit
@@ -280,11 +521,20 @@ async def executar_triagem(
 
                     aprovados_info.append({
                         "arquivo": arquivo.name,
+                        "caminho": caminho,
                         "formacoes_encontradas": formacoes_encontradas,
                         "tamanho_texto": len(texto),
-                        "ocr_usado": ocr_usado
+                        "ocr_usado": ocr_usado,
+                        **resultado.detalhes
                     })
 
+        async with EXTRACAO:
+            await asyncio.to_thread(triar)
+
+        if ranking is not None:
+            aprovados_info = mover_ranking(ranking)
+            total_aprovados = len(aprovados_info)
+
         # Limpar arquivos restantes
         for arquivo in UPLOAD_DIR.glob("*"):
             if arquivo.is_file():
@@ -301,7 +551,8 @@ async def executar_triagem(
             total_processados=total_processados,
             total_aprovados=total_aprovados,
             percentual_aprovacao=round(percentual, 2),
-            arquivos_aprovados=aprovados_info
+            arquivos_aprovados=aprovados_info,
+            arquivos_ignorados=ignorados_info
         )
 
     except Exception as e:
@@ -311,6 +562,53 @@ async def executar_triagem(
         )
 
 
+@app.post("/triagem-indice", response_model=TriagemResponse)
+async def triagem_indice(
+    request: TriagemRequest,
+    token: str = Depends(verify_token)
+):
+    """Refazer a triagem sobre o índice de CVs já extraídos (sem OCR).
+
+    Segue a regra de /triagem: frases inteiras (``CompiledCriteria``),
+    sem exigir formação. A triagem de emails casa trechos
+    (``candidato_aprovado``), então "farm" lá acha "farmácia" e aqui não.
+    """
+    try:
+        criterios = compile_criteria(
+            [request.vaga_descricao] + request.palavras_chave,
+            request.palavras_negativas,
+            request.formacoes,
+            fuzzy=request.tolerancia_ocr
+        )
+        total_processados = len(INDICE)
+        if request.top_k:
+            aprovados_info = list(INDICE.rank(criterios, request.top_k))
+        else:
+            aprovados_info = list(INDICE.search(criterios))
+        total_aprovados = len(aprovados_info)
+
+        percentual = (
+            total_aprovados /
+            total_processados *
+            100) if total_processados > 0 else 0
+
+        return TriagemResponse(
+            success=True,
+            message=("Triagem sobre o índice concluída com sucesso "
+                     "(frases inteiras, como em /triagem)"),
+            total_processados=total_processados,
+            total_aprovados=total_aprovados,
+            percentual_aprovacao=round(percentual, 2),
+            arquivos_aprovados=aprovados_info
+        )
+
+    except Exception as e:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Erro durante a triagem do índice: {str(e)}"
+        )
+
+
 @app.get("/aprovados", response_model=dict)
 async def listar_aprovados(token: str = Depends(verify_token)):
     """Listar arquivos aprovados"""
@@ -360,6 +658,7 @@ async def triagem_email_odq(
     token: str = Depends(verify_token)
 ):
     """Triagem emails do domínio @odequadroservicos.com.br"""
+    graph = None
     print("🚀 Iniciando triagem de emails...")
     print(f"📋 Vaga: {request.vaga_descricao}")
     print(f"🏷️ Palavras-chave: {request.palavras_chave}")
@@ -401,8 +700,9 @@ async def triagem_email_odq(
         if not all([client_id, client_secret, authority]):
             return {"erro": "Configurações Microsoft Graph não encontradas"}
 
-        # Obter token de autenticação
-        auth_token = get_token_from_env(
+        # Provedor de token compartilhado: reaproveita o token entre as
+        # chamadas e o renova durante varreduras longas
+        auth_token = get_token_provider_from_env(
             client_id, client_secret, authority, scope
         )
 
@@ -412,110 +712,43 @@ async def triagem_email_odq(
         print("🔍 PROCESSANDO EMAILS DO DOMÍNIO @odequadroservicos.com.br")
         print(f"📧 Máximo de emails por usuário: {request.max_emails}")
 
-        # Lista para armazenar todos os emails de todo o domínio
-        all_emails = []
-        processed_users = []
-
-        # Buscar lista de usuários do domínio @odequadroservicos.com.br
-        users_endpoint = (
-            "https://graph.microsoft.com/v1.0/users?"
-            "$filter=endswith(userPrincipalName,'@odequadroservicos.com.br')"
-            "&$top=100&$select=userPrincipalName,displayName"
-        )
-
-        headers = {"Authorization": f"Bearer {auth_token}"}
-
-        # Buscar usuários do domínio
-        import requests
-        users_response = requests.get(users_endpoint, headers=headers)
-
-        if users_response.status_code != 200:
-            print(f"❌ Erro ao buscar usuários: {users_response.status_code}")
-            return {
-                "erro": f"Erro ao buscar usuários: "
-                        f"{users_response.status_code}"
-            }
-
-        users_data = users_response.json()
-        domain_users = users_data.get("value", [])
-
-        print(f"👥 Encontrados {len(domain_users)} usuários no domínio")
-
-        # Processar emails de cada usuário do domínio
-        total_emails_found = 0
-
-        for user in domain_users:
-            user_email = user.get("userPrincipalName")
-            display_name = user.get("displayName", "")
-
-            if not user_email:
-                continue
-
-            print(f"📬 Processando: {display_name} ({user_email})")
-
-            # Endpoint para emails deste usuário específico
-            max_per_user = min(request.max_emails, 100)
-            user_emails_endpoint = (
-                f"https://graph.microsoft.com/v1.0/users/{user_email}"
-                f"/messages?$top={max_per_user}"
+        # Caixas, mensagens e anexos buscados em paralelo (httpx)
+        graph = AsyncGraphClient(auth_token, client=app.state.graph_http)
+        try:
+            (all_emails, processed_users, emails_com_anexos,
+             sincronizacoes) = await varrer_dominio(
+                graph, request.max_emails, request.incremental
             )
-
-            try:
-                user_emails_response = requests.get(
-                    user_emails_endpoint, headers=headers
-                )
-
-                if user_emails_response.status_code == 200:
-                    user_emails_data = user_emails_response.json()
-                    user_emails = user_emails_data.get("value", [])
-
-                    print(f"  ✅ {len(user_emails)} emails para {user_email}")
-
-                    # Adicionar informação do usuário a cada email
-                    for email in user_emails:
-                        email["source_user"] = user_email
-                        email["source_user_name"] = display_name
-
-                    all_emails.extend(user_emails)
-                    total_emails_found += len(user_emails)
-                    processed_users.append({
-                        "email": user_email,
-                        "name": display_name,
-                        "emails_count": len(user_emails)
-                    })
-
-                else:
-                    status_code = user_emails_response.status_code
-                    print(f"  ⚠️ Erro ao acessar emails de {user_email}: "
-                          f"{status_code}")
-
-            except Exception as e:
-                print(f"  ❌ Erro ao processar {user_email}: {str(e)}")
-                continue
+        except Exception as e:
+            print(f"❌ Erro ao buscar usuários: {e}")
+            return {"erro": f"Erro ao buscar usuários: {e}"}
+        total_emails_found = len(all_emails)
+        # (caixa, id) das mensagens que não foram triadas por inteiro
+        falhas = set()
 
         print(f"🎯 TOTAL DE EMAILS COLETADOS: {total_emails_found}")
         print(f"👥 USUÁRIOS PROCESSADOS: {len(processed_users)}")
 
         if not all_emails:
-            return {
-                "status": "nenhum_email_encontrado",
-                "total_emails": 0,
-                "usuarios_processados": len(processed_users),
-                "detalhes_usuarios": processed_users
-            }
+            salvar_sincronizacao(sincronizacoes, falhas)
+            # Caso comum no modo incremental: nada novo desde a última
+            return TriagemResponse(
+                success=True,
+                message="Nenhum email encontrado no domínio",
+                total_processados=0,
+                total_aprovados=0,
+                percentual_aprovacao=0.0,
+                arquivos_aprovados=[],
+                detalhes_usuarios=processed_users
+            )
 
         # Usar os emails já coletados de todo o domínio
         print(f"🔄 Processando triagem de {len(all_emails)} emails...")
 
-        # Filtrar apenas emails com anexos
-        emails_com_anexos = []
-        for email in all_emails:
-            if email.get("hasAttachments", False):
-                emails_com_anexos.append(email)
-
         print(f"📎 Emails com anexos encontrados: {len(emails_com_anexos)}")
 
         if not emails_com_anexos:
+            salvar_sincronizacao(sincronizacoes, falhas)
             return TriagemResponse(
                 success=True,
                 message="Nenhum email com anexos encontrado no domínio",
@@ -529,49 +762,97 @@ async def triagem_email_odq(
         total_anexos = 0
         total_aprovados = 0
         aprovados_info = []
+        ignorados_info = []
+
+        criterios_negativos = compile_criteria(
+            negativas=request.palavras_negativas
+        )
+        criterios = compile_criteria(
+            [request.vaga_descricao] + request.palavras_chave,
+            request.palavras_negativas,
+            request.formacoes,
+            fuzzy=request.tolerancia_ocr
+        )
+        # Com top_k os anexos são ordenados por relevância (BM25)
+        ranking = (
+            RelevanceRanking(criterios, request.top_k)
+            if request.top_k else None
+        )
+        # Parar de ler o PDF cedo não combina com o ranking, e o texto
+        # parcial não vai para o índice
+        parar_cedo = request.parar_cedo and ranking is None
 
         # Criar diretório temporário para anexos
         tmp_dir = Path(tempfile.mkdtemp(prefix="triagem_emails_"))
 
-        # Processar emails
-        for msg in emails_com_anexos[:request.max_emails]:
-            msg_id = msg.get('id')
-            if not msg.get('hasAttachments'):
-                continue
-
-            # Listar anexos do email - usar o email da origem
-            user_email_source = msg.get("source_user")
-            if not user_email_source:
-                continue
-            attachments = list_attachments(
-                user_email_source, msg_id, auth_token
-            )
-
-            for att in attachments:
-                if att.get('@odata.type') != \
-                        '#microsoft.graph.fileAttachment':
+        def ler_anexos(anexos):
+            for msg, fname, data, ctype, digest in anexos:
+                user_email_source = msg["source_user"]
+                # ZIP/EML/MSG: um documento por arquivo interno, com o
+                # caminho "portfolio.zip/cv.pdf"
+                for caminho, tipo, conteudo, formato in expand_attachment(
+                        fname, ctype, data):
+                    # Salvar temporariamente; vários documentos estão em
+                    # andamento ao mesmo tempo, então cada um tem o seu
+                    # arquivo mesmo com nomes iguais
+                    safe_filename = safe_name(caminho)
+                    temp_path = save_bytes(tmp_dir, safe_filename, conteudo,
+                                           unique=True)
+
+                    ctx = (msg, user_email_source, safe_filename, temp_path)
+                    # O hash do download só vale para o próprio anexo
+                    sha = digest if conteudo is data else None
+                    yield ctx, caminho, tipo, conteudo, sha, formato
+
+        def triar(anexos):
+            """Extrai em paralelo e avalia os anexos conforme chegam"""
+            nonlocal total_anexos, total_aprovados
+            for job, resultado in ENGINE.map_unordered(
+                    ler_anexos(anexos), criterios if parar_cedo else None):
+                texto, ocr_usado = resultado
+                ctx, caminho, _, data, sha, _ = job
+                msg, user_email_source, safe_filename, temp_path = ctx
+                total_anexos += 1
+                if not resultado.complete:
+                    # Falhou ou estourou o orçamento: a mensagem volta na
+                    # próxima triagem incremental
+                    falhas.add((user_email_source, msg["id"]))
+
+                if "status" in resultado.detalhes:
+                    # Estourou o tempo ou a memória; o lote segue
+                    ignorados_info.append({
+                        "arquivo": caminho,
+                        "email_assunto": msg.get('subject', 'Sem assunto'),
+                        "email_origem": user_email_source,
+                        "status": resultado.detalhes["status"]
+                    })
+                    temp_path.unlink(missing_ok=True)
                     continue
-
-                # Baixar anexo
-                fname, data, ctype = download_attachment(
-                    user_email_source, msg_id, att['id'], auth_token
-                )
-
-                if not fname or not data:
+                if not texto:
                     continue
 
-                total_anexos += 1
-
-                # Salvar temporariamente
-                safe_filename = safe_name(fname)
-                temp_path = save_bytes(tmp_dir, safe_filename, data)
-
-                # Extrair texto
-                texto, ocr_usado = extract_text_any(
-                    fname, ctype, data
-                )
+                # Normalizar uma única vez para todos os filtros
+                doc = NormalizedDocument(texto)
+                if not parar_cedo:
+                    indexar_documento(data, safe_filename, doc, ocr_usado, {
+                        "email_assunto": msg.get('subject', 'Sem assunto'),
+                        "email_data": msg.get('receivedDateTime', ''),
+                        "email_origem": user_email_source
+                    }, sha)
 
-                if not texto:
+                if ranking is not None:
+                    descartado = ranking.add(doc, (temp_path, {
+                        "arquivo": safe_filename,
+                        "caminho": caminho,
+                        "email_assunto": msg.get('subject', 'Sem assunto'),
+                        "email_data": msg.get('receivedDateTime', ''),
+                        "email_origem": user_email_source,
+                        "tamanho_texto": len(texto),
+                        "ocr_usado": ocr_usado,
+                        **resultado.detalhes
+                    }))
+                    if descartado is not None:
+                        descartado[0].unlink(missing_ok=True)
                     continue
 
                 # Aplicar critérios de triagem
@@ -580,40 +861,62 @@ async def triagem_email_odq(
 
                 # Usar a função completa de candidato aprovado
                 aprovado, formacoes_encontradas = candidato_aprovado(
-                    texto,
+                    doc,
                     palavras_positivas,
-                    request.formacoes
+                    request.formacoes,
+                    fuzzy=request.tolerancia_ocr
                 )
 
                 # Verificar palavras negativas
-                neg_hit = any(
-                    _has_exact_phrase(texto, palavra)
-                    for palavra in request.palavras_negativas
-                ) if request.palavras_negativas else False
+                _, neg_hit, _ = criterios_negativos.evaluate(doc)
 
                 # Decisão final
                 if aprovado and not neg_hit:
                     total_aprovados += 1
 
                     # Mover para pasta de aprovados
-                    arquivo_aprovado = APROVADOS_DIR / safe_filename
+                    arquivo_aprovado = destino_aprovado(safe_filename)
                     temp_path.rename(arquivo_aprovado)
 
                     aprovados_info.append({
-                        "arquivo": safe_filename,
+                        "arquivo": arquivo_aprovado.name,
+                        "caminho": caminho,
                         "email_assunto": msg.get('subject', 'Sem assunto'),
                         "email_data": msg.get('receivedDateTime', ''),
                         "email_origem": user_email_source,
                         "formacoes_encontradas": list(formacoes_encontradas),
                         "tamanho_texto": len(texto),
-                        "ocr_usado": ocr_usado
+                        "ocr_usado": ocr_usado,
+                        **resultado.detalhes
                     })
                 else:
                     # Remover arquivo não aprovado
                     temp_path.unlink(missing_ok=True)
 
+        # Os downloads seguem no event loop enquanto uma thread extrai o
+        # que já chegou
+        fila = asyncio.Queue(FILA_ANEXOS)
+        downloads = asyncio.create_task(
+            baixar_anexos(graph, emails_com_anexos, falhas, fila)
+        )
+        try:
+            async with EXTRACAO:
+                await asyncio.to_thread(
+                    triar, ler_fila(fila, asyncio.get_running_loop())
+                )
+        finally:
+            downloads.cancel()
+            await asyncio.gather(downloads, return_exceptions=True)
+
+        if ranking is not None:
+            aprovados_info = mover_ranking(ranking)
+            total_aprovados = len(aprovados_info)
+
         # Limpar diretório temporário
         shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Só agora as caixas avançam: uma triagem que falhou no meio
+        # repete as mesmas mensagens na próxima
+        salvar_sincronizacao(sincronizacoes, falhas)
 
         percentual = (
             total_aprovados /
@@ -628,7 +931,8 @@ async def triagem_email_odq(
             total_aprovados=total_aprovados,
             percentual_aprovacao=round(percentual, 2),
             arquivos_aprovados=aprovados_info,
-            detalhes_usuarios=processed_users
+            detalhes_usuarios=processed_users,
+            arquivos_ignorados=ignorados_info
         )
 
     except Exception as e:
@@ -636,6 +940,23 @@ async def triagem_email_odq(
             status_code=500,
             detail=f"Erro durante triagem de emails: {str(e)}"
         )
+    finally:
+        if graph is not None:
+            await graph.aclose()
+
+
+@app.delete("/sincronizacao")
+async def resetar_sincronizacao(
+    caixa: Optional[str] = None,
+    token: str = Depends(verify_token)
+):
+    """Zera o estado incremental de uma caixa (ou de todas); a próxima
+    triagem incremental lê as caixas inteiras"""
+    zeradas = DELTA.reset(caixa)
+    return {
+        "success": True,
+        "message": f"Estado incremental zerado ({zeradas} caixas)"
+    }
 
 
 @app.delete("/limpar")
@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do motor de triagem ODQ
+Mede o desempenho das etapas críticas e confere que os resultados
+continuam idênticos à implementação anterior.
+
+Uso:
+    python benchmark_triagem.py normalizacao [--chars 100000]
+    python benchmark_triagem.py ocr [--paginas 20] [--lang por+eng]
+    python benchmark_triagem.py preprocessamento [--corpus DIR]
+    python benchmark_triagem.py docx [--paragrafos 500]
+"""
+
+import argparse
+import random
+import re
+import shutil
+import sys
+import time
+import unicodedata
+from pathlib import Path
+
+import confidential_client_secret_sample as motor
+from confidential_client_secret_sample import (
+    _normalize, normalize_text, normalize_batch
+)
+
+
+def _normalize_antigo(s: str) -> str:
+    s = s.replace("\u00AD", "")
+    s = re.sub(r'(?<=\w)-\s+(?=\w)', '', s)
+    s = s.lower()
+    s = ''.join(
+        c for c in unicodedata.normalize('NFD', s)
+        if unicodedata.category(c) != 'Mn'
+    )
+    s = re.sub(r'\s+', ' ', s).strip()
+    return s
+
+
+def _normalize_text_antigo(s):
+    s = s.lower()
+    s = ''.join(
+        c for c in unicodedata.normalize('NFD', s)
+        if unicodedata.category(c) != 'Mn'
+    )
+    s = re.sub(r'\s+', ' ', s).strip()
+    return s
+
+
+_PALAVRAS = (
+    "Graduação em Farmácia pela Universidade Estadual, experiência em "
+    "controle de qualidade, análise físico-química, Química Industrial, "
+    "BIOMEDICINA, coordenação de equipes, técnico em laboratório, "
+    "informática, inglês avançado, espanhol intermediário, São Paulo, "
+    "currículo, formação acadêmica, certificações, atuação, ﬁscal, "
+    "Ωmega, Straße, İstanbul, naïve, Œuvre, “aspas”, – travessão •"
+).split()
+
+
+def _gerar_texto_ocr(chars: int, seed: int = 42) -> str:
+    rnd = random.Random(seed)
+    partes = []
+    total = 0
+    while total < chars:
+        palavra = rnd.choice(_PALAVRAS)
+        sep = rnd.choice([" ", " ", "\n", "  ", "\t", "-\n", "\u00AD"])
+        partes.append(palavra + sep)
+        total += len(palavra) + len(sep)
+    return "".join(partes)[:chars]
+
+
+def _cronometrar(func, arg, repeticoes: int) -> float:
+    melhor = float("inf")
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        func(arg)
+        melhor = min(melhor, time.perf_counter() - inicio)
+    return melhor
+
+
+def _conferir_normalizacao(textos) -> int:
+    """Compara o kernel novo com a implementação antiga."""
+    divergencias = 0
+    for t in textos:
+        if _normalize(t) != _normalize_antigo(t):
+            divergencias += 1
+        if normalize_text(t) != _normalize_text_antigo(t):
+            divergencias += 1
+    return divergencias
+
+
+def bench_normalizacao(args):
+    texto = _gerar_texto_ocr(args.chars)
+    # Todos os caracteres do BMP (exceto surrogates) em blocos
+    bmp = "".join(
+        chr(c) for c in range(0x10000) if not 0xD800 <= c <= 0xDFFF
+    )
+    blocos = [bmp[i:i + 512] for i in range(0, len(bmp), 512)]
+    casos = [texto, "ΟΔΟΣ ΣΟΦΟΣ", "ᬅ᭄ᬓ Σ-\n x"] + blocos
+    divergencias = _conferir_normalizacao(casos)
+    print(f"Conferência: {len(casos)} textos, {divergencias} divergências")
+
+    for nome, antigo, novo in (
+        ("_normalize", _normalize_antigo, _normalize),
+        ("normalize_text", _normalize_text_antigo, normalize_text),
+    ):
+        t_antigo = _cronometrar(antigo, texto, args.repeticoes)
+        t_novo = _cronometrar(novo, texto, args.repeticoes)
+        print(
+            f"{nome:15s} {args.chars} chars: antigo={t_antigo * 1000:.1f}ms "
+            f"novo={t_novo * 1000:.1f}ms ({t_antigo / t_novo:.1f}x)"
+        )
+
+    lote = [_gerar_texto_ocr(args.chars // 10, seed=i) for i in range(10)]
+    inicio = time.perf_counter()
+    normalize_batch(lote, exact=True)
+    t_lote = time.perf_counter() - inicio
+    print(f"normalize_batch 10 x {args.chars // 10} chars: "
+          f"{t_lote * 1000:.1f}ms")
+    return 1 if divergencias else 0
+
+
+def _gerar_paginas(n: int, seed: int = 42):
+    """Páginas sintéticas (PIL) com trechos de CV em fonte grande."""
+    from PIL import Image, ImageDraw, ImageFont
+    try:
+        fonte = ImageFont.truetype("DejaVuSans.ttf", 36)
+    except OSError:
+        fonte = ImageFont.load_default(size=36)
+    rnd = random.Random(seed)
+    paginas = []
+    for _ in range(n):
+        img = Image.new("L", (1240, 1754), 255)
+        draw = ImageDraw.Draw(img)
+        for linha in range(rnd.randint(3, 12)):
+            texto = " ".join(rnd.choice(_PALAVRAS[:20]) for _ in range(5))
+            draw.text((80, 80 + linha * 60), texto, fill=0, font=fonte)
+        paginas.append(img)
+    return paginas
+
+
+def _backend_disponivel(nome: str) -> bool:
+    if nome == "tesserocr":
+        return motor.tesserocr is not None
+    if motor.pytesseract is None:
+        return False
+    cmd = motor.pytesseract.pytesseract.tesseract_cmd
+    return shutil.which(cmd) is not None
+
+
+def bench_ocr(args):
+    paginas = _gerar_paginas(args.paginas)
+    resultados = {}
+    for nome in ("pytesseract", "lote", "tesserocr"):
+        if not _backend_disponivel(nome):
+            print(f"{nome:12s} indisponível")
+            continue
+        # Inclui a carga dos modelos, que é o custo que o lote amortiza
+        motor._TESSEROCR_APIS.clear()
+        inicio = time.perf_counter()
+        if nome == "pytesseract":
+            textos = [
+                motor.ocr_images([p], args.lang, nome)[0] for p in paginas
+            ]
+        else:
+            textos = []
+            for i in range(0, len(paginas), motor.OCR_BATCH_PAGES):
+                lote = paginas[i:i + motor.OCR_BATCH_PAGES]
+                textos.extend(motor.ocr_images(lote, args.lang, nome))
+        tempo = time.perf_counter() - inicio
+        resultados[nome] = [normalize_text(t) for t in textos]
+        print(f"{nome:12s} {len(paginas)} páginas em {tempo:.2f}s "
+              f"({len(paginas) / tempo:.1f} páginas/s)")
+    divergencias = 0
+    if "pytesseract" in resultados:
+        base = resultados["pytesseract"]
+        for nome, textos in resultados.items():
+            diff = sum(1 for a, b in zip(base, textos) if a != b)
+            print(f"{nome:12s} {diff} páginas diferentes de pytesseract")
+            divergencias += diff
+    return 1 if divergencias else 0
+
+
+_PALAVRAS_CHAVE = (
+    "farmácia", "biomedicina", "química", "laboratório", "qualidade",
+    "enfermagem", "microbiologia", "engenharia", "análises", "hospital",
+)
+
+
+def _gerar_fotos(n: int, seed: int = 7):
+    """Páginas que imitam fotos de celular: fundo tingido, inclinação,
+    desfoque e letra grande. Retorna ``[(imagem, palavras_esperadas)]``.
+    """
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont
+    rnd = random.Random(seed)
+    corpus = []
+    for _ in range(n):
+        tamanho = rnd.choice((40, 56, 72))
+        try:
+            fonte = ImageFont.truetype("DejaVuSans.ttf", tamanho)
+        except OSError:
+            fonte = ImageFont.load_default(size=tamanho)
+        fundo = tuple(rnd.randint(200, 240) for _ in range(3))
+        img = Image.new("RGB", (2480, 3508), fundo)
+        draw = ImageDraw.Draw(img)
+        esperadas = rnd.sample(_PALAVRAS_CHAVE, 4)
+        for linha, palavra in enumerate(esperadas):
+            texto = f"{palavra} " + " ".join(
+                rnd.choice(_PALAVRAS[:20]) for _ in range(2)
+            )
+            draw.text((250, 500 + linha * tamanho * 2), texto,
+                      fill=(40, 40, 50), font=fonte)
+        img = img.rotate(rnd.uniform(-3, 3), fillcolor=fundo)
+        img = img.filter(ImageFilter.GaussianBlur(rnd.uniform(0.5, 1.5)))
+        corpus.append((img, esperadas))
+    return corpus
+
+
+def _ler_corpus(pasta: str, palavras):
+    from PIL import Image
+    exts = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+    return [
+        (Image.open(p), palavras) for p in sorted(Path(pasta).iterdir())
+        if p.suffix.lower() in exts
+    ]
+
+
+def bench_preprocessamento(args):
+    if args.corpus:
+        palavras = [p.strip() for p in args.palavras.split(",") if p.strip()]
+        corpus = _ler_corpus(args.corpus, palavras)
+    else:
+        corpus = _gerar_fotos(args.paginas)
+    backend = motor.ocr_backend()
+    print(f"Corpus: {len(corpus)} páginas, backend {backend}")
+    # Carrega os modelos antes de cronometrar
+    motor.ocr_images(corpus[:1][0][:1], args.lang, backend, ())
+    completo = motor.OCR_PREPROCESS_STEPS + ("binarizar",)
+    for nome, etapas in (("sem etapas", ()),
+                         ("padrão", motor.OCR_PREPROCESS_STEPS),
+                         ("padrão+binarizar", completo)):
+        achadas = total = 0
+        inicio = time.perf_counter()
+        for img, esperadas in corpus:
+            texto = normalize_text(
+                motor.ocr_images([img], args.lang, backend, etapas)[0]
+            )
+            total += len(esperadas)
+            achadas += sum(1 for p in esperadas if normalize_text(p) in texto)
+        tempo = time.perf_counter() - inicio
+        print(f"{nome:>16s}: {tempo:.2f}s "
+              f"({len(corpus) / tempo:.2f} páginas/s), "
+              f"recall {achadas}/{total} ({achadas / max(total, 1):.0%})")
+    return 0
+
+
+def _docx_antigo(data: bytes) -> str:
+    """Caminho anterior: arquivo temporário + modelo do python-docx."""
+    import tempfile
+    import docx
+    with tempfile.NamedTemporaryFile(suffix=".docx", delete=True) as tmp:
+        tmp.write(data)
+        tmp.flush()
+        d = docx.Document(tmp.name)
+        return "\n".join(p.text for p in d.paragraphs)
+
+
+def _gerar_docx(paragrafos: int, seed: int = 3) -> bytes:
+    """CV sintético com formação em tabela, cabeçalho e rodapé."""
+    import io
+    import docx
+    rnd = random.Random(seed)
+    d = docx.Document()
+    d.sections[0].header.paragraphs[0].text = "Maria Silva - Farmacêutica"
+    d.sections[0].footer.paragraphs[0].text = "Formação: Farmácia (USP)"
+    for _ in range(paragrafos):
+        d.add_paragraph(" ".join(rnd.choice(_PALAVRAS) for _ in range(12)))
+    tabela = d.add_table(rows=3, cols=2)
+    tabela.cell(0, 0).text = "Formação"
+    tabela.cell(0, 1).text = "Biomedicina - UFRJ"
+    tabela.cell(1, 1).text = "Química Industrial - UFMG"
+    buf = io.BytesIO()
+    d.save(buf)
+    return buf.getvalue()
+
+
+def bench_docx(args):
+    data = _gerar_docx(args.paragrafos)
+    esperados = ("Farmácia (USP)", "Biomedicina", "Química Industrial",
+                 "Maria Silva")
+    for nome, func in (("python-docx", _docx_antigo),
+                       ("docx_text", motor.docx_text)):
+        tempo = _cronometrar(func, data, args.repeticoes)
+        texto = func(data)
+        achados = [e for e in esperados if e in texto]
+        print(f"{nome:12s} {len(data) // 1024} KB: {tempo * 1000:.1f}ms, "
+              f"{len(texto)} chars, achou {len(achados)}/{len(esperados)} "
+              f"trechos de tabela/cabeçalho/rodapé")
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmarks do motor de triagem"
+    )
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p_norm = sub.add_parser("normalizacao", help="Kernel de normalização")
+    p_norm.add_argument("--chars", type=int, default=100_000)
+    p_norm.add_argument("--repeticoes", type=int, default=5)
+    p_norm.set_defaults(func=bench_normalizacao)
+
+    p_ocr = sub.add_parser("ocr", help="Modos de execução do Tesseract")
+    p_ocr.add_argument("--paginas", type=int, default=20)
+    p_ocr.add_argument("--lang", default=motor.OCR_LANG)
+    p_ocr.set_defaults(func=bench_ocr)
+
+    p_pre = sub.add_parser(
+        "preprocessamento", help="Velocidade e recall do OCR com/sem "
+        "pré-processamento"
+    )
+    p_pre.add_argument("--paginas", type=int, default=10)
+    p_pre.add_argument("--corpus", help="Pasta com imagens reais")
+    p_pre.add_argument("--palavras", default=",".join(_PALAVRAS_CHAVE),
+                       help="Palavras esperadas nas imagens do --corpus")
+    p_pre.add_argument("--lang", default=motor.OCR_LANG)
+    p_pre.set_defaults(func=bench_preprocessamento)
+
+    p_docx = sub.add_parser("docx", help="Extração de DOCX")
+    p_docx.add_argument("--paragrafos", type=int, default=500)
+    p_docx.add_argument("--repeticoes", type=int, default=5)
+    p_docx.set_defaults(func=bench_docx)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
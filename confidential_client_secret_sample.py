@@ -1,55 +1,220 @@
 import argparse
+import asyncio
+import contextlib
+import csv
+import email
 import hashlib
+import heapq
 import io
 import json
+import math
+import multiprocessing
+import os
 import re
+import shlex
+import shutil
+import signal
+import sqlite3
+import subprocess
 import sys
+import tempfile
+import threading
 import time
 import unicodedata
+import urllib.parse
+import uuid
+import zipfile
+import zlib
+from array import array
+from concurrent.futures import (
+    FIRST_COMPLETED, ProcessPoolExecutor, wait
+)
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from email import policy as email_policy
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from html.parser import HTMLParser
 from pathlib import Path
+from xml.etree import ElementTree
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
 
 import msal
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+# Cliente assíncrono do Graph (varredura do domínio no backend)
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
 # Garante que a saída padrão será UTF-8
 if hasattr(sys.stdout, "reconfigure"):
     sys.stdout.reconfigure(encoding="utf-8")
 
+GRAPH_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_RETRY_STATUS = (408, 429, 500, 502, 503, 504)
+FILE_ATTACHMENT = "#microsoft.graph.fileAttachment"
+
+
+def graph_base_url() -> str:
+    """Raiz da API: ``GRAPH_BASE_URL`` (ex.: servidor local de teste)."""
+    return (os.getenv("GRAPH_BASE_URL") or GRAPH_URL).rstrip("/")
+
+
+def retry_after(value, default: float) -> float:
+    """Segundos de espera de um ``Retry-After``, que pode vir em segundos
+    ou como data HTTP; ``default`` se faltar ou não for legível."""
+    if not value:
+        return default
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        quando = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if quando.tzinfo is None:
+        quando = quando.replace(tzinfo=timezone.utc)
+    return max((quando - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+# Timeouts (segundos) de toda chamada ao Graph: conexão e leitura
+GRAPH_CONNECT_TIMEOUT = 10
+GRAPH_READ_TIMEOUT = 60
+GRAPH_MAX_RETRIES = 5
+
+
+def graph_timeout(read: float = GRAPH_READ_TIMEOUT):
+    return (GRAPH_CONNECT_TIMEOUT, read)
+
 
-def make_session(max_retries: int) -> requests.Session:
+def make_session(max_retries: int, pool_size: int = None) -> requests.Session:
     s = requests.Session()
     retry = Retry(
         total=max_retries,
         connect=max_retries,
         read=max_retries,
         backoff_factor=1.5,
-        status_forcelist=[408, 429, 500, 502, 503, 504],
+        status_forcelist=list(GRAPH_RETRY_STATUS),
         allowed_methods=frozenset(["GET", "POST"]),
         raise_on_status=False,
         respect_retry_after_header=True,
     )
-    adapter = HTTPAdapter(max_retries=retry, pool_maxsize=10)
+    adapter = HTTPAdapter(
+        max_retries=retry,
+        pool_maxsize=pool_size or default_graph_concurrency()
+    )
     s.mount("https://", adapter)
     s.mount("http://", adapter)
     return s
 
 
+_GRAPH_SESSIONS = {}
+_GRAPH_SESSIONS_LOCK = threading.Lock()
+
+
+def graph_session(max_retries: int = GRAPH_MAX_RETRIES) -> requests.Session:
+    """Sessão do processo para o Graph (e o login do MSAL).
+
+    As conexões ficam abertas entre as chamadas, num pool do tamanho de
+    ``default_graph_concurrency()``, e toda requisição passa pela mesma
+    política ``Retry`` (falhas de rede, 408/429/5xx com ``Retry-After``).
+    """
+    with _GRAPH_SESSIONS_LOCK:
+        if max_retries not in _GRAPH_SESSIONS:
+            _GRAPH_SESSIONS[max_retries] = make_session(max_retries)
+        return _GRAPH_SESSIONS[max_retries]
+
+
+class _MsalHttp:
+    """A sessão do Graph como ``http_client`` do MSAL, com timeout.
+
+    O MSAL não repassa o próprio ``timeout`` a um ``http_client``
+    externo; sem isto um login travado prenderia a varredura (e o lock
+    do token) indefinidamente. ``close()`` não fecha a sessão, que é
+    compartilhada com as chamadas ao Graph.
+    """
+
+    def __init__(self, session: requests.Session, timeout=None):
+        self._session = session
+        self._timeout = timeout or graph_timeout()
+
+    def get(self, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.get(url, *args, **kwargs)
+
+    def post(self, url, *args, **kwargs):
+        kwargs.setdefault("timeout", self._timeout)
+        return self._session.post(url, *args, **kwargs)
+
+    def close(self):
+        pass
+
+
 # OCR opcional
 try:
     from pdf2image import convert_from_bytes
     import pytesseract
-    from PIL import Image
+    from PIL import Image, ImageChops, ImageFilter, ImageOps
     HAVE_OCR = True
 except Exception:
     convert_from_bytes = None
     pytesseract = None
-    Image = None
+    Image = ImageChops = ImageFilter = ImageOps = None
     HAVE_OCR = False
 
+# Modo persistente do OCR (modelos carregados uma vez por processo)
+try:
+    import tesserocr
+except Exception:
+    tesserocr = None
+
+# Anexos .msg do Outlook (arquivo OLE)
+try:
+    import olefile
+except Exception:
+    olefile = None
+
 OCR_LANG = "por+eng"
+# Escolha automática do idioma (TRIAGEM_OCR_IDIOMA=auto; outro valor fixa
+# o idioma): uma faixa da primeira página passa pelo OCR com
+# OCR_DETECT_LANG e as palavras mais comuns de cada idioma decidem
+OCR_DETECT_LANG = "por"
+OCR_LANG_STOPWORDS = {
+    "por": frozenset((
+        "de da do das dos em no na nos nas para com que nao os as um uma "
+        "e ao pela pelo experiencia formacao curso ensino superior "
+        "cargo empresa atividades"
+    ).split()),
+    "eng": frozenset((
+        "the of and to in for with at on from is as by experience "
+        "education skills university work company degree"
+    ).split()),
+}
 MIN_TEXT_CHARS = 80
+# Páginas por execução do Tesseract no modo "lote"
+OCR_BATCH_PAGES = 8
+# Pré-processamento antes do OCR (ver preprocess_page). TRIAGEM_OCR_PREPROC
+# escolhe as etapas separadas por vírgula; "0" desliga. "binarizar" fica
+# de fora do padrão: o limiar interno do Tesseract preserva melhor os
+# acentos (benchmark_triagem.py preprocessamento)
+OCR_PREPROCESS_STEPS = ("cinza", "endireitar", "recortar", "reduzir")
+OCR_TARGET_XHEIGHT = 20
+OCR_MAX_SKEW = 5.0
+# Decisão de OCR por página (ver _page_needs_ocr)
+OCR_PAGE_MIN_CHARS = 40
+OCR_PAGE_MAX_CHARS = 200
+OCR_PAGE_IMAGE_COVERAGE = 0.5
+OCR_PAGE_GARBAGE_RATIO = 0.3
 
 
 def safe_print(msg: str):
@@ -63,28 +228,135 @@ def safe_print(msg: str):
 
 
 _SOFT_HYPHEN = "\u00AD"
+# Equivale a r'(?<=\w)-\s+(?=\w)', mas começa pelo literal '-', o que
+# deixa o re pular direto para os hífens
+_HYPHEN_BREAK = re.compile(r'-(?<=\w-)\s+(?=\w)')
 
 
-def _normalize(s: str) -> str:
-    s = s.replace(_SOFT_HYPHEN, "")
-    s = re.sub(r'(?<=\w)-\s+(?=\w)', '', s)
-    s = s.lower()
-    s = ''.join(
-        c for c in unicodedata.normalize('NFD', s)
+def _fold_slow(s: str) -> str:
+    # Caminho de referência: minúsculas, NFD e remoção das marcas (Mn)
+    return ''.join(
+        c for c in unicodedata.normalize('NFD', s.lower())
         if unicodedata.category(c) != 'Mn'
     )
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+
+
+class _FoldTable(dict):
+    """Tabela de ``str.translate`` que dobra caixa e acentos por caractere.
+
+    Latin-1 e Latin Extended-A/B são pré-calculados; os demais caracteres
+    são calculados na primeira vez que aparecem e ficam guardados.
+    Caracteres cujo resultado depende do contexto (sigma maiúsculo, marcas
+    combinantes que não são Mn) são anotados em ``unsafe`` para que
+    ``_fold`` recorra ao caminho lento.
+    """
+
+    def __init__(self, first_range: int):
+        super().__init__()
+        self.unsafe = set()
+        for cp in range(first_range):
+            self[cp] = self._compute(cp)
+
+    def _compute(self, cp: int) -> str:
+        c = chr(cp)
+        decomposed = unicodedata.normalize('NFD', c.lower())
+        if c == "\u03A3" or any(
+            unicodedata.combining(x) and unicodedata.category(x) != 'Mn'
+            for x in decomposed
+        ):
+            self.unsafe.add(c)
+        return ''.join(
+            x for x in decomposed if unicodedata.category(x) != 'Mn'
+        )
+
+    def __missing__(self, cp: int) -> str:
+        folded = self[cp] = self._compute(cp)
+        return folded
+
+
+_FOLD_TABLE = _FoldTable(0x250)
+_TOKEN_RE = re.compile(r'\w+')
+
+
+def _fold(s: str) -> str:
+    folded = s.translate(_FOLD_TABLE)
+    if _FOLD_TABLE.unsafe and any(c in s for c in _FOLD_TABLE.unsafe):
+        return _fold_slow(s)
+    return folded
+
+
+def _normalize(s: str) -> str:
+    s = s.replace(_SOFT_HYPHEN, "")
+    if "-" in s:
+        s = _HYPHEN_BREAK.sub('', s)
+    return ' '.join(_fold(s).split())
 
 
 def normalize_text(s):
-    s = s.lower()
-    s = ''.join(
-        c for c in unicodedata.normalize('NFD', s)
-        if unicodedata.category(c) != 'Mn'
-    )
-    s = re.sub(r'\s+', ' ', s).strip()
-    return s
+    return ' '.join(_fold(s).split())
+
+
+def normalize_batch(textos, exact: bool = False) -> list:
+    """Normaliza uma lista de documentos com o mesmo kernel.
+
+    ``exact=True`` aplica ``_normalize`` (frases exatas); caso contrário
+    ``normalize_text``.
+    """
+    func = _normalize if exact else normalize_text
+    return [func(t or "") for t in textos]
+
+
+class NormalizedDocument:
+    """Texto de um documento com as normalizações calculadas uma só vez.
+
+    ``exact`` é a forma de ``_normalize`` (usada nas frases exatas) e
+    ``normalized`` a de ``normalize_text`` (usada por
+    ``candidato_aprovado``). Ambas são calculadas sob demanda e ficam
+    guardadas, então o mesmo objeto pode passar por todos os filtros.
+    """
+
+    __slots__ = ("texto", "_exact", "_normalized", "_tokens")
+
+    def __init__(self, texto: str):
+        self.texto = texto or ""
+        self._exact = None
+        self._normalized = None
+        self._tokens = None
+
+    @property
+    def exact(self) -> str:
+        if self._exact is None:
+            self._exact = _normalize(self.texto)
+        return self._exact
+
+    @property
+    def normalized(self) -> str:
+        if self._normalized is None:
+            self._normalized = normalize_text(self.texto)
+        return self._normalized
+
+    @property
+    def tokens(self) -> list:
+        """Palavras (``\\w+``) da forma ``exact``, em ordem."""
+        if self._tokens is None:
+            self._tokens = _TOKEN_RE.findall(self.exact)
+        return self._tokens
+
+    @classmethod
+    def from_exact(cls, exact: str) -> "NormalizedDocument":
+        """Documento reconstruído a partir da forma ``exact`` já salva."""
+        doc = cls(exact)
+        doc._exact = exact
+        return doc
+
+    def __len__(self):
+        return len(self.texto)
+
+
+def as_document(texto) -> NormalizedDocument:
+    if isinstance(texto, NormalizedDocument):
+        return texto
+    return NormalizedDocument(texto)
 
 
 def _has_exact_phrase(texto: str, frase: str) -> bool:
@@ -93,47 +365,549 @@ def _has_exact_phrase(texto: str, frase: str) -> bool:
     return re.search(r'\b' + re.escape(p) + r'\b', t) is not None
 
 
+def _is_word_char(c: str) -> bool:
+    # Mesma definição de \w usada pelo módulo re para str
+    return c.isalnum() or c == "_"
+
+
+class PhraseMatcher:
+    """Autômato Aho-Corasick que procura várias frases numa única passada.
+
+    As frases e o texto devem chegar já normalizados. Com
+    ``word_boundary=True`` uma ocorrência só é aceita se respeitar as
+    mesmas fronteiras que ``\\b`` impõe em ``_has_exact_phrase``.
+    ``iter_matches`` devolve o índice (na lista original) de cada frase
+    encontrada, permitindo ao chamador parar assim que decidir.
+    """
+
+    def __init__(self, phrases, word_boundary: bool = True):
+        self.phrases = list(phrases)
+        self.word_boundary = word_boundary
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [[]]
+        self._empty = []
+        for idx, phrase in enumerate(self.phrases):
+            if not phrase:
+                self._empty.append(idx)
+                continue
+            state = 0
+            for ch in phrase:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self._goto)
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._out.append([])
+                    self._goto[state][ch] = nxt
+                state = nxt
+            self._out[state].append(idx)
+        self._build_failure_links()
+        # Se a frase começa/termina com caractere de palavra
+        self._first_word = [
+            bool(p) and _is_word_char(p[0]) for p in self.phrases
+        ]
+        self._last_word = [
+            bool(p) and _is_word_char(p[-1]) for p in self.phrases
+        ]
+
+    def _build_failure_links(self):
+        queue = list(self._goto[0].values())
+        for state in queue:
+            for ch, nxt in self._goto[state].items():
+                queue.append(nxt)
+                f = self._fail[state]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                # Herda as saídas do estado de falha (sufixos)
+                self._out[nxt] = (
+                    self._out[nxt] + self._out[self._fail[nxt]]
+                )
+
+    def _accept(self, text: str, end: int, idx: int) -> bool:
+        if not self.word_boundary:
+            return True
+        start = end - len(self.phrases[idx])
+        before = start > 0 and _is_word_char(text[start - 1])
+        if before == self._first_word[idx]:
+            return False
+        after = end < len(text) and _is_word_char(text[end])
+        return after != self._last_word[idx]
+
+    def iter_matches(self, text: str):
+        if self._empty:
+            # r'\b\b' casa se houver qualquer caractere de palavra
+            if not self.word_boundary or re.search(r'\w', text):
+                yield from self._empty
+        goto = self._goto
+        fail = self._fail
+        out = self._out
+        state = 0
+        for end, ch in enumerate(text, 1):
+            nxt = goto[state].get(ch)
+            while nxt is None and state:
+                state = fail[state]
+                nxt = goto[state].get(ch)
+            state = nxt or 0
+            if out[state]:
+                for idx in out[state]:
+                    if self._accept(text, end, idx):
+                        yield idx
+
+
+def _fuzzy_max_edits(term_len: int, max_edits: int) -> int:
+    # Palavras curtas toleram menos erros para não casar com qualquer coisa
+    if term_len <= 3:
+        return 0
+    if term_len <= 5:
+        return min(max_edits, 1)
+    return max_edits
+
+
+class _TokenTrie:
+    """Trie das palavras distintas de um documento.
+
+    ``search`` percorre a trie calculando uma linha da matriz de
+    Levenshtein por nó (como um autômato de Levenshtein) e abandona o
+    ramo assim que todos os valores passam do limite, então o custo
+    depende só dos prefixos próximos da palavra procurada.
+    """
+
+    def __init__(self, tokens):
+        self.root = {}
+        for tok in tokens:
+            node = self.root
+            for ch in tok:
+                node = node.setdefault(ch, {})
+            node[None] = tok
+
+    def search(self, word: str, max_edits: int) -> set:
+        found = set()
+        first = list(range(len(word) + 1))
+        stack = [(ch, child, first) for ch, child in self.root.items()
+                 if ch is not None]
+        while stack:
+            ch, node, prev = stack.pop()
+            row = [prev[0] + 1]
+            for i, wc in enumerate(word, 1):
+                row.append(min(
+                    row[i - 1] + 1,
+                    prev[i] + 1,
+                    prev[i - 1] + (wc != ch),
+                ))
+            if row[-1] <= max_edits and None in node:
+                found.add(node[None])
+            if min(row) <= max_edits:
+                stack.extend(
+                    (c, child, row) for c, child in node.items()
+                    if c is not None
+                )
+        return found
+
+
+class FuzzyPhraseMatcher:
+    """Casamento de frases tolerante a erros de OCR.
+
+    Cada palavra da frase casa com palavras do documento a até
+    ``max_edits`` edições (menos para palavras curtas, ver
+    ``_fuzzy_max_edits``) e as palavras precisam aparecer em sequência.
+    As frases devem chegar normalizadas.
+    """
+
+    def __init__(self, phrases, max_edits: int):
+        self.phrases = list(phrases)
+        self.max_edits = max_edits
+        self._tokens = [tuple(_TOKEN_RE.findall(p)) for p in self.phrases]
+
+    def count(self, texto, indices=None) -> dict:
+        """Ocorrências aproximadas de cada frase em ``indices``."""
+        doc = as_document(texto)
+        if indices is None:
+            indices = range(len(self.phrases))
+        indices = [i for i in indices if self._tokens[i]]
+        tokens = doc.tokens
+        distinct = set(tokens)
+        trie = None
+        variants = {}
+        for tok in {t for i in indices for t in self._tokens[i]}:
+            allowed = _fuzzy_max_edits(len(tok), self.max_edits)
+            if not allowed:
+                variants[tok] = {tok} & distinct
+                continue
+            if trie is None:
+                trie = _TokenTrie(distinct)
+            variants[tok] = trie.search(tok, allowed)
+        wanted = set().union(*variants.values()) if variants else set()
+        positions = {}
+        for pos, tok in enumerate(tokens):
+            if tok in wanted:
+                positions.setdefault(tok, []).append(pos)
+        counts = {}
+        for i in indices:
+            first, *rest = self._tokens[i]
+            total = 0
+            for v in variants[first]:
+                for pos in positions.get(v, ()):
+                    if all(
+                        pos + j < len(tokens)
+                        and tokens[pos + j] in variants[t]
+                        for j, t in enumerate(rest, 1)
+                    ):
+                        total += 1
+            counts[i] = total
+        return counts
+
+
+@lru_cache(maxsize=64)
+def _fuzzy_matcher(terms: tuple, max_edits: int) -> FuzzyPhraseMatcher:
+    return FuzzyPhraseMatcher(terms, max_edits)
+
+
+class CompiledCriteria:
+    """Critérios de triagem compilados num único ``PhraseMatcher``.
+
+    Equivale a chamar ``_has_exact_phrase`` para cada palavra positiva,
+    negativa e formação, mas normaliza o texto uma só vez. Use
+    ``compile_criteria`` para reaproveitar a compilação entre chamadas.
+    """
+
+    def __init__(self, positivas=(), negativas=(), formacoes=(),
+                 fuzzy: int = 0):
+        self.positivas = tuple(positivas)
+        self.negativas = tuple(negativas)
+        self.formacoes = tuple(formacoes)
+        self.fuzzy = fuzzy
+        phrases = self.positivas + self.negativas + self.formacoes
+        self._n_pos = len(self.positivas)
+        self._n_neg = len(self.negativas)
+        self._matcher = PhraseMatcher(_normalize(p) for p in phrases)
+        # Negativas continuam exatas: a tolerância vale para o que aprova
+        self._fuzzy = (
+            FuzzyPhraseMatcher(self._matcher.phrases, fuzzy)
+            if fuzzy else None
+        )
+
+    def __reduce__(self):
+        # Processos de extração recompilam (com cache) em vez de receber
+        # os autômatos serializados
+        return compile_criteria, (
+            self.positivas, self.negativas, self.formacoes, self.fuzzy
+        )
+
+    def _fuzzy_indices(self, pos_hit: bool, found) -> list:
+        form_base = self._n_pos + self._n_neg
+        indices = [] if pos_hit else list(range(self._n_pos))
+        indices.extend(
+            form_base + i for i, hit in enumerate(found) if not hit
+        )
+        return indices
+
+    def evaluate(self, texto, early_stop: bool = True):
+        """Retorna ``(pos_hit, neg_hit, formacoes_encontradas)``.
+
+        ``texto`` pode ser ``str`` ou ``NormalizedDocument``.
+
+        Com ``early_stop`` a varredura termina assim que a decisão
+        (``pos_hit and not neg_hit``) estiver definida: na primeira
+        negativa encontrada, ou quando não há negativas e já houve
+        positiva e todas as formações. Após uma negativa, ``pos_hit`` e
+        as formações podem estar incompletos.
+        """
+        n_pos, n_neg = self._n_pos, self._n_neg
+        form_base = n_pos + n_neg
+        pos_hit = False
+        neg_hit = False
+        found = [False] * len(self.formacoes)
+        pending_form = len(found)
+        doc = as_document(texto)
+        for idx in self._matcher.iter_matches(doc.exact):
+            if idx < n_pos:
+                pos_hit = True
+            elif idx < form_base:
+                neg_hit = True
+                if early_stop:
+                    break
+            elif not found[idx - form_base]:
+                found[idx - form_base] = True
+                pending_form -= 1
+            if (early_stop and pos_hit and not pending_form
+                    and not n_neg):
+                break
+        if self._fuzzy is not None and not neg_hit:
+            fuzzy_counts = self._fuzzy.count(
+                doc, self._fuzzy_indices(pos_hit, found)
+            )
+            for idx, total in fuzzy_counts.items():
+                if not total:
+                    continue
+                if idx < n_pos:
+                    pos_hit = True
+                else:
+                    found[idx - form_base] = True
+        formacoes_encontradas = [
+            f for f, hit in zip(self.formacoes, found) if hit
+        ]
+        return pos_hit, neg_hit, formacoes_encontradas
+
+    def decided(self, texto, vistos: dict = None) -> bool:
+        """Indica se mais texto não pode mudar o resultado de ``texto``.
+
+        Verdadeiro quando já há uma negativa, ou quando não há negativas
+        e já foram encontradas uma positiva e todas as formações.
+
+        Com ``vistos`` (o mesmo dict a cada chamada), ``texto`` é só um
+        trecho do documento e os achados somam-se aos dos trechos
+        anteriores, sem reler o que já foi avaliado.
+        """
+        pos_hit, neg_hit, formacoes = self.evaluate(texto)
+        if vistos is not None:
+            pos_hit = vistos["pos"] = pos_hit or vistos.get("pos", False)
+            vistos.setdefault("formacoes", set()).update(formacoes)
+            formacoes = vistos["formacoes"]
+        if neg_hit:
+            return True
+        return (not self._n_neg and pos_hit
+                and set(formacoes) == set(self.formacoes))
+
+    def count_matches(self, texto):
+        """Conta as ocorrências de cada frase, sem parada antecipada.
+
+        Retorna ``(tf_positivas, neg_hit, tf_formacoes)``.
+        """
+        doc = as_document(texto)
+        counts = [0] * (self._n_pos + self._n_neg + len(self.formacoes))
+        for idx in self._matcher.iter_matches(doc.exact):
+            counts[idx] += 1
+        form_base = self._n_pos + self._n_neg
+        if self._fuzzy is not None:
+            # Só recorre à contagem aproximada onde a exata não achou nada
+            missing = [
+                i for i, c in enumerate(counts)
+                if not c and not self._n_pos <= i < form_base
+            ]
+            for idx, total in self._fuzzy.count(doc, missing).items():
+                counts[idx] = total
+        return (
+            counts[:self._n_pos],
+            any(counts[self._n_pos:form_base]),
+            counts[form_base:],
+        )
+
+
+@lru_cache(maxsize=32)
+def _compile_criteria_cached(positivas, negativas, formacoes, fuzzy):
+    return CompiledCriteria(positivas, negativas, formacoes, fuzzy)
+
+
+def compile_criteria(positivas=(), negativas=(), formacoes=(), fuzzy=0):
+    """Compila (ou busca no cache LRU) os critérios de uma triagem.
+
+    ``fuzzy`` > 0 ativa o casamento tolerante a erros de OCR para
+    positivas e formações (até ``fuzzy`` edições por palavra).
+    """
+    return _compile_criteria_cached(
+        tuple(positivas), tuple(negativas), tuple(formacoes), fuzzy or 0
+    )
+
+
 def load_config(path: str) -> dict:
     with open(path, "r", encoding="utf-8") as f:
         return json.load(f)
 
 
-def get_token(cfg: dict) -> str:
-    app = msal.ConfidentialClientApplication(
-        client_id=cfg["client_id"],
-        authority=cfg["authority"],
-        client_credential=cfg["secret"],
-    )
-    scopes = cfg.get("scope", ["https://graph.microsoft.com/.default"])
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+# Renova o token quando faltam menos que isso (segundos) para vencer
+TOKEN_REFRESH_MARGIN = 300
+
+
+class TokenError(Exception):
+    """O Azure AD não entregou um token de acesso."""
+
+
+def default_token_cache():
+    """Arquivo do cache de tokens do MSAL: ``TRIAGEM_TOKEN_CACHE``
+    (``0`` mantém o cache só em memória)."""
+    path = os.getenv("TRIAGEM_TOKEN_CACHE")
+    if path == "0":
+        return None
+    if not path:
+        path = Path.home() / ".cache" / "triagem" / "token_cache.json"
+    return Path(path)
+
+
+class TokenProvider:
+    """Token de aplicativo (client credentials) do Graph, reaproveitado.
+
+    Um único ``ConfidentialClientApplication`` com ``SerializableTokenCache``
+    (gravado em ``cache_path``, se houver), então execuções seguidas do CLI
+    e chamadas seguidas do backend reusam o mesmo token. ``token()``
+    renova antes do vencimento (``refresh_margin``) e ``renew()`` troca
+    um token que o Graph recusou (401). Pode ser usado por várias threads.
+    """
+
+    def __init__(self, client_id: str, authority: str, secret: str,
+                 scopes=None, cache_path=None,
+                 refresh_margin: int = TOKEN_REFRESH_MARGIN):
+        if isinstance(scopes, str):
+            scopes = [scopes]
+        self.scopes = list(scopes or GRAPH_SCOPES)
+        self.cache_path = Path(cache_path) if cache_path else None
+        self.refresh_margin = refresh_margin
+        self._cache = msal.SerializableTokenCache()
+        if self.cache_path and self.cache_path.exists():
+            try:
+                self._cache.deserialize(self.cache_path.read_text())
+            except (OSError, ValueError) as e:
+                safe_print(f"[WARN] Cache de tokens ignorado: {e}")
+        self._app = msal.ConfidentialClientApplication(
+            client_id=client_id,
+            authority=authority,
+            client_credential=secret,
+            token_cache=self._cache,
+            http_client=_MsalHttp(graph_session()),
+        )
+        self._lock = threading.Lock()
+        self._token = None
+        self._expires_at = 0.0
+
+    def current(self):
+        """Token em memória que ainda vale pela margem, sem ir à rede."""
+        limite = self._expires_at - self.refresh_margin
+        if self._token and time.time() < limite:
+            return self._token
+        return None
+
+    def token(self) -> str:
+        token = self.current()
+        if token:
+            return token
+        with self._lock:
+            return self.current() or self._acquire()
+
+    def renew(self, rejected: str) -> str:
+        """Token novo depois de um 401 com ``rejected``; se outra thread
+        já renovou, devolve o dela."""
+        with self._lock:
+            if self._token and self._token != rejected:
+                return self._token
+            return self._acquire(force=True)
+
+    def _acquire(self, force: bool = False) -> str:
+        if force:
+            # Sem isso o MSAL devolveria o mesmo token do cache
+            self._app.remove_tokens_for_client()
+        result = self._app.acquire_token_for_client(scopes=self.scopes)
+        if "access_token" not in result:
+            raise TokenError(f"{result.get('error')}: "
+                             f"{result.get('error_description')}")
+        expires_in = int(result.get("expires_in") or 0)
+        if expires_in <= self.refresh_margin and not force:
+            # Token do cache perto de vencer: pede outro já
+            return self._acquire(force=True)
+        if result.get("token_source") != "cache":
+            safe_print(f"[INFO] Novo token obtido (vale {expires_in}s)")
+        self._token = result["access_token"]
+        self._expires_at = time.time() + expires_in
+        self._persist()
+        return self._token
+
+    def _persist(self):
+        if self.cache_path is None or not self._cache.has_state_changed:
+            return
+        try:
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.cache_path.with_name(self.cache_path.name + ".tmp")
+            # O cache guarda tokens: só o dono lê
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, "w") as f:
+                f.write(self._cache.serialize())
+            os.replace(tmp, self.cache_path)
+            self._cache.has_state_changed = False
+        except OSError as e:
+            safe_print(f"[WARN] Cache de tokens não gravado: {e}")
+
+
+_TOKEN_PROVIDERS = {}
+_TOKEN_PROVIDERS_LOCK = threading.Lock()
+
+
+def token_provider(client_id: str, authority: str, secret: str,
+                   scopes=None) -> TokenProvider:
+    """``TokenProvider`` único do processo para estas credenciais."""
     if isinstance(scopes, str):
         scopes = [scopes]
-    result = app.acquire_token_silent(scopes=scopes, account=None)
-    if not result:
-        safe_print("[INFO] Nenhum token no cache. Solicitando novo...")
-        result = app.acquire_token_for_client(scopes=scopes)
-    if "access_token" not in result:
-        error_msg = (
-            f"[ERRO] Falha ao obter token: {result.get('error')}: "
-            f"{result.get('error_description')}"
-        )
-        safe_print(error_msg)
+    chave = (client_id, authority, secret, tuple(scopes or GRAPH_SCOPES))
+    with _TOKEN_PROVIDERS_LOCK:
+        if chave not in _TOKEN_PROVIDERS:
+            _TOKEN_PROVIDERS[chave] = TokenProvider(
+                client_id, authority, secret, scopes,
+                cache_path=default_token_cache()
+            )
+        return _TOKEN_PROVIDERS[chave]
+
+
+def get_token_provider(cfg: dict) -> TokenProvider:
+    """Provedor do ``parameters.json``, já com um token válido."""
+    tokens = token_provider(
+        cfg["client_id"], cfg["authority"], cfg["secret"], cfg.get("scope")
+    )
+    try:
+        tokens.token()
+    except TokenError as e:
+        safe_print(f"[ERRO] Falha ao obter token: {e}")
         sys.exit(2)
-    return result["access_token"]
+    return tokens
 
 
-def fetch_messages(
-    endpoint: str,
+def get_token(cfg: dict) -> str:
+    return get_token_provider(cfg).token()
+
+
+def bearer_token(token) -> str:
+    """String do token; ``token`` pode ser um ``TokenProvider``."""
+    if isinstance(token, TokenProvider):
+        return token.token()
+    return token
+
+
+def graph_get(url: str, token, session=None, headers: dict = None,
+              timeout=None, **kwargs):
+    """GET autenticado no Graph pela sessão compartilhada
+    (``graph_session``), com ``graph_timeout()`` por padrão.
+
+    Com um ``TokenProvider`` um 401 (token vencido no meio de uma
+    varredura longa) é repetido uma vez com um token novo.
+    """
+    http = session or graph_session()
+    kwargs["timeout"] = timeout or graph_timeout()
+    bearer = bearer_token(token)
+    for renovado in (False, True):
+        resp = http.get(url, headers={**(headers or {}),
+                                      "Authorization": f"Bearer {bearer}"},
+                        **kwargs)
+        if (resp.status_code != 401 or renovado
+                or not isinstance(token, TokenProvider)):
+            return resp
+        resp.close()
+        safe_print("[RETRY] Graph 401: renovando o token")
+        bearer = token.renew(bearer)
+
+
+def _iter_pages(
+    url: str,
     token: str,
-    timeout: int = 60,
-    max_retries: int = 5
+    timeout: int = GRAPH_READ_TIMEOUT,
+    max_retries: int = GRAPH_MAX_RETRIES,
+    headers: dict = None
 ):
-    sess = make_session(max_retries)
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/json"
-    }
-    url = endpoint
-    items = []
+    """Cada página JSON da coleção, seguindo ``@odata.nextLink``.
+
+    ``token`` é a string ou um ``TokenProvider`` (ver ``graph_get``).
+    """
+    sess = graph_session(max_retries)
+    headers = {"Accept": "application/json", **(headers or {})}
+    total = 0
     page = 1
     while url:
         attempt = 0
@@ -141,9 +915,10 @@ def fetch_messages(
             attempt += 1
             try:
                 safe_print(f"Buscando página {page}: {url}")
-                resp = sess.get(url, headers=headers, timeout=(10, timeout))
+                resp = graph_get(url, token, session=sess, headers=headers,
+                                 timeout=graph_timeout(timeout))
                 if resp.status_code == 429:
-                    ra = int(resp.headers.get("Retry-After", "5"))
+                    ra = retry_after(resp.headers.get("Retry-After"), 5)
                     safe_print(
                         f"[RETRY] 429 Too Many Requests – aguardando {ra}s"
                     )
@@ -156,12 +931,13 @@ def fetch_messages(
                     resp.raise_for_status()
                 data = resp.json()
                 batch = data.get("value", [])
-                items.extend(batch)
+                total += len(batch)
                 url = data.get("@odata.nextLink")
                 msg = f"Página {page} recebida, msgs={len(batch)}, "
-                msg += f"acumulado={len(items)}"
+                msg += f"acumulado={total}"
                 safe_print(msg)
                 page += 1
+                yield data
                 break
             except (
                 requests.exceptions.ReadTimeout,
@@ -179,30 +955,170 @@ def fetch_messages(
                     msg = f"[ERRO] Falhou após {max_retries} tentativas: {e}"
                     safe_print(msg)
                     raise
+
+
+def fetch_messages(
+    endpoint: str,
+    token: str,
+    timeout: int = GRAPH_READ_TIMEOUT,
+    max_retries: int = GRAPH_MAX_RETRIES
+):
+    items = []
+    for data in _iter_pages(endpoint, token, timeout, max_retries):
+        items.extend(data.get("value", []))
     return items
 
 
+DELTA_FOLDER = "inbox"
+DELTA_PAGE_SIZE = 100
+# Rodadas em que uma mensagem incompleta volta a ser triada
+DELTA_MAX_RETRIES = 3
+
+
+def delta_url(user: str, folder: str = DELTA_FOLDER) -> str:
+    """Consulta delta inicial das mensagens de uma pasta da caixa."""
+    return (f"{graph_base_url()}/users/{user}/mailFolders/{folder}"
+            f"/messages/delta?$select={MESSAGE_FIELDS}")
+
+
+def fetch_messages_delta(
+    user_email: str,
+    token: str,
+    delta_link: str = None,
+    folder: str = DELTA_FOLDER,
+    timeout: int = GRAPH_READ_TIMEOUT,
+    max_retries: int = GRAPH_MAX_RETRIES
+):
+    """``(mensagens, novo_delta_link)`` alteradas desde ``delta_link``.
+
+    Sem ``delta_link`` (ou se o Graph não o aceita mais, 410) a pasta é
+    lida inteira. Filtre o resultado com ``added_messages``.
+    """
+    headers = {"Prefer": f"odata.maxpagesize={DELTA_PAGE_SIZE}"}
+    url = delta_link or delta_url(user_email, folder)
+    items = []
+    novo_link = None
+    try:
+        for data in _iter_pages(url, token, timeout, max_retries, headers):
+            items.extend(data.get("value", []))
+            novo_link = data.get("@odata.deltaLink")
+    except requests.exceptions.HTTPError as e:
+        if delta_link is None or e.response.status_code != 410:
+            raise
+        safe_print(f"[WARN] deltaLink de {user_email} expirou; "
+                   f"sincronizando a pasta inteira")
+        return fetch_messages_delta(user_email, token, None, folder,
+                                    timeout, max_retries)
+    return items, novo_link
+
+
+def added_messages(items: list, since: str = None):
+    """``(novas, recebido_ate)``: mensagens de uma rodada delta que
+    chegaram depois de ``since``.
+
+    O delta também devolve removidas (``@removed``) e alteradas (lidas,
+    movidas); só entram as recebidas após a última sincronização, cujo
+    ``receivedDateTime`` (ISO, UTC) máximo é devolvido para a próxima.
+    """
+    novas = [
+        m for m in items
+        if "@removed" not in m
+        and (since is None or m.get("receivedDateTime", "") > since)
+    ]
+    recebido_ate = max(
+        [m["receivedDateTime"] for m in novas if m.get("receivedDateTime")]
+        + ([since] if since else []),
+        default=None
+    )
+    return novas, recebido_ate
+
+
+def fetch_message(user_email, msg_id, token):
+    """Uma mensagem (``MESSAGE_FIELDS``) pelo id, ou None se ela não
+    existir mais (apagada ou movida)."""
+    url = f"{graph_base_url()}/users/{user_email}/messages/{msg_id}"
+    resp = graph_get(url, token, params={"$select": MESSAGE_FIELDS})
+    if resp.status_code == 404:
+        return None
+    resp.raise_for_status()
+    return resp.json()
+
+
 def list_attachments(user_email, msg_id, token):
-    base_url = "https://graph.microsoft.com/v1.0/users"
+    """Metadados (``ATTACHMENT_FIELDS``) dos anexos, sem o conteúdo, ou
+    None se a listagem falhar."""
+    base_url = f"{graph_base_url()}/users"
     url = f"{base_url}/{user_email}/messages/{msg_id}/attachments"
-    headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(url, headers=headers)
+    resp = graph_get(url, token, params={"$select": ATTACHMENT_FIELDS})
     if resp.status_code != 200:
         safe_print(f"[WARN] Falha ao listar anexos: {resp.text}")
-        return []
+        return None
     return resp.json().get("value", [])
 
 
 def download_attachment(user_email, msg_id, att_id, token):
-    base_url = "https://graph.microsoft.com/v1.0/users"
+    base_url = f"{graph_base_url()}/users"
     url = f"{base_url}/{user_email}/messages/{msg_id}/attachments/{att_id}"
-    headers = {"Authorization": f"Bearer {token}"}
-    resp = requests.get(url, headers=headers)
+    resp = graph_get(url, token)
     if resp.status_code != 200:
         safe_print(f"[WARN] Falha ao baixar anexo {att_id}: {resp.text}")
         return None, None, None
-    att = resp.json()
-    if att.get('@odata.type') == '#microsoft.graph.fileAttachment':
+    return file_attachment(resp.json(), att_id)
+
+
+# Tamanho de cada parte lida nos downloads em streaming
+STREAM_CHUNK = 256 * 1024
+
+
+class HashingWriter:
+    """Destino de um download em partes: junta os bytes e calcula o
+    SHA-256 (o mesmo de ``content_hash``) enquanto eles chegam."""
+
+    def __init__(self):
+        self._buffer = io.BytesIO()
+        self._sha = hashlib.sha256()
+        self.size = 0
+
+    def write(self, chunk: bytes) -> int:
+        self._sha.update(chunk)
+        self.size += len(chunk)
+        return self._buffer.write(chunk)
+
+    def hexdigest(self) -> str:
+        return self._sha.hexdigest()
+
+    def getvalue(self) -> bytes:
+        # O BytesIO entrega o próprio buffer, sem uma segunda cópia
+        return self._buffer.getvalue()
+
+
+def stream_attachment(user_email, msg_id, att, token,
+                      timeout=GRAPH_READ_TIMEOUT):
+    """Baixa o conteúdo cru (``/$value``) de um fileAttachment em partes.
+
+    ``att`` são os metadados de ``list_attachments``. Retorna
+    ``(fname, data, ctype, sha256)``, ou Nones se o download falhar; o
+    conteúdo nunca passa por base64 nem é copiado inteiro.
+    """
+    base_url = f"{graph_base_url()}/users"
+    url = (f"{base_url}/{user_email}/messages/{msg_id}/attachments/"
+           f"{att['id']}/$value")
+    writer = HashingWriter()
+    with graph_get(url, token, stream=True,
+                   timeout=graph_timeout(timeout)) as resp:
+        if resp.status_code != 200:
+            safe_print(f"[WARN] Falha ao baixar anexo {att['id']}: "
+                       f"{resp.status_code}")
+            return None, None, None, None
+        for chunk in resp.iter_content(STREAM_CHUNK):
+            writer.write(chunk)
+    return (att.get("name", att["id"]), writer.getvalue(),
+            att.get("contentType", ""), writer.hexdigest())
+
+
+def file_attachment(att: dict, att_id: str = ""):
+    """``(fname, data, ctype)`` de um fileAttachment do Graph, ou Nones."""
+    if att.get('@odata.type') == FILE_ATTACHMENT:
         fname = att.get('name', att_id)
         ctype = att.get('contentType', '')
         import base64
@@ -218,106 +1134,2226 @@ def download_attachment(user_email, msg_id, att_id, token):
     return None, None, None
 
 
-_ILLEGAL = r'[\\/:*?"<>|]'
+def default_graph_concurrency() -> int:
+    """Requisições simultâneas: ``TRIAGEM_GRAPH_CONCORRENCIA`` (16)."""
+    return int(os.getenv("TRIAGEM_GRAPH_CONCORRENCIA") or 16)
+
+
+# O Graph aceita até 4 requisições simultâneas por caixa postal
+GRAPH_MAILBOX_CONCURRENCY = 4
+# JSON $batch: até 20 sub-requisições por POST; as chamadas que chegam
+# dentro de GRAPH_BATCH_DELAY segundos vão juntas
+GRAPH_BATCH_SIZE = 20
+GRAPH_BATCH_DELAY = 0.01
+# Só os campos que a triagem usa; os metadados dos anexos vêm junto com
+# a mensagem ($expand) e o conteúdo é baixado à parte
+MESSAGE_FIELDS = "id,subject,from,receivedDateTime,hasAttachments"
+ATTACHMENT_FIELDS = "id,name,size,contentType"
+# Anexos maiores que isso vêm crus por /$value, em streaming; os menores
+# continuam no $batch (JSON com base64)
+GRAPH_STREAM_MIN_BYTES = 1024 * 1024
+
+
+class GraphError(Exception):
+    """Resposta de erro do Graph para uma sub-requisição do ``$batch``."""
+
+    def __init__(self, status: int, url: str, body=None):
+        super().__init__(f"Graph retornou {status} para {url}: {body}")
+        self.status = status
+        self.url = url
+        self.body = body
+
+
+class AsyncGraphClient:
+    """Cliente assíncrono (httpx) do Graph para varrer as caixas do domínio.
+
+    Caixas, listas de anexos e conteúdos são buscados em paralelo, com no
+    máximo ``max_concurrency`` requisições em andamento no total e
+    ``GRAPH_MAILBOX_CONCURRENCY`` por caixa. 408/429/5xx e falhas de
+    rede são repetidos até ``max_retries`` vezes, respeitando o
+    ``Retry-After``. ``base_url`` (padrão ``graph_base_url()``) e
+    ``transport`` permitem apontar para um servidor local de teste.
+    ``token`` pode ser um ``TokenProvider``: o token é renovado antes de
+    vencer e uma requisição recusada com 401 é repetida uma vez.
+    ``client`` reaproveita um ``httpx.AsyncClient`` do processo (ver
+    ``http_client()``), que então não é fechado por ``aclose()``.
+
+    Listas de anexos e anexos vão pelo ``/$batch``: as chamadas pendentes
+    de várias mensagens são agrupadas em POSTs de até ``batch_size``
+    sub-requisições, e cada sub-requisição com 429/5xx volta para a fila
+    depois do seu ``Retry-After``. ``batch_size=1`` desliga o agrupamento.
+    Cada POST leva no máximo ``GRAPH_MAILBOX_CONCURRENCY`` sub-requisições
+    da mesma caixa e ocupa as vagas dela no semáforo por caixa enquanto
+    estiver em andamento.
+    """
+
+    def __init__(self, token, base_url: str = None,
+                 max_concurrency: int = None,
+                 timeout: float = GRAPH_READ_TIMEOUT,
+                 max_retries: int = GRAPH_MAX_RETRIES, transport=None,
+                 batch_size: int = GRAPH_BATCH_SIZE, client=None):
+        if httpx is None:
+            raise RuntimeError("AsyncGraphClient precisa do httpx")
+        self.max_concurrency = max_concurrency or default_graph_concurrency()
+        self.max_retries = max_retries
+        self._tokens = token
+        self._own_client = client is None
+        self._client = client or self.http_client(
+            base_url, self.max_concurrency, timeout, transport
+        )
+        self._slots = asyncio.Semaphore(self.max_concurrency)
+        self._mailboxes = {}
+        self.batch_size = min(batch_size, GRAPH_BATCH_SIZE)
+        # Sub-requisições [url, future, tentativa, caixa] à espera do POST
+        self._pending = []
+        self._timer = None
+        self._batches = set()
+        # Um POST reserva as vagas de cada vez: dois lotes segurando parte
+        # das vagas da mesma caixa esperariam um pelo outro para sempre
+        self._reserva = asyncio.Lock()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    async def aclose(self):
+        if self._own_client:
+            await self._client.aclose()
+
+    @staticmethod
+    def http_client(base_url: str = None, max_concurrency: int = None,
+                    timeout: float = GRAPH_READ_TIMEOUT, transport=None):
+        """``httpx.AsyncClient`` configurado para o Graph.
+
+        Pode ser criado uma vez e passado como ``client`` a cada
+        ``AsyncGraphClient``, para as conexões sobreviverem entre as
+        varreduras; quem o cria fecha com ``aclose()``.
+        """
+        if httpx is None:
+            raise RuntimeError("AsyncGraphClient precisa do httpx")
+        max_concurrency = max_concurrency or default_graph_concurrency()
+        return httpx.AsyncClient(
+            base_url=base_url or graph_base_url(),
+            headers={"Accept": "application/json"},
+            timeout=httpx.Timeout(timeout, connect=GRAPH_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=max_concurrency,
+                max_keepalive_connections=max_concurrency
+            ),
+            transport=transport,
+        )
+
+    def _mailbox(self, user):
+        if user is None:
+            return contextlib.nullcontext()
+        if user not in self._mailboxes:
+            self._mailboxes[user] = asyncio.Semaphore(
+                GRAPH_MAILBOX_CONCURRENCY
+            )
+        return self._mailboxes[user]
+
+    async def get(self, url: str, params: dict = None, mailbox: str = None,
+                  batch: bool = False) -> dict:
+        """GET de um recurso JSON dentro dos limites de concorrência.
+
+        Com ``batch`` a chamada espera a vez num ``/$batch``.
+        """
+        if batch and self.batch_size > 1:
+            future = asyncio.get_running_loop().create_future()
+            self._enqueue([self._relative(url, params), future, 0, mailbox])
+            return await future
+        return await self._request("GET", url, params=params,
+                                   mailbox=mailbox)
+
+    async def _bearer(self) -> str:
+        if not isinstance(self._tokens, TokenProvider):
+            return self._tokens
+        # Renovar vai à rede: fora do loop de eventos
+        return (self._tokens.current()
+                or await asyncio.to_thread(self._tokens.token))
+
+    async def _request(self, method: str, url: str, mailbox: str = None,
+                       stream: bool = False, headers: dict = None,
+                       **kwargs):
+        """JSON da resposta ou, com ``stream``, um ``HashingWriter`` com o
+        corpo cru lido em partes."""
+        renovar = isinstance(self._tokens, TokenProvider)
+        attempt = 0
+        while True:
+            bearer = await self._bearer()
+            auth = {**(headers or {}), "Authorization": f"Bearer {bearer}"}
+            try:
+                async with self._mailbox(mailbox), self._slots:
+                    async with self._client.stream(
+                            method, url, headers=auth, **kwargs) as resp:
+                        repetir = (
+                            (resp.status_code == 401 and renovar)
+                            or (resp.status_code in GRAPH_RETRY_STATUS
+                                and attempt < self.max_retries)
+                        )
+                        if not repetir:
+                            resp.raise_for_status()
+                            if not stream:
+                                await resp.aread()
+                                return resp.json()
+                            writer = HashingWriter()
+                            async for chunk in resp.aiter_bytes(STREAM_CHUNK):
+                                writer.write(chunk)
+                            return writer
+            except httpx.TransportError as e:
+                if attempt == self.max_retries:
+                    raise
+                wait_s = min(2 ** attempt, 30)
+                motivo = type(e).__name__
+            else:
+                if resp.status_code == 401:
+                    # Token vencido no meio da varredura: renova uma vez
+                    renovar = False
+                    safe_print("[RETRY] Graph 401: renovando o token")
+                    await asyncio.to_thread(self._tokens.renew, bearer)
+                    continue
+                wait_s = retry_after(resp.headers.get("Retry-After"),
+                                     min(2 ** attempt, 30))
+                motivo = resp.status_code
+            # A espera acontece fora dos semáforos
+            safe_print(f"[RETRY] Graph {motivo}: aguardando {wait_s}s")
+            await asyncio.sleep(wait_s)
+            attempt += 1
+
+    def _relative(self, url: str, params: dict = None) -> str:
+        # Sub-requisições usam caminhos relativos à versão da API
+        base = str(self._client.base_url).rstrip("/")
+        if url.startswith(base):
+            url = url[len(base):]
+        if params:
+            url += "?" + urllib.parse.urlencode(params, safe="$,'()")
+        return url
+
+    def _enqueue(self, item):
+        self._pending.append(item)
+        if len(self._pending) >= self.batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(
+                GRAPH_BATCH_DELAY, self._flush
+            )
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            # O Graph executa as sub-requisições em paralelo: cada caixa
+            # entra com no máximo GRAPH_MAILBOX_CONCURRENCY por POST e o
+            # resto fica para o próximo
+            lote, resto, por_caixa = [], [], {}
+            for item in self._pending:
+                caixa = item[3]
+                if (len(lote) < self.batch_size
+                        and por_caixa.get(caixa, 0)
+                        < GRAPH_MAILBOX_CONCURRENCY):
+                    por_caixa[caixa] = por_caixa.get(caixa, 0) + 1
+                    lote.append(item)
+                else:
+                    resto.append(item)
+            self._pending = resto
+            task = asyncio.ensure_future(self._send_batch(lote, por_caixa))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _send_batch(self, lote, por_caixa):
+        pedidos = [{"id": str(i), "method": "GET", "url": item[0]}
+                   for i, item in enumerate(lote)]
+        # Vagas por caixa, como nas chamadas diretas
+        ocupadas = []
+        try:
+            async with self._reserva:
+                for caixa in por_caixa:
+                    if caixa is None:
+                        continue
+                    semaforo = self._mailbox(caixa)
+                    for _ in range(por_caixa[caixa]):
+                        await semaforo.acquire()
+                        ocupadas.append(semaforo)
+            data = await self._request(
+                "POST", "/$batch", json={"requests": pedidos}
+            )
+        except Exception as e:
+            for item in lote:
+                if not item[1].done():
+                    item[1].set_exception(e)
+            return
+        finally:
+            for semaforo in ocupadas:
+                semaforo.release()
+        loop = asyncio.get_running_loop()
+        respostas = {r.get("id"): r for r in data.get("responses", [])}
+        for i, item in enumerate(lote):
+            url, future, attempt, _ = item
+            resp = respostas.get(str(i), {"status": 500})
+            status = resp.get("status", 500)
+            if future.done():
+                continue
+            if status in GRAPH_RETRY_STATUS and attempt < self.max_retries:
+                headers = {k.lower(): v
+                           for k, v in (resp.get("headers") or {}).items()}
+                wait_s = retry_after(headers.get("retry-after"),
+                                     min(2 ** attempt, 30))
+                safe_print(f"[RETRY] Graph {status} no $batch: "
+                           f"aguardando {wait_s}s")
+                item[2] += 1
+                loop.call_later(wait_s, self._enqueue, item)
+            elif status >= 400:
+                future.set_exception(GraphError(status, url, resp.get("body")))
+            else:
+                future.set_result(resp.get("body") or {})
+
+    async def get_all(self, url: str, params: dict = None,
+                      mailbox: str = None, batch: bool = False) -> list:
+        """Todos os itens de uma coleção, seguindo ``@odata.nextLink``."""
+        items = []
+        while url:
+            data = await self.get(url, params, mailbox, batch)
+            items.extend(data.get("value", []))
+            url, params = data.get("@odata.nextLink"), None
+        return items
+
+    async def domain_users(self, domain: str) -> list:
+        return await self.get_all("/users", {
+            "$filter": f"endswith(userPrincipalName,'{domain}')",
+            "$top": 100,
+            "$select": "userPrincipalName,displayName",
+        })
+
+    async def messages(self, user: str, top: int) -> list:
+        """Primeira página (``$top``) de mensagens da caixa ``user``.
+
+        Cada mensagem traz só ``MESSAGE_FIELDS`` e, em ``attachments``,
+        os metadados (``ATTACHMENT_FIELDS``) dos anexos.
+        """
+        data = await self.get(f"/users/{user}/messages", {
+            "$top": top,
+            "$select": MESSAGE_FIELDS,
+            "$expand": f"attachments($select={ATTACHMENT_FIELDS})",
+        }, mailbox=user)
+        return data.get("value", [])
+
+    async def messages_delta(self, user: str, delta_link: str = None,
+                             folder: str = DELTA_FOLDER):
+        """``(mensagens, novo_delta_link)`` como ``fetch_messages_delta``.
+
+        As mensagens trazem só ``MESSAGE_FIELDS``: o delta não aceita
+        ``$expand``, então os anexos são listados depois.
+        """
+        headers = {"Prefer": f"odata.maxpagesize={DELTA_PAGE_SIZE}"}
+        url, params = delta_link, None
+        if url is None:
+            url = f"/users/{user}/mailFolders/{folder}/messages/delta"
+            params = {"$select": MESSAGE_FIELDS}
+        items = []
+        while True:
+            try:
+                data = await self._request("GET", url, mailbox=user,
+                                           params=params, headers=headers)
+            except httpx.HTTPStatusError as e:
+                if delta_link is None or e.response.status_code != 410:
+                    raise
+                safe_print(f"[WARN] deltaLink de {user} expirou; "
+                           f"sincronizando a pasta inteira")
+                return await self.messages_delta(user, None, folder)
+            items.extend(data.get("value", []))
+            url, params = data.get("@odata.nextLink"), None
+            if not url:
+                return items, data.get("@odata.deltaLink")
+
+    async def message(self, user: str, msg_id: str):
+        """Uma mensagem como ``fetch_message`` (None se não existir), com
+        os metadados dos anexos como em ``messages``."""
+        try:
+            return await self.get(f"/users/{user}/messages/{msg_id}", {
+                "$select": MESSAGE_FIELDS,
+                "$expand": f"attachments($select={ATTACHMENT_FIELDS})",
+            }, mailbox=user)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code != 404:
+                raise
+            return None
+
+    async def list_attachments(self, user: str, msg_id: str) -> list:
+        """Metadados (``ATTACHMENT_FIELDS``) dos anexos, sem o conteúdo,
+        que é baixado à parte."""
+        return await self.get_all(
+            f"/users/{user}/messages/{msg_id}/attachments",
+            {"$select": ATTACHMENT_FIELDS}, mailbox=user, batch=True
+        )
+
+    async def download_attachment(self, user: str, msg_id: str,
+                                  att_id: str):
+        att = await self.get(
+            f"/users/{user}/messages/{msg_id}/attachments/{att_id}",
+            mailbox=user, batch=True
+        )
+        return file_attachment(att, att_id)
+
+    async def stream_attachment(self, user: str, msg_id: str, att: dict):
+        """``(fname, data, ctype, sha256)`` lido cru de ``/$value``."""
+        writer = await self._request(
+            "GET", f"/users/{user}/messages/{msg_id}/attachments/"
+                   f"{att['id']}/$value",
+            mailbox=user, stream=True
+        )
+        return (att.get("name", att["id"]), writer.getvalue(),
+                att.get("contentType", ""), writer.hexdigest())
+
+    async def _small_attachment(self, user: str, msg_id: str, att: dict):
+        fname, data, ctype = await self.download_attachment(
+            user, msg_id, att["id"]
+        )
+        return fname, data, ctype, data and content_hash(data)
+
+    async def file_attachments(self, user: str, msg_id: str,
+                               attachments: list = None) -> list:
+        """``[(fname, data, ctype, sha256)]`` dos anexos de arquivo.
+
+        Os downloads correm em paralelo: os pequenos pelo ``$batch`` e os
+        maiores que ``GRAPH_STREAM_MIN_BYTES`` em streaming. ``attachments``
+        são os metadados já expandidos na mensagem; sem eles a lista de
+        anexos é buscada antes. Nomes em ``UNSUPPORTED_EXT`` nem são
+        baixados.
+        """
+        atts = attachments
+        if atts is None:
+            atts = await self.list_attachments(user, msg_id)
+        baixados = await asyncio.gather(*(
+            self.stream_attachment(user, msg_id, att)
+            if (att.get("size") or 0) > GRAPH_STREAM_MIN_BYTES
+            else self._small_attachment(user, msg_id, att)
+            for att in atts
+            if att.get("@odata.type") == FILE_ATTACHMENT
+            and not unsupported_name(att.get("name"))
+        ))
+        return [b for b in baixados if b[0] and b[1]]
+
+
+_ILLEGAL = r'[\\/:*?"<>|]'
+
+
+def safe_name(name: str, fallback_ext: str = "") -> str:
+    name = (name or "anexo").strip()
+    base, dot, ext = name.rpartition('.')
+    if not dot:
+        base, ext = name, fallback_ext.lstrip('.')
+    base = re.sub(_ILLEGAL, "_", base) or "arquivo"
+    ext = re.sub(_ILLEGAL, "", ext.lower())
+    full = f"{base}.{ext}" if ext else base
+    if len(full) > 120:
+        h = hashlib.sha1(full.encode('utf-8')).hexdigest()[:8]
+        keep = 120 - (len(ext) + (1 if ext else 0) + 9)
+        base = base[:max(10, keep)]
+        full = f"{base}_{h}.{ext}" if ext else f"{base}_{h}"
+    return full
+
+
+def save_bytes(tmp_dir: Path, filename: str, data: bytes,
+               unique: bool = False) -> Path:
+    """Grava ``data`` em ``tmp_dir`` com o nome saneado de ``filename``.
+
+    Com ``unique`` o arquivo vai para um subdiretório próprio: anexos
+    homônimos (dois "curriculo.pdf") em andamento ao mesmo tempo não se
+    sobrescrevem, e o nome do arquivo continua o original.
+    """
+    if unique:
+        tmp_dir = tmp_dir / uuid.uuid4().hex
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    path = tmp_dir / safe_name(filename)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def _ocr_images_pytesseract(images, lang):
+    return [pytesseract.image_to_string(img, lang=lang) for img in images]
+
+
+def _ocr_images_lote(images, lang):
+    """Uma execução do Tesseract para todas as imagens (arquivo-lista).
+
+    A saída de cada página vem separada por form feed.
+    """
+    with tempfile.TemporaryDirectory(prefix="triagem_ocr_") as folder:
+        paths = []
+        for i, img in enumerate(images):
+            if isinstance(img, (str, Path)):
+                paths.append(str(img))
+                continue
+            if img.mode not in ("1", "L", "RGB"):
+                img = img.convert("RGB")
+            path = os.path.join(folder, f"{i}.ppm")
+            img.save(path)
+            paths.append(path)
+        lista = os.path.join(folder, "lista.txt")
+        with open(lista, "w", encoding="utf-8") as f:
+            f.write("\n".join(paths) + "\n")
+        proc = subprocess.run(
+            [pytesseract.pytesseract.tesseract_cmd, lista, "stdout",
+             "-l", lang],
+            capture_output=True, check=True
+        )
+    pages = proc.stdout.decode("utf-8", errors="replace").split("\f")
+    if len(pages) < len(images):
+        raise RuntimeError(
+            f"Tesseract devolveu {len(pages)} de {len(images)} páginas"
+        )
+    return pages[:len(images)]
+
+
+# Uma instância por idioma e por processo; a API não é thread-safe
+_TESSEROCR_APIS = {}
+_TESSEROCR_LOCK = threading.Lock()
+
+
+def _ocr_images_tesserocr(images, lang):
+    with _TESSEROCR_LOCK:
+        api = _TESSEROCR_APIS.get(lang)
+        if api is None:
+            kwargs = {"lang": lang}
+            if os.getenv("TESSDATA_PREFIX"):
+                kwargs["path"] = os.environ["TESSDATA_PREFIX"]
+            api = _TESSEROCR_APIS[lang] = tesserocr.PyTessBaseAPI(**kwargs)
+        texts = []
+        for img in images:
+            if isinstance(img, (str, Path)):
+                api.SetImageFile(str(img))
+            else:
+                api.SetImage(img)
+            texts.append(api.GetUTF8Text())
+    return texts
+
+
+_OCR_BACKENDS = {
+    "pytesseract": _ocr_images_pytesseract,
+    "lote": _ocr_images_lote,
+    "tesserocr": _ocr_images_tesserocr,
+}
+
+
+@lru_cache(maxsize=None)
+def ocr_backend() -> str:
+    """Modo de OCR: ``TRIAGEM_OCR`` ou, em ``auto``, o mais rápido.
+
+    ``tesserocr`` mantém os modelos carregados no processo; ``lote``
+    roda o Tesseract uma vez por grupo de páginas; ``pytesseract``
+    inicia um Tesseract por imagem.
+    """
+    backend = os.getenv("TRIAGEM_OCR", "auto")
+    if backend in _OCR_BACKENDS:
+        return backend
+    if backend != "auto":
+        safe_print(f"[WARN] TRIAGEM_OCR desconhecido: {backend}")
+    if tesserocr is not None:
+        return "tesserocr"
+    if pytesseract is not None and shutil.which(
+            pytesseract.pytesseract.tesseract_cmd):
+        return "lote"
+    return "pytesseract"
+
+
+def _binarize(gray, radius: int = 15, offset: int = 5):
+    """Limiar adaptativo: escuro em relação à média da vizinhança."""
+    mean = gray.filter(ImageFilter.BoxBlur(radius))
+    diff = ImageChops.subtract(mean, gray)
+    return diff.point(lambda v: 0 if v > offset else 255)
+
+
+def _row_profile(binary) -> list:
+    """Tinta (0..255) de cada linha da imagem binária."""
+    rows = binary.resize((1, binary.height), Image.BOX)
+    return [255 - v for v in rows.getdata()]
+
+
+def _skew_angle(binary) -> float:
+    """Ângulo (graus) que deixa as linhas de texto na horizontal.
+
+    Perfil de projeção: o ângulo certo concentra a tinta em poucas
+    linhas, maximizando a variância das somas por linha. A busca é
+    grossa (1 grau) e depois refinada em meio grau.
+    """
+    def score(angle):
+        profile = _row_profile(
+            binary.rotate(angle, expand=True, fillcolor=255)
+        )
+        mean = sum(profile) / len(profile)
+        return sum((v - mean) ** 2 for v in profile)
+
+    limit = int(OCR_MAX_SKEW)
+    best = max(range(-limit, limit + 1), key=score)
+    return max((best - 0.5, best, best + 0.5), key=score)
+
+
+def _line_height(binary):
+    """Altura mediana das linhas de texto, ou ``None`` sem texto."""
+    heights = []
+    run = 0
+    for ink in _row_profile(binary) + [0]:
+        if ink > 2:
+            run += 1
+        elif run:
+            heights.append(run)
+            run = 0
+    heights = sorted(h for h in heights if h > 1)
+    return heights[len(heights) // 2] if heights else None
+
+
+def ocr_preprocess_steps() -> tuple:
+    env = os.getenv("TRIAGEM_OCR_PREPROC")
+    if env is None:
+        return OCR_PREPROCESS_STEPS
+    if env.strip() == "0":
+        return ()
+    return tuple(e.strip() for e in env.split(",") if e.strip())
+
+
+def preprocess_page(img, steps=None, xheight: int = OCR_TARGET_XHEIGHT):
+    """Prepara a imagem para o Tesseract.
+
+    Etapas (``steps``, padrão ``ocr_preprocess_steps()``): ``cinza``,
+    ``binarizar`` (limiar adaptativo), ``endireitar`` (corrige até
+    ``OCR_MAX_SKEW`` graus), ``recortar`` (margens vazias) e ``reduzir``
+    (escala para que a altura-x fique perto de ``xheight`` pixels).
+    Margens, inclinação e altura das linhas são medidas numa cópia
+    pequena; a imagem inteira é cortada e reduzida antes de ser girada.
+    """
+    steps = ocr_preprocess_steps() if steps is None else steps
+    if not steps:
+        return img
+    gray = img.convert("L") if "cinza" in steps else img
+    if gray.mode != "L":
+        return img
+    ratio = min(1.0, 800 / gray.width)
+    small = gray.resize(
+        (max(1, int(gray.width * ratio)), max(1, int(gray.height * ratio))),
+        Image.BOX
+    )
+    probe = _binarize(small, radius=5)
+    if "recortar" in steps:
+        box = ImageOps.invert(probe).getbbox()
+        if box:
+            pad = 3
+            box = (max(box[0] - pad, 0), max(box[1] - pad, 0),
+                   min(box[2] + pad, probe.width),
+                   min(box[3] + pad, probe.height))
+            probe = probe.crop(box)
+            gray = gray.crop(tuple(int(v / ratio) for v in box))
+    angle = _skew_angle(probe) if "endireitar" in steps else 0
+    if "reduzir" in steps:
+        line = _line_height(
+            probe.rotate(angle, expand=True, fillcolor=255)
+            if angle else probe
+        )
+        # Altura da linha (ascendentes a descendentes) ~ 2x a altura-x
+        if line and line / ratio / 2 > xheight * 1.2:
+            scale = xheight * 2 * ratio / line
+            gray = gray.resize(
+                (max(1, int(gray.width * scale)),
+                 max(1, int(gray.height * scale))),
+                Image.LANCZOS
+            )
+    if angle:
+        # Gira por último, já pequena; cantos com a cor do fundo
+        hist = gray.histogram()
+        fundo = hist.index(max(hist))
+        gray = gray.rotate(angle, Image.BICUBIC, expand=True,
+                           fillcolor=fundo)
+    return _binarize(gray) if "binarizar" in steps else gray
+
+
+def _open_image(img):
+    return Image.open(img) if isinstance(img, (str, Path)) else img
+
+
+def ocr_images(images, lang: str = OCR_LANG, backend: str = None,
+               steps=None) -> list:
+    """OCR de imagens PIL ou caminhos de arquivo, um texto por imagem.
+
+    As imagens passam antes por ``preprocess_page(img, steps)``.
+    """
+    if not images:
+        return []
+    steps = ocr_preprocess_steps() if steps is None else steps
+    if steps:
+        images = [preprocess_page(_open_image(i), steps) for i in images]
+    return _OCR_BACKENDS[backend or ocr_backend()](list(images), lang)
+
+
+def detect_ocr_lang(img) -> str:
+    """Idioma do OCR para uma página já pré-processada.
+
+    Lê só o terço de cima (OCR rápido com ``OCR_DETECT_LANG``) e conta
+    as palavras frequentes de cada idioma. Sem um vencedor claro, volta
+    ao modelo combinado ``OCR_LANG``.
+    """
+    strip = img.crop((0, 0, img.width, max(1, img.height // 3)))
+    texto = ocr_images([strip], OCR_DETECT_LANG, steps=())[0]
+    tokens = _TOKEN_RE.findall(normalize_text(texto))
+    votos = sorted(
+        ((sum(1 for t in tokens if t in palavras), lang)
+         for lang, palavras in OCR_LANG_STOPWORDS.items()),
+        reverse=True
+    )
+    (primeiro, lang), (segundo, _) = votos[0], votos[1]
+    if primeiro >= 3 and primeiro >= 2 * segundo:
+        return lang
+    return OCR_LANG
+
+
+class _OCRSession:
+    """OCR de um documento: o idioma é escolhido na primeira página e
+    reaproveitado nas demais."""
+
+    def __init__(self):
+        lang = os.getenv("TRIAGEM_OCR_IDIOMA", "auto")
+        self.lang = None if lang == "auto" else lang
+        # ``ocr_idioma``, ``ocr_idioma_ms`` e ``ocr_falhou``
+        self.detalhes = {}
+
+    def __call__(self, images) -> list:
+        images = [preprocess_page(_open_image(i)) for i in images]
+        if images and self.lang is None:
+            inicio = time.perf_counter()
+            try:
+                self.lang = detect_ocr_lang(images[0])
+            except MemoryError:
+                raise
+            except Exception as e:
+                safe_print(f"[WARN] Detecção de idioma falhou: {e}")
+                self.lang = OCR_LANG
+            self.detalhes["ocr_idioma_ms"] = round(
+                (time.perf_counter() - inicio) * 1000, 1
+            )
+        if images:
+            self.detalhes["ocr_idioma"] = self.lang
+        return ocr_images(images, self.lang, steps=())
+
+
+def _ocr_pdf_range(data: bytes, first: int, last: int, ocr) -> list:
+    """OCR das páginas ``first``..``last`` (1-based) de uma vez.
+
+    As páginas são rasterizadas em arquivos temporários, não na memória,
+    e seguem juntas para ``ocr`` (``_OCRSession``). A lista vem mais
+    curta se o PDF tiver menos páginas, e vazia se a rasterização ou o
+    OCR falharem.
+    """
+    try:
+        with tempfile.TemporaryDirectory(prefix="triagem_pdf_") as folder:
+            paths = convert_from_bytes(
+                data, dpi=300, first_page=first, last_page=last,
+                output_folder=folder, paths_only=True
+            )
+            return ocr(paths)
+    except MemoryError:
+        # Estouro do orçamento de memória: quem decide é o pool
+        raise
+    except Exception as e:
+        safe_print(f"[WARN] OCR das páginas {first}-{last} falhou: {e}")
+        # Texto incompleto: o resultado não entra no cache
+        ocr.detalhes["ocr_falhou"] = True
+        return []
+
+
+def _ocr_batch_size() -> int:
+    return OCR_BATCH_PAGES if ocr_backend() == "lote" else 1
+
+
+def _ocr_pdf_pages(data: bytes, numbers, ocr) -> dict:
+    """OCR das páginas ``numbers``, agrupando as consecutivas em lotes."""
+    batch = _ocr_batch_size()
+    texts = {}
+    run = []
+    for number in list(numbers) + [None]:
+        if run and (number != run[-1] + 1 or len(run) == batch):
+            texts.update(
+                zip(run, _ocr_pdf_range(data, run[0], run[-1], ocr))
+            )
+            run = []
+        if number is not None:
+            run.append(number)
+    return texts
+
+
+def _ocr_all_pdf_pages(data: bytes, max_pages: int, ocr):
+    batch = _ocr_batch_size()
+    first = 1
+    while not max_pages or first <= max_pages:
+        last = first + batch - 1
+        if max_pages:
+            last = min(last, max_pages)
+        texts = _ocr_pdf_range(data, first, last, ocr)
+        yield from texts
+        if len(texts) < last - first + 1:
+            return
+        first = last + 1
+
+
+def _resolve_ocr(data: bytes, entries, ocr):
+    """``(número, texto, precisa_ocr)`` -> ``(número, texto, ocr_usado)``.
+
+    Onde o OCR falhar fica o texto da camada de texto.
+    """
+    texts = _ocr_pdf_pages(
+        data, [n for n, _, needs in entries if needs], ocr
+    )
+    for number, text, _ in entries:
+        if texts.get(number) is not None:
+            yield number, texts[number], True
+        else:
+            yield number, text, False
+
+
+def _garbage_ratio(text: str) -> float:
+    """Fração de caracteres sem sentido (controle, privados, U+FFFD)."""
+    chars = [c for c in text if not c.isspace()]
+    if not chars:
+        return 0.0
+    garbage = sum(
+        1 for c in chars
+        if c == "\ufffd"
+        or unicodedata.category(c) in ("Cc", "Co", "Cn", "Cs")
+    )
+    return garbage / len(chars)
+
+
+def _matrix_area(ctm) -> float:
+    a, b, c, d = ctm
+    return abs(a * d - b * c)
+
+
+def _image_coverage(page) -> float:
+    """Fração da página coberta por imagens.
+
+    Segue os operadores ``q``/``Q``/``cm`` do content stream para saber
+    a escala com que cada imagem (``Do`` ou inline) é desenhada.
+    """
+    from PyPDF2.generic import ContentStream
+    box = page.mediabox
+    page_area = float(box.width) * float(box.height)
+    contents = page.get_contents()
+    if contents is None or not page_area:
+        return 0.0
+    if not isinstance(contents, ContentStream):
+        contents = ContentStream(contents, page.pdf)
+    resources = page.get("/Resources")
+    resources = resources.get_object() if resources is not None else {}
+    xobjects = resources.get("/XObject")
+    xobjects = xobjects.get_object() if xobjects is not None else {}
+    ctm = (1.0, 0.0, 0.0, 1.0)
+    stack = []
+    area = 0.0
+    for operands, operator in contents.operations:
+        if operator == b"q":
+            stack.append(ctm)
+        elif operator == b"Q":
+            ctm = stack.pop() if stack else ctm
+        elif operator == b"cm":
+            a, b, c, d = (float(x) for x in operands[:4])
+            ta, tb, tc, td = ctm
+            ctm = (a * ta + b * tc, a * tb + b * td,
+                   c * ta + d * tc, c * tb + d * td)
+        elif operator == b"INLINE IMAGE":
+            area += _matrix_area(ctm)
+        elif operator == b"Do" and operands[0] in xobjects:
+            xobject = xobjects[operands[0]].get_object()
+            subtype = xobject.get("/Subtype")
+            if subtype == "/Image":
+                area += _matrix_area(ctm)
+            elif subtype == "/Form" and "/XObject" in (
+                    xobject.get("/Resources") or {}):
+                # Formulário com imagens dentro (comum em scanners)
+                x0, y0, x1, y1 = (float(v) for v in xobject["/BBox"])
+                area += _matrix_area(ctm) * abs((x1 - x0) * (y1 - y0))
+    return min(area / page_area, 1.0)
+
+
+def _page_needs_ocr(page, text: str) -> bool:
+    """Decide se a página vai para o OCR.
+
+    Sim quando a camada de texto é lixo, quando está praticamente vazia
+    numa página com imagem, ou quando é curta e imagens cobrem boa parte
+    da página (digitalização com carimbo/cabeçalho em texto).
+    """
+    chars = len(text.strip())
+    if chars and _garbage_ratio(text) > OCR_PAGE_GARBAGE_RATIO:
+        return True
+    if chars >= OCR_PAGE_MAX_CHARS:
+        return False
+    try:
+        coverage = _image_coverage(page)
+    except MemoryError:
+        raise
+    except Exception:
+        return chars < OCR_PAGE_MIN_CHARS
+    if chars < OCR_PAGE_MIN_CHARS:
+        return coverage > 0
+    return coverage >= OCR_PAGE_IMAGE_COVERAGE
+
+
+def iter_pdf_pages(data: bytes, max_pages: int = None, ocr=None):
+    """Gera ``(texto, ocr_usado)`` de cada página do PDF, sob demanda.
+
+    A decisão de OCR é por página (``_page_needs_ocr``): só páginas
+    digitalizadas são rasterizadas e o resultado sai na ordem das
+    páginas. No modo ``lote`` até ``OCR_BATCH_PAGES`` páginas seguidas
+    vão juntas para o Tesseract. Se o documento inteiro tiver menos de
+    ``MIN_TEXT_CHARS``, as páginas que restaram também passam pelo OCR.
+    ``max_pages`` limita quantas páginas são lidas; ``ocr`` é a
+    ``_OCRSession`` do documento.
+    """
+    can_ocr = HAVE_OCR and convert_from_bytes is not None
+    if ocr is None:
+        ocr = _OCRSession()
+    try:
+        from PyPDF2 import PdfReader
+        pages = PdfReader(io.BytesIO(data)).pages
+        if max_pages:
+            pages = pages[:max_pages]
+    except MemoryError:
+        raise
+    except Exception:
+        # PDF ilegível para o PyPDF2: resta o OCR de todas as páginas
+        if can_ocr:
+            for text in _ocr_all_pdf_pages(data, max_pages, ocr):
+                yield text, True
+        return
+    batch = _ocr_batch_size()
+    # Páginas retidas até o documento somar MIN_TEXT_CHARS
+    buffered = []
+    total = 0
+
+    def emit(entries):
+        nonlocal buffered, total
+        for number, text, used in _resolve_ocr(data, entries, ocr):
+            if buffered is None:
+                yield text, used
+                continue
+            buffered.append((number, text, used))
+            total += len(text.strip())
+            if total >= MIN_TEXT_CHARS:
+                for _, text, used in buffered:
+                    yield text, used
+                buffered = None
+
+    # Trecho de páginas seguidas à espera do OCR
+    pending = []
+    for number, page in enumerate(pages, 1):
+        try:
+            text = page.extract_text() or ""
+        except MemoryError:
+            raise
+        except Exception:
+            text = ""
+        needs = can_ocr and _page_needs_ocr(page, text)
+        pending.append((number, text, needs))
+        if needs and len(pending) < batch:
+            continue
+        yield from emit(pending)
+        pending = []
+    yield from emit(pending)
+    if buffered is None:
+        return
+    numbers = [n for n, _, used in buffered if not used] if can_ocr else []
+    texts = _ocr_pdf_pages(data, numbers, ocr)
+    for number, text, used in buffered:
+        if texts.get(number) is not None:
+            yield texts[number], True
+        else:
+            yield text, used
+
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_MC_FALLBACK = (
+    "{http://schemas.openxmlformats.org/markup-compatibility/2006}Fallback"
+)
+_DOCX_RUN_TEXT = {_W + "tab": "\t", _W + "br": "\n", _W + "cr": "\n",
+                  _W + "noBreakHyphen": "-"}
+_DOCX_PART_RE = re.compile(r"word/(document|header|footer)\d*\.xml")
+
+
+def _docx_part_paragraphs(stream) -> list:
+    """Parágrafos de uma parte do DOCX, lidos em streaming (iterparse).
+
+    Tabelas e caixas de texto aparecem como parágrafos comuns; caixas de
+    texto aninhadas num parágrafo viram parágrafos próprios, e a cópia
+    de compatibilidade (``mc:Fallback``) é ignorada para não duplicar.
+    """
+    paragraphs = []
+    stack = []
+    fallback = 0
+    for event, elem in ElementTree.iterparse(stream, ("start", "end")):
+        tag = elem.tag
+        if tag == _MC_FALLBACK:
+            fallback += 1 if event == "start" else -1
+            continue
+        if fallback:
+            continue
+        if tag == _W + "p":
+            if event == "start":
+                stack.append([])
+            else:
+                paragraphs.append("".join(stack.pop()))
+                elem.clear()
+        elif event == "end" and stack:
+            if tag == _W + "t":
+                stack[-1].append(elem.text or "")
+            elif tag in _DOCX_RUN_TEXT:
+                stack[-1].append(_DOCX_RUN_TEXT[tag])
+    return paragraphs
+
+
+def docx_text(data: bytes) -> str:
+    """Texto de um DOCX direto da memória, sem arquivo temporário.
+
+    Lê o corpo (``word/document.xml``, com tabelas e caixas de texto) e
+    depois cabeçalhos e rodapés, onde muitos CVs guardam a formação.
+    """
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        # Corpo primeiro, depois cabeçalhos e rodapés
+        ordem = {"document": 0, "header": 1, "footer": 2}
+        names = []
+        for name in z.namelist():
+            match = _DOCX_PART_RE.fullmatch(name)
+            if match:
+                names.append((ordem[match.group(1)], name))
+        names.sort()
+        paragraphs = []
+        for _, name in names:
+            with _CappedReader(z, name) as stream:
+                paragraphs.extend(_docx_part_paragraphs(stream))
+    return "\n".join(paragraphs)
+
+
+class ExtractionResult(tuple):
+    """``(texto, ocr_usado)`` devolvido por ``extract_text_any``.
+
+    Desempacota como a tupla de sempre; ``detalhes`` guarda o que mais
+    se souber da extração (``ocr_idioma``, ``ocr_idioma_ms``). ``erro``,
+    ``ocr_falhou`` e ``status`` marcam textos vazios ou incompletos,
+    que não vão para o ``ExtractionCache`` (``complete`` falso).
+    """
+
+    def __new__(cls, texto: str = "", ocr_usado: bool = False, **detalhes):
+        self = super().__new__(cls, (texto, ocr_usado))
+        self.detalhes = detalhes
+        return self
+
+    def __getnewargs_ex__(self):
+        return (self[0], self[1]), self.detalhes
+
+    @property
+    def texto(self) -> str:
+        return self[0]
+
+    @property
+    def ocr_usado(self) -> bool:
+        return self[1]
+
+    @property
+    def complete(self) -> bool:
+        return not {"erro", "ocr_falhou", "status"} & self.detalhes.keys()
+
+    @property
+    def cacheable(self) -> bool:
+        return self.complete
+
+
+# Classes de custo dos extratores (todos passam pelo pool do
+# ExtractionEngine, com o mesmo orçamento por documento)
+COST_CHEAP = 0
+COST_MEDIUM = 1
+COST_EXPENSIVE = 2
+
+
+class Extractor:
+    """Extrator registrado para um formato (ver ``register_extractor``)."""
+
+    __slots__ = ("kind", "func", "cost", "magic", "sniff", "extensions",
+                 "mime", "fallback", "members")
+
+    def __init__(self, kind, func, cost, magic, sniff, extensions, mime,
+                 fallback=None, members=None):
+        self.kind = kind
+        self.func = func
+        self.cost = cost
+        self.magic = tuple(magic)
+        self.sniff = sniff
+        self.extensions = tuple(extensions)
+        self.mime = tuple(mime)
+        self.fallback = fallback
+        # Só contêineres (ver ``register_container``)
+        self.members = members
+
+    def matches(self, data: bytes) -> bool:
+        """Reconhece o formato pelo conteúdo (assinatura ou ``sniff``)."""
+        if any(data.startswith(m) for m in self.magic):
+            return True
+        return self.sniff is not None and self.sniff(data)
+
+
+# Ordem de registro = ordem de teste das assinaturas
+_EXTRACTORS = {}
+
+
+def register_extractor(kind: str, cost: int = COST_CHEAP, magic=(),
+                       sniff=None, extensions=(), mime=(), fallback=None):
+    """Registra ``func(data, **opcoes) -> (texto, ocr_usado)``.
+
+    O formato é reconhecido pelos bytes iniciais (``magic``) ou por
+    ``sniff(data)``; ``extensions`` e trechos do contentType (``mime``)
+    só valem quando nenhum conteúdo é reconhecido. ``fallback(data)`` é
+    um teste fraco de conteúdo, usado por último e só se o nome não tiver
+    extensão e o contentType for genérico. As opções passadas são
+    ``fname`` (nome do anexo), ``max_pages``, ``criterios`` e ``ocr``
+    (``_OCRSession``).
+    """
+    def decorator(func):
+        _EXTRACTORS[kind] = Extractor(
+            kind, func, cost, magic, sniff, extensions, mime, fallback
+        )
+        return func
+    return decorator
+
+
+# contentTypes que não dizem nada sobre o formato
+GENERIC_MIME = ("", "application/octet-stream")
+
+
+def sniff_format(data: bytes, fname: str = "", ctype: str = ""):
+    """Formato registrado de ``data`` ou ``None`` se nenhum servir."""
+    for extractor in _EXTRACTORS.values():
+        if extractor.matches(data):
+            return extractor.kind
+    # Sem assinatura conhecida: nome do arquivo e contentType do Graph
+    name = (fname or "").lower()
+    ctype = (ctype or "").lower()
+    for extractor in _EXTRACTORS.values():
+        if (any(name.endswith(e) for e in extractor.extensions)
+                or any(m in ctype for m in extractor.mime)):
+            return extractor.kind
+    # Nome e contentType sem formato: resta o teste fraco (texto puro).
+    # Um .vcf, .ics ou .csv tem extensão e não chega aqui
+    if not os.path.splitext(name)[1] and ctype in GENERIC_MIME:
+        for extractor in _EXTRACTORS.values():
+            if extractor.fallback is not None and extractor.fallback(data):
+                return extractor.kind
+    return None
+
+
+def extractor_for(data: bytes, fname: str = "", ctype: str = ""):
+    """``Extractor`` do anexo, ou ``None`` se o formato não é suportado."""
+    return _EXTRACTORS.get(sniff_format(data, fname, ctype))
+
+
+# Formatos sem extrator, descartados pelo nome antes do download
+UNSUPPORTED_EXT = (
+    ".rar", ".7z", ".xls", ".xlsx", ".ppt", ".pptx", ".vcf", ".ics", ".csv"
+)
+
+
+def unsupported_name(fname: str) -> bool:
+    """Anexo que nem vale baixar: extensão em ``UNSUPPORTED_EXT``."""
+    return (fname or "").lower().endswith(UNSUPPORTED_EXT)
+
+
+def _zip_member(data: bytes, member: str, content: bytes = None) -> bool:
+    if not data.startswith(b"PK\x03\x04"):
+        return False
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            if content is None:
+                z.getinfo(member)
+                return True
+            # Só o começo: o membro pode ser uma zip-bomb
+            with z.open(member) as f:
+                return f.read(len(content) + 64).strip() == content
+    except (KeyError, zipfile.BadZipFile):
+        return False
+
+
+_OLE_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+
+
+def _is_word97(data: bytes) -> bool:
+    # Documento OLE com o stream "WordDocument" (nome em UTF-16LE)
+    return (data.startswith(_OLE_MAGIC)
+            and "WordDocument".encode("utf-16-le") in data)
+
+
+def _looks_like_html(data: bytes) -> bool:
+    head = data[:1024].lstrip(b"\xef\xbb\xbf \t\r\n").lower()
+    return head.startswith((b"<!doctype html", b"<html")) or (
+        head.startswith(b"<") and b"<html" in head
+    )
+
+
+# Tamanhos do cabeçalho DIB (BITMAPCOREHEADER, BITMAPINFOHEADER e
+# sucessores)
+_BMP_DIB_SIZES = (12, 40, 52, 56, 64, 108, 124)
+
+
+def _looks_like_bmp(data: bytes) -> bool:
+    # "BM" sozinho aparece em texto ("BMW..."): confere também os campos
+    # reservados e o tamanho do cabeçalho DIB
+    return (len(data) >= 26 and data.startswith(b"BM")
+            and data[6:10] == b"\0\0\0\0"
+            and int.from_bytes(data[14:18], "little") in _BMP_DIB_SIZES)
+
+
+def _looks_like_text(data: bytes) -> bool:
+    head = data[:4096]
+    if b"\x00" in head:
+        return False
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as e:
+        # Um caractere multibyte cortado no fim do trecho não conta
+        return e.start >= len(head) - 3 and len(data) > len(head)
+    return True
+
+
+@register_extractor("pdf", COST_MEDIUM, magic=(b"%PDF",),
+                    sniff=lambda data: b"%PDF-" in data[:1024],
+                    extensions=(".pdf",), mime=("pdf",))
+def _extract_pdf(data: bytes, max_pages: int = None, criterios=None,
+                 ocr=None, **_) -> tuple[str, bool]:
+    textos = []
+    ocr_usado = False
+    vistos = {}
+    for page_text, used in iter_pdf_pages(data, max_pages, ocr):
+        textos.append(page_text)
+        ocr_usado = ocr_usado or used
+        # Para de ler páginas quando o resto não muda mais a decisão; só a
+        # página nova (com a anterior, por frases que cruzam a quebra) é
+        # avaliada, para o custo não crescer com o quadrado das páginas
+        if criterios is not None and criterios.decided(
+                "\n".join(textos[-2:]), vistos):
+            break
+    return "\n".join(textos), ocr_usado
+
+
+@register_extractor(
+    "docx", sniff=lambda data: _zip_member(data, "word/document.xml"),
+    extensions=(".docx",),
+    mime=("officedocument.wordprocessingml.document",)
+)
+def _extract_docx(data: bytes, **_):
+    return docx_text(data), False
+
+
+_ODT_NS = "urn:oasis:names:tc:opendocument:xmlns:text:1.0"
+_ODT_P = ("{%s}p" % _ODT_NS, "{%s}h" % _ODT_NS)
+_ODT_SPACE = "{%s}s" % _ODT_NS
+_ODT_INLINE = {"{%s}tab" % _ODT_NS: "\t",
+               "{%s}line-break" % _ODT_NS: "\n"}
+
+
+def _odt_inline_text(elem) -> str:
+    parts = [elem.text or ""]
+    for child in elem:
+        if child.tag == _ODT_SPACE:
+            parts.append(" " * int(child.get("{%s}c" % _ODT_NS, "1")))
+        elif child.tag in _ODT_INLINE:
+            parts.append(_ODT_INLINE[child.tag])
+        elif child.tag not in _ODT_P:
+            # Parágrafos aninhados (quadros) já saíram por conta própria
+            parts.append(_odt_inline_text(child))
+        parts.append(child.tail or "")
+    return "".join(parts)
+
+
+def odt_text(data: bytes) -> str:
+    """Texto de um ODT (corpo e, em ``styles.xml``, cabeçalho/rodapé)."""
+    paragraphs = []
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        for name in ("content.xml", "styles.xml"):
+            if name not in z.namelist():
+                continue
+            with _CappedReader(z, name) as stream:
+                for _, elem in ElementTree.iterparse(stream):
+                    if elem.tag in _ODT_P:
+                        paragraphs.append(_odt_inline_text(elem))
+                        tail = elem.tail
+                        elem.clear()
+                        elem.tail = tail
+    return "\n".join(paragraphs)
+
+
+@register_extractor(
+    "odt",
+    sniff=lambda data: _zip_member(
+        data, "mimetype", b"application/vnd.oasis.opendocument.text"
+    ),
+    extensions=(".odt",), mime=("opendocument.text",)
+)
+def _extract_odt(data: bytes, **_):
+    return odt_text(data), False
+
+
+_RTF_TOKEN = re.compile(
+    rb"\\([a-z]{1,32})(-?\d{1,10})? ?|\\'([0-9a-f]{2})|\\([^a-z])"
+    rb"|([{}])|[\r\n]+|([^\\{}\r\n]+)",
+    re.IGNORECASE
+)
+# Destinos cujo conteúdo não é texto do documento
+_RTF_SKIP = frozenset((
+    b"fonttbl", b"colortbl", b"stylesheet", b"info", b"pict", b"object",
+    b"themedata", b"colorschememapping", b"latentstyles", b"datastore",
+    b"listtable", b"listoverridetable", b"rsidtbl", b"generator",
+    b"xmlnstbl", b"fldinst", b"mmathPr",
+))
+_RTF_CHARS = {b"par": "\n", b"line": "\n", b"row": "\n", b"cell": "\t",
+              b"tab": "\t", b"emdash": "\u2014", b"endash": "\u2013",
+              b"bullet": "\u2022", b"lquote": "\u2018",
+              b"rquote": "\u2019", b"ldblquote": "\u201c",
+              b"rdblquote": "\u201d"}
+
+
+def rtf_text(data: bytes) -> str:
+    """Texto de um RTF: ignora tabelas de fonte/cor, imagens e campos."""
+    encoding = "cp1252"
+    out = []
+    stack = []
+    skip = False
+    uc = 1
+    pending_skip = 0
+    for m in _RTF_TOKEN.finditer(data):
+        word, arg, hexcode, symbol, brace, plain = m.groups()
+        if pending_skip and (hexcode or plain):
+            # Caracteres de substituição depois de um \uN
+            if plain:
+                plain = plain[pending_skip:]
+                pending_skip = 0
+                if not plain:
+                    continue
+            else:
+                pending_skip -= 1
+                continue
+        if brace == b"{":
+            stack.append((skip, uc))
+        elif brace == b"}":
+            skip, uc = stack.pop() if stack else (False, 1)
+        elif symbol is not None:
+            if symbol == b"*":
+                skip = True
+            elif not skip and symbol in (b"\\", b"{", b"}"):
+                out.append(symbol.decode())
+            elif not skip and symbol == b"~":
+                out.append("\u00a0")
+        elif word is not None:
+            if word in _RTF_SKIP:
+                skip = True
+            elif word == b"ansicpg" and arg:
+                encoding = f"cp{int(arg)}"
+            elif word == b"uc" and arg:
+                uc = int(arg)
+            elif skip:
+                continue
+            elif word == b"u" and arg:
+                out.append(chr(int(arg) % 65536))
+                pending_skip = uc
+            elif word in _RTF_CHARS:
+                out.append(_RTF_CHARS[word])
+        elif skip:
+            continue
+        elif hexcode is not None:
+            out.append(bytes([int(hexcode, 16)]).decode(encoding, "replace"))
+        elif plain is not None:
+            out.append(plain.decode(encoding, "replace"))
+    return "".join(out)
+
+
+@register_extractor("rtf", magic=(b"{\\rtf",), extensions=(".rtf",),
+                    mime=("rtf",))
+def _extract_rtf(data: bytes, **_):
+    return rtf_text(data), False
+
+
+class _HTMLText(HTMLParser):
+    _BLOCK = frozenset((
+        "p", "div", "br", "li", "tr", "td", "th", "h1", "h2", "h3", "h4",
+        "h5", "h6", "section", "article", "header", "footer", "table",
+        "ul", "ol",
+    ))
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self._skip += 1
+        elif tag in self._BLOCK:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head"):
+            self._skip = max(self._skip - 1, 0)
+        elif tag in self._BLOCK:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+
+def html_text(data: bytes) -> str:
+    """Texto visível de um HTML (sem scripts, estilos e ``<head>``)."""
+    try:
+        html = data.decode("utf-8-sig")
+    except UnicodeDecodeError:
+        m = re.search(rb'charset=["\']?([\w-]+)', data[:2048], re.I)
+        try:
+            html = data.decode(m.group(1).decode() if m else "cp1252",
+                               "replace")
+        except LookupError:
+            html = data.decode("cp1252", "replace")
+    parser = _HTMLText()
+    parser.feed(html)
+    parser.close()
+    return "".join(parser.parts)
+
+
+@register_extractor("html", sniff=_looks_like_html,
+                    extensions=(".html", ".htm"), mime=("text/html",))
+def _extract_html(data: bytes, **_):
+    return html_text(data), False
+
+
+# Contêineres (ZIP, EML, MSG) são abertos em memória e cada documento de
+# dentro vira um anexo próprio. Os limites valem para o anexo inteiro,
+# somando todos os níveis; a taxa de compressão barra zip-bombs
+CONTAINER_MAX_DEPTH = 3
+CONTAINER_MAX_DOCS = 100
+CONTAINER_MAX_BYTES = 200 * 1024 * 1024
+CONTAINER_MAX_RATIO = 100
+# Abaixo disso a taxa de compressão não importa
+CONTAINER_RATIO_MIN_BYTES = 1024 * 1024
+
+
+class ContainerLimitError(Exception):
+    """Anexo contêiner passou de ``CONTAINER_MAX_DOCS``/``_BYTES`` ou da
+    taxa de compressão."""
+
+
+def _member_limit(info: zipfile.ZipInfo,
+                  max_bytes: int = CONTAINER_MAX_BYTES) -> int:
+    """Bytes descompactados aceitos de um membro de ZIP: no máximo
+    ``CONTAINER_MAX_RATIO`` vezes o tamanho compactado (acima de
+    ``CONTAINER_RATIO_MIN_BYTES``) e nunca mais que ``max_bytes``."""
+    return min(max_bytes, max(CONTAINER_RATIO_MIN_BYTES,
+                              info.compress_size * CONTAINER_MAX_RATIO))
+
+
+class _CappedReader:
+    """Membro de ZIP lido em partes que para com ``ContainerLimitError``
+    ao passar de ``_member_limit`` (zip-bomb dentro de DOCX/ODT)."""
+
+    def __init__(self, z: zipfile.ZipFile, name: str):
+        info = z.getinfo(name)
+        self._stream = z.open(info)
+        self._name = name
+        self._left = _member_limit(info)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0 or size > self._left:
+            size = self._left + 1
+        data = self._stream.read(size)
+        self._left -= len(data)
+        if self._left < 0:
+            raise ContainerLimitError(
+                f"taxa de compressão suspeita (zip-bomb?) em {self._name}"
+            )
+        return data
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self._stream.close()
+
+
+class _ContainerBudget:
+    """O que ainda cabe na expansão de um anexo contêiner.
+
+    ``nivel`` é a profundidade de quem está entregando documentos agora,
+    compartilhada entre ``expand_attachment`` e os contêineres que se
+    aninham por dentro (mensagem anexada a um MSG).
+    """
+
+    __slots__ = ("documentos", "bytes", "nivel")
+
+    def __init__(self):
+        self.documentos = CONTAINER_MAX_DOCS
+        self.bytes = CONTAINER_MAX_BYTES
+        self.nivel = 0
+
+    def take(self, size: int):
+        if size > self.bytes:
+            raise ContainerLimitError(
+                f"mais de {CONTAINER_MAX_BYTES // 2 ** 20} MB descompactados"
+            )
+        self.bytes -= size
+
+    def documento(self):
+        if not self.documentos:
+            raise ContainerLimitError(
+                f"mais de {CONTAINER_MAX_DOCS} documentos"
+            )
+        self.documentos -= 1
+
+
+def register_container(kind: str, magic=(), sniff=None, extensions=(),
+                       mime=()):
+    """Registra ``func(data, budget)``, que gera ``(nome, bytes)``.
+
+    ``expand_attachment`` troca o contêiner pelos documentos de dentro;
+    ``extract_text_any`` chamado direto sobre ele junta o texto desses
+    documentos. ``budget.take(n)`` deve ser chamado antes de entregar
+    ``n`` bytes descompactados; um contêiner que desça níveis por conta
+    própria soma ``budget.nivel`` enquanto estiver lá dentro.
+    """
+    def decorator(func):
+        def extract(data, fname=None, max_pages=None, **_):
+            textos, ocr_usado = [], False
+            for caminho, ctype, conteudo, formato in expand_attachment(
+                    fname or kind, "", data, kind):
+                texto, ocr = extract_text_any(
+                    caminho, ctype, conteudo, max_pages, kind=formato
+                )
+                textos.append(texto)
+                ocr_usado = ocr_usado or ocr
+            return "\n".join(t for t in textos if t), ocr_usado
+
+        _EXTRACTORS[kind] = Extractor(
+            kind, extract, COST_EXPENSIVE, magic, sniff, extensions, mime,
+            members=func
+        )
+        return func
+    return decorator
+
+
+def expand_attachment(fname: str, ctype: str, data: bytes,
+                      kind: str = None, _depth: int = 0, _budget=None):
+    """Gera ``(caminho, ctype, data, formato)`` para cada documento do
+    anexo.
+
+    Um anexo comum sai como está. ZIP, EML e MSG são abertos em memória,
+    recursivamente até ``CONTAINER_MAX_DEPTH`` níveis, e cada documento
+    sai com o caminho dentro do contêiner (``portfolio.zip/cv.pdf``).
+    Documentos internos de formato não suportado são pulados; passar dos
+    limites interrompe o resto do contêiner. ``kind`` é o formato já
+    reconhecido por ``sniff_format`` (sem ele o anexo é farejado aqui);
+    ``formato`` vai junto com cada documento para ``extract_text_any``
+    não farejar de novo.
+    """
+    if kind is None:
+        kind = sniff_format(data, fname, ctype)
+    extractor = _EXTRACTORS.get(kind)
+    if extractor is None or extractor.members is None:
+        if _depth:
+            if extractor is None:
+                safe_print(f"[SKIP] Formato não suportado: {fname}")
+                return
+            _budget.documento()
+        yield fname, ctype, data, kind
+        return
+    if _depth >= CONTAINER_MAX_DEPTH:
+        safe_print(f"[SKIP] Contêiner aninhado demais: {fname}")
+        return
+    budget = _budget or _ContainerBudget()
+    budget.nivel = _depth
+    try:
+        for nome, conteudo in extractor.members(data, budget):
+            # Um MSG entrega também os anexos das mensagens embutidas,
+            # já alguns níveis abaixo: vale o nível de quem entregou
+            nivel = budget.nivel
+            yield from expand_attachment(
+                f"{fname}/{nome}", "", conteudo, None, nivel + 1, budget
+            )
+            budget.nivel = nivel
+    except ContainerLimitError as e:
+        if _budget is not None:
+            raise
+        safe_print(f"[WARN] {fname}: {e}; o restante foi ignorado")
+    except MemoryError:
+        raise
+    except Exception as e:
+        safe_print(f"[WARN] Contêiner ilegível {fname}: {e}")
+
+
+def _is_archive(data: bytes) -> bool:
+    # ZIP "puro": pacotes OOXML/ODF não formatados como DOCX/ODT (xlsx,
+    # pptx, ods...) continuam sem suporte
+    if not data.startswith(b"PK\x03\x04"):
+        return False
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as z:
+            nomes = set(z.namelist())
+    except zipfile.BadZipFile:
+        return False
+    return not nomes & {"[Content_Types].xml", "mimetype",
+                        "META-INF/manifest.xml"}
+
+
+@register_container("zip", sniff=_is_archive, extensions=(".zip",),
+                    mime=("/zip", "x-zip"))
+def _zip_members(data: bytes, budget):
+    with zipfile.ZipFile(io.BytesIO(data)) as z:
+        for info in z.infolist():
+            nome = info.filename
+            if info.is_dir() or nome.startswith("__MACOSX/"):
+                continue
+            if info.flag_bits & 0x1:
+                safe_print(f"[SKIP] Protegido por senha: {nome}")
+                continue
+            # Lê no máximo o limite (+1 para detectar o excesso), sem
+            # confiar no tamanho declarado no cabeçalho
+            limite = _member_limit(info, budget.bytes)
+            with z.open(info) as f:
+                conteudo = f.read(limite + 1)
+            if len(conteudo) > limite:
+                if limite == budget.bytes:
+                    budget.take(len(conteudo))  # ContainerLimitError
+                safe_print(f"[SKIP] Taxa de compressão suspeita "
+                           f"(zip-bomb?): {nome}")
+                continue
+            budget.take(len(conteudo))
+            yield nome, conteudo
+
+
+_EML_HEADER = re.compile(rb"[!-9;-~]+:")
+_EML_KNOWN = (b"from:", b"to:", b"subject:", b"date:", b"message-id:",
+              b"mime-version:", b"received:", b"return-path:",
+              b"content-type:")
+
+
+def _looks_like_eml(data: bytes) -> bool:
+    head = data[:4096]
+    if b"\x00" in head:
+        return False
+    bloco = head.replace(b"\r\n", b"\n").split(b"\n\n", 1)[0].lower()
+    linhas = [linha for linha in bloco.split(b"\n")
+              if linha and not linha[:1].isspace()]
+    return (bool(linhas) and all(_EML_HEADER.match(x) for x in linhas)
+            and sum(x.startswith(_EML_KNOWN) for x in linhas) >= 3)
+
+
+def _email_parts(part):
+    if part.get_content_maintype() == "multipart":
+        for sub in part.iter_parts():
+            yield from _email_parts(sub)
+    elif part.get_content_type() == "message/rfc822":
+        # Mensagem encaminhada como anexo: mais um nível de contêiner
+        interna = part.get_payload(0)
+        nome = part.get_filename() or (
+            f"{interna.get('subject') or 'mensagem'}.eml"
+        )
+        yield nome.replace("/", "_"), interna.as_bytes()
+    elif part.get_filename():
+        yield part.get_filename(), part.get_payload(decode=True) or b""
+
+
+@register_container("eml", sniff=_looks_like_eml, extensions=(".eml",),
+                    mime=("message/rfc822",))
+def _eml_members(data: bytes, budget):
+    msg = email.message_from_bytes(data, policy=email_policy.default)
+    for nome, conteudo in _email_parts(msg):
+        budget.take(len(conteudo))
+        yield nome, conteudo
+
+
+_MSG_MARK = "__substg1.0_".encode("utf-16-le")
+_MSG_ATTACH = "__attach_version1.0_"
+_MSG_EMBEDDED = "__substg1.0_3701000D"
+
+
+def _is_outlook_msg(data: bytes) -> bool:
+    # Arquivo OLE com as propriedades MAPI do Outlook
+    return data.startswith(_OLE_MAGIC) and _MSG_MARK in data
+
+
+def _msg_string(ole, storage: list, tag: str) -> str:
+    for tipo, encoding in (("001F", "utf-16-le"), ("001E", "cp1252")):
+        caminho = storage + [f"__substg1.0_{tag}{tipo}"]
+        if ole.exists("/".join(caminho)):
+            valor = ole.openstream(caminho).read().decode(encoding, "ignore")
+            return valor.rstrip("\x00").strip()
+    return ""
+
+
+def _msg_attachments(ole, raiz: list, budget):
+    nivel = len(raiz)
+    anexos = sorted({
+        e[nivel] for e in ole.listdir(streams=True, storages=True)
+        if len(e) > nivel and e[:nivel] == raiz
+        and e[nivel].startswith(_MSG_ATTACH)
+    })
+    for anexo in anexos:
+        storage = raiz + [anexo]
+        embutida = storage + [_MSG_EMBEDDED]
+        if ole.exists("/".join(embutida)):
+            # Mensagem anexada: os anexos dela ficam na sub-árvore
+            nome = (_msg_string(ole, storage, "3001")
+                    or _msg_string(ole, embutida, "0037") or "mensagem")
+            if budget.nivel + 1 >= CONTAINER_MAX_DEPTH:
+                safe_print(f"[SKIP] Contêiner aninhado demais: {nome}")
+                continue
+            # Mesmo contador de níveis de ``expand_attachment``
+            budget.nivel += 1
+            try:
+                for interno, conteudo in _msg_attachments(
+                        ole, embutida, budget):
+                    yield f"{nome.replace('/', '_')}/{interno}", conteudo
+            finally:
+                budget.nivel -= 1
+            continue
+        dados = storage + ["__substg1.0_37010102"]
+        if not ole.exists("/".join(dados)):
+            continue
+        nome = (_msg_string(ole, storage, "3707")
+                or _msg_string(ole, storage, "3704") or "anexo")
+        budget.take(ole.get_size(dados))
+        yield nome.replace("/", "_"), ole.openstream(dados).read()
+
+
+# Antes do "doc": um .doc anexado deixa "WordDocument" dentro do .msg
+@register_container("msg", sniff=_is_outlook_msg, extensions=(".msg",),
+                    mime=("vnd.ms-outlook",))
+def _msg_members(data: bytes, budget):
+    if olefile is None:
+        safe_print("[WARN] Instale o olefile para ler anexos .msg")
+        return
+    with olefile.OleFileIO(io.BytesIO(data)) as ole:
+        yield from _msg_attachments(ole, [], budget)
+
+
+# Conversores de .doc (Word 97-2003) tentados em ordem; TRIAGEM_CONVERSOR_DOC
+# define outro comando ("{arquivo}" é trocado pelo caminho do .doc)
+DOC_CONVERTERS = (
+    "antiword {arquivo}",
+    "catdoc -w {arquivo}",
+    "soffice --headless --cat {arquivo}",
+)
+
+
+@register_extractor("doc", COST_MEDIUM, sniff=_is_word97,
+                    extensions=(".doc",), mime=("msword",))
+def _extract_doc(data: bytes, **_):
+    comandos = ([os.environ["TRIAGEM_CONVERSOR_DOC"]]
+                if os.getenv("TRIAGEM_CONVERSOR_DOC") else DOC_CONVERTERS)
+    with tempfile.TemporaryDirectory(prefix="triagem_doc_") as folder:
+        arquivo = os.path.join(folder, "anexo.doc")
+        with open(arquivo, "wb") as f:
+            f.write(data)
+        for comando in comandos:
+            # Caminhos com espaço no comando vêm entre aspas
+            args = [a.replace("{arquivo}", arquivo)
+                    for a in shlex.split(comando)]
+            if not args or not shutil.which(args[0]):
+                continue
+            try:
+                proc = subprocess.run(args, capture_output=True,
+                                      timeout=120)
+            except (subprocess.TimeoutExpired, OSError) as e:
+                # Um conversor travado ou quebrado não derruba os outros
+                safe_print(f"[WARN] Conversor de .doc falhou "
+                           f"({args[0]}): {e}")
+                continue
+            if proc.returncode == 0 and proc.stdout.strip():
+                return proc.stdout.decode("utf-8", "replace"), False
+    safe_print("[WARN] Nenhum conversor de .doc disponível "
+               "(antiword, catdoc ou LibreOffice)")
+    return "", False
+
+
+@register_extractor(
+    "image", COST_EXPENSIVE,
+    magic=(b"\x89PNG", b"\xff\xd8\xff", b"GIF8", b"II*\x00", b"MM\x00*"),
+    sniff=_looks_like_bmp,
+    extensions=(".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp"),
+    mime=("image/",)
+)
+def _extract_image(data: bytes, ocr=None, **_):
+    if not (HAVE_OCR and Image is not None and pytesseract is not None):
+        return "", False
+    img = Image.open(io.BytesIO(data))
+    return ocr([img])[0], True
+
+
+# Por último: sem nome nem contentType, conteúdo que pareça texto puro
+@register_extractor("text", extensions=(".txt",), mime=("text/plain",),
+                    fallback=_looks_like_text)
+def _extract_text(data: bytes, **_):
+    return data.decode("utf-8", errors="ignore"), False
+
+
+def extract_text_any(fname: str, ctype: str, data: bytes,
+                     max_pages: int = None, criterios=None,
+                     kind: str = None) -> ExtractionResult:
+    """Extrai o texto de um anexo; retorna ``(texto, ocr_usado)``.
+
+    O extrator vem do formato reconhecido pelo conteúdo (``sniff_format``),
+    não só da extensão, e o formato fica em ``detalhes["formato"]``. Em
+    PDFs, ``max_pages`` limita as páginas lidas e, com ``criterios``
+    (``CompiledCriteria``), a leitura para assim que a decisão estiver
+    definida, então o texto pode ficar parcial. ``kind`` é o formato já
+    reconhecido (ex.: por ``expand_attachment``), que poupa farejar de novo.
+    """
+    extractor = _EXTRACTORS.get(kind or sniff_format(data, fname, ctype))
+    if extractor is None:
+        return ExtractionResult("", False, formato=None)
+    ocr = _OCRSession()
+    try:
+        texto, ocr_usado = extractor.func(
+            data, fname=fname, max_pages=max_pages, criterios=criterios,
+            ocr=ocr
+        )
+    except MemoryError:
+        # Estouro do orçamento de memória (ver ``ExtractionEngine``)
+        raise
+    except Exception as e:
+        texto, ocr_usado = "", False
+        ocr.detalhes["erro"] = f"{type(e).__name__}: {e}"[:200]
+    return ExtractionResult(
+        texto, ocr_usado, formato=extractor.kind, **ocr.detalhes
+    )
+
+
+# Mude sempre que a extração passar a produzir texto diferente: invalida
+# as entradas antigas do ExtractionCache
+EXTRACTOR_VERSION = "9"
+
+
+@lru_cache(maxsize=None)
+def ocr_signature() -> str:
+    """O que do ambiente de OCR muda o texto extraído: se há OCR, o modo,
+    o idioma e o pré-processamento. Faz parte da chave do cache, então
+    um processo sem Tesseract não serve "" para quem tem."""
+    if not (HAVE_OCR and convert_from_bytes is not None):
+        return "sem-ocr"
+    backend = ocr_backend()
+    if backend != "tesserocr" and not shutil.which(
+            pytesseract.pytesseract.tesseract_cmd):
+        return "sem-ocr"
+    idioma = os.getenv("TRIAGEM_OCR_IDIOMA", "auto")
+    return f"{backend}|{idioma}|{','.join(ocr_preprocess_steps())}"
+
+
+class ExtractionCache:
+    """Cache em disco dos resultados de ``extract_text_any``.
+
+    A chave é o SHA-256 dos bytes do anexo mais ``EXTRACTOR_VERSION`` e
+    ``ocr_signature()``, então o mesmo CV recebido em outra caixa (ou
+    numa nova execução) não passa de novo pela extração/OCR, e extrações
+    que falharam ficam de fora. Os valores ``(texto, ocr_usado)`` ficam
+    comprimidos com zlib num SQLite que pode ser compartilhado entre os
+    workers do backend e o CLI; quando o total passa de
+    ``max_bytes`` as entradas menos usadas recentemente saem primeiro.
+    """
+
+    def __init__(self, path, max_bytes: int = 512 * 1024 * 1024):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with _sqlite_connect(self.path) as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS extracoes (
+                    chave TEXT PRIMARY KEY,
+                    valor BLOB NOT NULL,
+                    tamanho INTEGER NOT NULL,
+                    ultimo_acesso REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS extracoes_acesso
+                    ON extracoes (ultimo_acesso);
+            """)
+
+    @staticmethod
+    def key(data: bytes, max_pages: int = None, digest: str = None) -> str:
+        """Chave de ``data``; ``digest`` é o ``content_hash`` já calculado
+        (ex.: durante o download)."""
+        key = (f"{digest or content_hash(data)}:{EXTRACTOR_VERSION}:"
+               f"{ocr_signature()}")
+        return f"{key}:p{max_pages}" if max_pages else key
+
+    def get(self, key: str):
+        """``ExtractionResult`` guardado para ``key`` ou ``None``."""
+        try:
+            with _sqlite_connect(self.path) as conn:
+                row = conn.execute(
+                    "SELECT valor FROM extracoes WHERE chave = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                conn.execute(
+                    "UPDATE extracoes SET ultimo_acesso = ? WHERE chave = ?",
+                    (time.time(), key)
+                )
+            texto, ocr_usado, detalhes = json.loads(zlib.decompress(row[0]))
+            return ExtractionResult(texto, ocr_usado, **detalhes)
+        except (sqlite3.Error, zlib.error, ValueError) as e:
+            safe_print(f"[WARN] Cache de extração indisponível: {e}")
+            return None
+
+    def put(self, key: str, result: ExtractionResult):
+        texto, ocr_usado = result
+        detalhes = getattr(result, "detalhes", {})
+        valor = zlib.compress(json.dumps(
+            [texto, ocr_usado, detalhes], ensure_ascii=False
+        ).encode("utf-8"))
+        try:
+            with _sqlite_connect(self.path) as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO extracoes "
+                    "(chave, valor, tamanho, ultimo_acesso) "
+                    "VALUES (?, ?, ?, ?)",
+                    (key, valor, len(valor), time.time())
+                )
+                self._evict(conn)
+        except sqlite3.Error as e:
+            safe_print(f"[WARN] Cache de extração indisponível: {e}")
+
+    def _evict(self, conn):
+        total = conn.execute(
+            "SELECT COALESCE(SUM(tamanho), 0) FROM extracoes"
+        ).fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Remove as menos usadas até ficar em 90% do limite
+        excesso = total - int(self.max_bytes * 0.9)
+        removidas = []
+        for chave, tamanho in conn.execute(
+            "SELECT chave, tamanho FROM extracoes ORDER BY ultimo_acesso"
+        ):
+            if excesso <= 0:
+                break
+            removidas.append((chave,))
+            excesso -= tamanho
+        conn.executemany("DELETE FROM extracoes WHERE chave = ?", removidas)
+
+
+def default_cache():
+    """Cache compartilhado: ``TRIAGEM_CACHE`` (arquivo; ``0`` desliga) e
+    ``TRIAGEM_CACHE_MB`` (limite, padrão 512)."""
+    path = os.getenv("TRIAGEM_CACHE")
+    if path == "0":
+        return None
+    if not path:
+        path = Path.home() / ".cache" / "triagem" / "extracao.sqlite3"
+    max_mb = int(os.getenv("TRIAGEM_CACHE_MB") or 512)
+    return ExtractionCache(path, max_mb * 1024 * 1024)
+
+
+def default_workers() -> int:
+    """Processos de extração: ``TRIAGEM_WORKERS`` ou o número de CPUs."""
+    return int(os.getenv("TRIAGEM_WORKERS") or os.cpu_count() or 1)
+
+
+def default_max_pages():
+    """Páginas lidas por PDF: ``TRIAGEM_MAX_PAGINAS`` (vazio ou 0 = todas)."""
+    return int(os.getenv("TRIAGEM_MAX_PAGINAS") or 0) or None
+
+
+def default_doc_timeout():
+    """Segundos por documento no pool: ``TRIAGEM_TIMEOUT_DOC`` (0 = livre)."""
+    return float(os.getenv("TRIAGEM_TIMEOUT_DOC") or 120) or None
+
+
+def default_doc_memory():
+    """MB por documento no pool: ``TRIAGEM_MEMORIA_DOC_MB`` (0 = livre)."""
+    return int(os.getenv("TRIAGEM_MEMORIA_DOC_MB") or 1024) or None
+
+
+# Status em ``detalhes["status"]`` de quem estourou o orçamento
+STATUS_TIMEOUT = "timeout"
+STATUS_TOO_LARGE = "too_large"
+
+
+class _ExtractionTimeout(BaseException):
+    # BaseException: os ``except Exception`` da extração não a engolem
+    pass
+
+
+def _on_timeout(signum, frame):
+    raise _ExtractionTimeout()
+
+
+# Fila em que o processo do pool avisa quando começa cada trabalho
+_STARTED = None
+
+
+def _init_worker(max_memory_mb, started=None):
+    """Limita a memória do processo do pool a ``max_memory_mb`` além do
+    que ele já ocupa; um documento que passe disso gera MemoryError.
+    ``started`` é a fila de início de trabalhos do ``ExtractionEngine``."""
+    global _STARTED
+    _STARTED = started
+    if not max_memory_mb or resource is None:
+        return
+    try:
+        with open("/proc/self/statm") as f:
+            atual = int(f.read().split()[0]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return
+    _, hard = resource.getrlimit(resource.RLIMIT_AS)
+    limite = atual + max_memory_mb * 1024 * 1024
+    if hard != resource.RLIM_INFINITY:
+        limite = min(limite, hard)
+    resource.setrlimit(resource.RLIMIT_AS, (limite, hard))
+
+
+def _extract_budgeted(fname, ctype, data, max_pages, criterios, timeout,
+                      token=None, kind=None):
+    """``extract_text_any`` no processo do pool, com prazo por documento.
+
+    ``token`` vai para a fila ``_STARTED`` assim que o trabalho começa de
+    fato (e não quando entra na fila interna do pool).
+    """
+    if _STARTED is not None and token is not None:
+        _STARTED.put(token)
+    alarme = bool(timeout) and hasattr(signal, "setitimer")
+    if alarme:
+        signal.signal(signal.SIGALRM, _on_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        return extract_text_any(fname, ctype, data, max_pages, criterios,
+                                kind)
+    except _ExtractionTimeout:
+        return ExtractionResult(status=STATUS_TIMEOUT)
+    except MemoryError:
+        return ExtractionResult(status=STATUS_TOO_LARGE)
+    finally:
+        if alarme:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def _job_kind(job):
+    # Formato do trabalho, se já farejado (sexto item)
+    return job[5] if len(job) > 5 else None
+
+
+def _unsupported_job(job) -> bool:
+    # Farejado e sem extrator: não há o que extrair
+    return len(job) > 5 and job[5] is None
 
 
-def safe_name(name: str, fallback_ext: str = "") -> str:
-    name = (name or "anexo").strip()
-    base, dot, ext = name.rpartition('.')
-    if not dot:
-        base, ext = name, fallback_ext.lstrip('.')
-    base = re.sub(_ILLEGAL, "_", base) or "arquivo"
-    ext = re.sub(_ILLEGAL, "", ext.lower())
-    full = f"{base}.{ext}" if ext else base
-    if len(full) > 120:
-        h = hashlib.sha1(full.encode('utf-8')).hexdigest()[:8]
-        keep = 120 - (len(ext) + (1 if ext else 0) + 9)
-        base = base[:max(10, keep)]
-        full = f"{base}_{h}.{ext}" if ext else f"{base}_{h}"
-    return full
+class ExtractionEngine:
+    """Executa ``extract_text_any`` num pool de processos.
 
+    PyPDF2 e Tesseract são limitados por CPU, então cada documento vai
+    para um processo do pool. ``map_unordered`` consome os trabalhos sob
+    demanda (o download do próximo anexo acontece enquanto os anteriores
+    são extraídos), mantém no máximo ``max_in_flight`` em andamento e
+    devolve os resultados na ordem em que ficam prontos. Todo documento,
+    de qualquer formato, passa pelo pool e pelo orçamento abaixo; só com
+    ``max_workers=0`` tudo roda no próprio processo, sem limites. Se houver
+    ``cache``, documentos já extraídos nem chegam ao pool. ``max_pages``
+    limita as páginas lidas de cada PDF.
 
-def save_bytes(tmp_dir: Path, filename: str, data: bytes) -> Path:
-    tmp_dir.mkdir(parents=True, exist_ok=True)
-    path = tmp_dir / safe_name(filename)
-    with open(path, "wb") as f:
-        f.write(data)
-    return path
+    No pool, cada documento tem ``timeout`` segundos e ``max_memory_mb``
+    de memória além do que o processo já ocupa. Quem estoura sai vazio,
+    com ``detalhes["status"]`` igual a ``STATUS_TIMEOUT`` ou
+    ``STATUS_TOO_LARGE``, e o resto do lote segue. Se o processo nem
+    responder ao prazo (preso em código C), o pool é recriado depois de
+    ``2 * timeout`` e os outros documentos em andamento são reenviados.
+    """
 
+    # Intervalo entre as verificações de prazo do pool
+    POLL_INTERVAL = 1.0
 
-UNSUPPORTED_EXT = (
-    ".zip", ".rar", ".7z", ".msg", ".eml", ".xls", ".xlsx", ".ppt", ".pptx"
-)
+    def __init__(self, max_workers: int = None, max_in_flight: int = None,
+                 cache: ExtractionCache = None, max_pages: int = None,
+                 timeout: float = None, max_memory_mb: int = None):
+        if max_workers is None:
+            max_workers = default_workers()
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight or max(2 * max_workers, 1)
+        self.cache = cache
+        self.max_pages = max_pages or default_max_pages()
+        self.timeout = timeout or default_doc_timeout()
+        self.max_memory_mb = max_memory_mb or default_doc_memory()
+        self._pool = None
+        # Início real de cada trabalho: token -> future
+        self._started = None
+        self._tokens = {}
+        self._next_token = 0
 
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._started = multiprocessing.SimpleQueue()
+            self._tokens = {}
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=_init_worker,
+                initargs=(self.max_memory_mb, self._started)
+            )
+        return self._pool
 
-def extract_text_any(fname: str, ctype: str, data: bytes) -> tuple[str, bool]:
-    # PDF
-    if fname.lower().endswith(".pdf") or "pdf" in (ctype or "").lower():
-        text = ""
-        try:
-            from PyPDF2 import PdfReader
-            reader = PdfReader(io.BytesIO(data))
-            for p in reader.pages:
-                text += (p.extract_text() or "") + "\n"
-        except Exception:
-            text = ""
-        if len(text.strip()) >= MIN_TEXT_CHARS:
-            return text, False
-        # fallback OCR
-        if HAVE_OCR and convert_from_bytes is not None:
-            try:
-                pages = convert_from_bytes(data, dpi=300)
-                ocr_text = []
-                for img in pages:
-                    ocr_result = pytesseract.image_to_string(
-                        img, lang=OCR_LANG
-                    )
-                    ocr_text.append(ocr_result)
-                return "\n".join(ocr_text), True
-            except Exception:
-                pass
-        return text, False
-
-    # DOCX
-    is_docx = (fname.lower().endswith(".docx") or
-               "officedocument.wordprocessingml.document" in
-               (ctype or "").lower())
-    if is_docx:
-        try:
-            import tempfile
-            import docx
-            with tempfile.NamedTemporaryFile(
-                suffix=".docx", delete=True
-            ) as tmp:
-                tmp.write(data)
-                tmp.flush()
-                d = docx.Document(tmp.name)
-                return "\n".join(p.text for p in d.paragraphs), False
-        except Exception:
-            return "", False
+    def _submit(self, job, criterios):
+        executor = self._executor()
+        self._next_token += 1
+        future = executor.submit(
+            _extract_budgeted, *job[1:4], self.max_pages, criterios,
+            self.timeout, self._next_token, _job_kind(job)
+        )
+        self._tokens[self._next_token] = future
+        return future
 
-    # TXT
-    if fname.lower().endswith(".txt") or "text/plain" in (ctype or "").lower():
+    def _kill_pool(self):
+        # Sem API pública para matar um processo preso do pool
+        processos = getattr(self._pool, "_processes", None) or {}
+        for processo in list(processos.values()):
+            processo.kill()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+        self._pool = None
+
+    def _result(self, future, job, key):
         try:
-            return data.decode("utf-8", errors="ignore"), False
-        except Exception:
-            return "", False
-
-    # Imagens (PNG/JPG/TIF)
-    image_exts = (".png", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
-    is_image = (any(fname.lower().endswith(ext) for ext in image_exts) or
-                (ctype or "").lower().startswith("image/"))
-    if is_image:
-        if HAVE_OCR and Image is not None and pytesseract is not None:
-            try:
-                img = Image.open(io.BytesIO(data))
-                return pytesseract.image_to_string(img, lang=OCR_LANG), True
-            except Exception:
-                return "", False
+            result = future.result()
+        except BrokenProcessPool as e:
+            # Um processo morreu (ex.: falta de memória); recria o pool.
+            # Os outros futures do pool quebrado também chegam aqui, talvez
+            # depois de o pool já ter sido recriado: só o atual, se quebrado
+            safe_print(f"[WARN] Pool de extração reiniciado ({job[1]}): {e}")
+            if self._pool is not None and getattr(self._pool, "_broken",
+                                                  True):
+                self._pool.shutdown(wait=False, cancel_futures=True)
+                self._pool = None
+            erro = f"{type(e).__name__}: {e}"
+        except Exception as e:
+            safe_print(f"[WARN] Falha ao extrair {job[1]}: {e}")
+            erro = f"{type(e).__name__}: {e}"
         else:
-            return "", False
+            # Estouros de orçamento e falhas não vão para o cache
+            if key is not None and result.cacheable:
+                self.cache.put(key, result)
+            return result
+        return ExtractionResult(erro=erro[:200])
 
-    return "", False
+    def _expired(self, pending, started):
+        """Futures em execução há mais de ``2 * timeout``.
+
+        O relógio de cada future só começa quando o processo do pool avisa
+        que pegou o trabalho; ``future.running()`` já é verdadeiro para os
+        que só estão na fila interna do pool.
+        """
+        if not self.timeout:
+            return []
+        agora = time.monotonic()
+        while self._started is not None and not self._started.empty():
+            future = self._tokens.pop(self._started.get(), None)
+            if future in pending:
+                started.setdefault(future, agora)
+        return [f for f, t in started.items()
+                if f in pending and agora - t > 2 * self.timeout]
+
+    def _lookup(self, job):
+        """Retorna ``(chave_cache, resultado_em_cache)``."""
+        if self.cache is None:
+            return None, None
+        digest = job[4] if len(job) > 4 else None
+        key = self.cache.key(job[3], self.max_pages, digest)
+        return key, self.cache.get(key)
+
+    def _extract_inline(self, job, key, criterios):
+        try:
+            result = extract_text_any(*job[1:4], self.max_pages, criterios,
+                                      _job_kind(job))
+        except Exception as e:
+            safe_print(f"[WARN] Falha ao extrair {job[1]}: {e}")
+            return ExtractionResult(erro=f"{type(e).__name__}: {e}"[:200])
+        if key is not None and result.cacheable:
+            self.cache.put(key, result)
+        return result
+
+    def map_unordered(self, jobs, criterios=None):
+        """Extrai ``jobs`` em paralelo.
+
+        ``jobs`` é um iterável de ``(contexto, fname, ctype, data)``,
+        opcionalmente com o ``content_hash`` de ``data`` como quinto item
+        (poupa recalcular a chave do cache) e o formato de
+        ``sniff_format`` como sexto (o anexo não é farejado de novo; um
+        formato ``None`` nem vai ao pool); cada resultado sai como
+        ``(job, ExtractionResult)``. Com
+        ``criterios`` a leitura de cada PDF para assim que a decisão
+        estiver definida; esses textos parciais não vão para o cache.
+        """
+        if not self.max_workers:
+            for job in jobs:
+                if _unsupported_job(job):
+                    yield job, ExtractionResult(formato=None)
+                    continue
+                key, cached = self._lookup(job)
+                if cached is not None:
+                    yield job, cached
+                    continue
+                if criterios is not None:
+                    key = None
+                yield job, self._extract_inline(job, key, criterios)
+            return
+        jobs = iter(jobs)
+        pending = {}
+        started = {}
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < self.max_in_flight:
+                job = next(jobs, None)
+                if job is None:
+                    exhausted = True
+                    break
+                if _unsupported_job(job):
+                    yield job, ExtractionResult(formato=None)
+                    continue
+                key, cached = self._lookup(job)
+                if cached is not None:
+                    yield job, cached
+                    continue
+                if criterios is not None:
+                    key = None
+                pending[self._submit(job, criterios)] = (job, key)
+            if not pending:
+                break
+            done, _ = wait(
+                pending, timeout=self.timeout and self.POLL_INTERVAL,
+                return_when=FIRST_COMPLETED
+            )
+            for future in done:
+                job, key = pending.pop(future)
+                started.pop(future, None)
+                yield job, self._result(future, job, key)
+            presos = self._expired(pending, started)
+            if presos:
+                for future in presos:
+                    job, _ = pending.pop(future)
+                    safe_print(f"[WARN] Pool de extração reiniciado "
+                               f"({job[1]} passou do prazo)")
+                    yield job, ExtractionResult(status=STATUS_TIMEOUT)
+                self._kill_pool()
+                started.clear()
+                pending = {
+                    self._submit(job, criterios): (job, key)
+                    for job, key in pending.values()
+                }
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
 
 
 def extract_text_from_pdf(path):
@@ -332,9 +3368,7 @@ def extract_text_from_pdf(path):
 
 def extract_text_from_docx(path):
     try:
-        import docx
-        d = docx.Document(path)
-        return "\n".join(p.text for p in d.paragraphs)
+        return docx_text(Path(path).read_bytes())
     except Exception:
         print("[WARN] Falha ao extrair texto de", path)
         return ""
@@ -369,42 +3403,596 @@ FORMAÇÃO_SYNONYMS = {
 }
 
 
+class FormacaoSynonyms:
+    """Tabela de sinônimos de formação compilada para consulta rápida.
+
+    ``groups`` mapeia cada chave normalizada para o conjunto de variantes
+    normalizadas (incluindo a própria chave) e ``reverse`` mapeia cada
+    variante para as chaves em que aparece, então ``expand`` não precisa
+    percorrer a tabela nem renormalizar sinônimos.
+    """
+
+    def __init__(self, table: dict):
+        self.groups = {}
+        for key, syns in table.items():
+            nkey = normalize_text(key)
+            variants = self.groups.setdefault(nkey, {nkey})
+            variants.update(normalize_text(s) for s in syns if s.strip())
+        self.reverse = {}
+        for nkey, variants in self.groups.items():
+            for variant in variants:
+                self.reverse.setdefault(variant, set()).add(nkey)
+
+    @classmethod
+    def load(cls, path, base: dict = None) -> "FormacaoSynonyms":
+        """Carrega um dicionário JSON ou CSV somado à tabela ``base``.
+
+        JSON: ``{"chave": ["variante", ...]}``. CSV: uma linha por grupo,
+        ``chave,variante1,variante2,...`` (linhas repetidas se somam e
+        linhas iniciadas por ``#`` são ignoradas).
+        """
+        table = {k: list(v) for k, v in (base or {}).items()}
+        path = Path(path)
+        if path.suffix.lower() == ".json":
+            with open(path, "r", encoding="utf-8") as f:
+                extra = json.load(f)
+            for key, syns in extra.items():
+                table.setdefault(key, []).extend(syns)
+        else:
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                for row in csv.reader(f):
+                    row = [c.strip() for c in row if c.strip()]
+                    if not row or row[0].startswith("#"):
+                        continue
+                    table.setdefault(row[0], []).extend(row[1:])
+        return cls(table)
+
+    def expand(self, user_terms) -> set:
+        result = set()
+        for term in user_terms:
+            norm = normalize_text(term)
+            result.add(norm)
+            for key in self.reverse.get(norm, ()):
+                result.update(self.groups[key])
+        return result
+
+
+_FORMACAO_SYNONYMS = FormacaoSynonyms(FORMAÇÃO_SYNONYMS)
+
+
+def load_formacao_synonyms(path):
+    """Troca a tabela de sinônimos pela embutida + o arquivo ``path``."""
+    global _FORMACAO_SYNONYMS
+    _FORMACAO_SYNONYMS = FormacaoSynonyms.load(path, FORMAÇÃO_SYNONYMS)
+    _expanded_terms.cache_clear()
+    return _FORMACAO_SYNONYMS
+
+
 def expand_formacoes(user_terms):
-    result = set()
-    for term in user_terms:
-        norm = normalize_text(term)
-        result.add(norm)
-        for key, syns in FORMAÇÃO_SYNONYMS.items():
-            if norm == key or norm in syns:
-                result.update([normalize_text(s) for s in syns])
-    return result
+    return _FORMACAO_SYNONYMS.expand(user_terms)
+
+
+@lru_cache(maxsize=64)
+def _expanded_terms(formacoes: tuple) -> tuple:
+    return tuple(sorted(expand_formacoes(formacoes)))
+
+
+# Com poucos termos, str.__contains__ (em C) vence o autômato em Python;
+# a partir daqui uma única passada do PhraseMatcher é mais rápida
+_SUBSTRING_SCAN_MIN_TERMS = 64
+
+
+@lru_cache(maxsize=64)
+def _substring_matcher(terms: tuple) -> PhraseMatcher:
+    return PhraseMatcher(terms, word_boundary=False)
+
+
+def _find_substrings(texto_norm: str, terms: tuple, first_only=False):
+    """Termos de ``terms`` contidos em ``texto_norm`` (como ``in``)."""
+    found = set()
+    if len(terms) < _SUBSTRING_SCAN_MIN_TERMS:
+        for term in terms:
+            if term in texto_norm:
+                found.add(term)
+                if first_only:
+                    break
+        return found
+    for idx in _substring_matcher(terms).iter_matches(texto_norm):
+        found.add(terms[idx])
+        if first_only or len(found) == len(terms):
+            break
+    return found
 
 
 def has_formacao_in_text(cv_text, formacoes):
-    cv_norm = normalize_text(cv_text)
-    expanded = expand_formacoes(formacoes)
-    for term in expanded:
-        if term in cv_norm:
-            return True
-    return False
+    cv_norm = as_document(cv_text).normalized
+    expanded = _expanded_terms(tuple(sorted(formacoes)))
+    return bool(_find_substrings(cv_norm, expanded, first_only=True))
+
+
+def _fuzzy_terms_found(doc, terms: tuple, max_edits: int) -> set:
+    counts = _fuzzy_matcher(terms, max_edits).count(doc)
+    return {terms[i] for i, total in counts.items() if total}
 
 
-def candidato_aprovado(texto_cv, palavras, formacoes):
-    texto_norm = normalize_text(texto_cv)
+def candidato_aprovado(texto_cv, palavras, formacoes, fuzzy=0):
+    doc = as_document(texto_cv)
+    texto_norm = doc.normalized
     formacoes_encontradas = set()
     if palavras:
-        if not any(normalize_text(p) in texto_norm for p in palavras):
+        termos = tuple(normalize_text(p) for p in palavras)
+        if (not _find_substrings(texto_norm, termos, first_only=True)
+                and not (fuzzy and _fuzzy_terms_found(doc, termos, fuzzy))):
             return False, formacoes_encontradas
     if formacoes:
-        expanded = expand_formacoes(formacoes)
-        for term in expanded:
-            if term in texto_norm:
-                formacoes_encontradas.add(term)
+        expanded = _expanded_terms(tuple(sorted(formacoes)))
+        formacoes_encontradas = _find_substrings(texto_norm, expanded)
+        if fuzzy:
+            faltantes = tuple(
+                t for t in expanded if t not in formacoes_encontradas
+            )
+            formacoes_encontradas |= _fuzzy_terms_found(
+                doc, faltantes, fuzzy
+            )
         if not formacoes_encontradas:
             return False, formacoes_encontradas
     return True, formacoes_encontradas
 
 
+# Dicionário adicional de sinônimos (JSON ou CSV)
+if os.getenv("FORMACOES_SINONIMOS"):
+    load_formacao_synonyms(os.environ["FORMACOES_SINONIMOS"])
+
+
+class TopK:
+    """Guarda apenas os ``k`` itens de maior pontuação (heap mínimo)."""
+
+    def __init__(self, k: int):
+        if k < 1:
+            raise ValueError(f"TopK precisa de k >= 1 (recebeu {k})")
+        self.k = k
+        self._heap = []
+        self._seq = 0
+
+    def push(self, score: float, item):
+        """Insere ``item``; retorna o item descartado (ou ``None``)."""
+        self._seq += 1
+        entry = (score, -self._seq, item)
+        if len(self._heap) < self.k:
+            heapq.heappush(self._heap, entry)
+            return None
+        if entry <= self._heap[0]:
+            return item
+        return heapq.heapreplace(self._heap, entry)[2]
+
+    def __iter__(self):
+        return (item for _, _, item in self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+
+class RelevanceRanking:
+    """Pontuação BM25 das palavras-chave e formações com top-k em fluxo.
+
+    As estatísticas do corpus (número de documentos, tamanho médio e em
+    quantos documentos cada termo aparece) são acumuladas conforme os
+    documentos chegam, e um ``TopK`` mantém só os ``k`` melhores, então
+    a memória não cresce com o lote. No fim, os sobreviventes são
+    pontuados de novo com as estatísticas finais.
+
+    Documentos com palavra negativa ou sem nenhum termo encontrado não
+    entram no ranking.
+    """
+
+    def __init__(self, criterios, k: int, k1: float = 1.2, b: float = 0.75,
+                 peso_formacao: float = 1.0):
+        self.criterios = criterios
+        self.k1 = k1
+        self.b = b
+        n_terms = len(criterios.positivas) + len(criterios.formacoes)
+        self._pesos = (
+            [1.0] * len(criterios.positivas)
+            + [peso_formacao] * len(criterios.formacoes)
+        )
+        self._df = [0] * n_terms
+        self._n_docs = 0
+        self._total_len = 0
+        self._top = TopK(k)
+
+    def _idf(self, df: int) -> float:
+        return math.log(1 + (self._n_docs - df + 0.5) / (df + 0.5))
+
+    def score(self, tfs, doc_len: int) -> float:
+        avgdl = self._total_len / self._n_docs if self._n_docs else 1
+        norm = self.k1 * (1 - self.b + self.b * doc_len / (avgdl or 1))
+        return sum(
+            peso * self._idf(df) * tf * (self.k1 + 1) / (tf + norm)
+            for tf, df, peso in zip(tfs, self._df, self._pesos) if tf
+        )
+
+    def add(self, texto, item):
+        """Pontua o documento e tenta colocá-lo no top-k.
+
+        Retorna o item que ficou de fora (o próprio ``item`` ou um que
+        foi desalojado), ou ``None`` se nada foi descartado.
+        """
+        doc = as_document(texto)
+        tf_pos, neg_hit, tf_form = self.criterios.count_matches(doc)
+        tfs = tf_pos + tf_form
+        doc_len = len(doc.tokens)
+        self._n_docs += 1
+        self._total_len += doc_len
+        for i, tf in enumerate(tfs):
+            if tf:
+                self._df[i] += 1
+        if neg_hit or not any(tfs):
+            return item
+        descartado = self._top.push(
+            self.score(tfs, doc_len), (tfs, doc_len, tf_form, item)
+        )
+        return descartado and descartado[3]
+
+    def results(self):
+        """Lista ``(pontuacao, formacoes_encontradas, item)`` em ordem."""
+        ranked = []
+        for tfs, doc_len, tf_form, item in self._top:
+            formacoes = [
+                f for f, tf in zip(self.criterios.formacoes, tf_form) if tf
+            ]
+            ranked.append((self.score(tfs, doc_len), formacoes, item))
+        ranked.sort(key=lambda r: r[0], reverse=True)
+        return ranked
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+@contextmanager
+def _sqlite_connect(path):
+    # Uma conexão por operação: funciona entre processos (backend e CLI)
+    conn = sqlite3.connect(str(path), timeout=30)
+    try:
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+
+class CVIndex:
+    """Índice invertido em disco (SQLite) dos CVs já extraídos.
+
+    Cada documento guarda o texto na forma ``exact`` de
+    ``NormalizedDocument`` e, para cada termo, a lista de posições
+    (ordem do token no texto). Uma nova triagem usa as posições para
+    descartar rapidamente quem não contém nenhuma frase positiva e só
+    então confere os candidatos com ``CompiledCriteria``, de modo que o
+    resultado é o mesmo de uma triagem completa, sem Graph nem OCR.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS docs (
+                    id INTEGER PRIMARY KEY,
+                    chave TEXT UNIQUE NOT NULL,
+                    nome TEXT,
+                    ocr_usado INTEGER,
+                    tamanho_texto INTEGER,
+                    meta TEXT,
+                    texto_norm TEXT,
+                    indexado_em TEXT
+                );
+                CREATE TABLE IF NOT EXISTS postings (
+                    termo TEXT NOT NULL,
+                    doc_id INTEGER NOT NULL,
+                    posicoes BLOB NOT NULL,
+                    PRIMARY KEY (termo, doc_id)
+                ) WITHOUT ROWID;
+            """)
+
+    def _connect(self):
+        return _sqlite_connect(self.path)
+
+    def add(self, chave: str, nome: str, texto, ocr_usado: bool,
+            meta: dict = None):
+        """Indexa (ou reindexa) um documento identificado por ``chave``."""
+        doc = as_document(texto)
+        posicoes = {}
+        for pos, m in enumerate(_TOKEN_RE.finditer(doc.exact)):
+            posicoes.setdefault(m.group(), array("I")).append(pos)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT id FROM docs WHERE chave = ?", (chave,)
+            ).fetchone()
+            if row:
+                conn.execute("DELETE FROM postings WHERE doc_id = ?", row)
+                conn.execute("DELETE FROM docs WHERE id = ?", row)
+            cur = conn.execute(
+                "INSERT INTO docs (chave, nome, ocr_usado, tamanho_texto, "
+                "meta, texto_norm, indexado_em) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (chave, nome, int(bool(ocr_usado)), len(doc),
+                 json.dumps(meta or {}, ensure_ascii=False), doc.exact,
+                 datetime.now().isoformat())
+            )
+            doc_id = cur.lastrowid
+            conn.executemany(
+                "INSERT INTO postings (termo, doc_id, posicoes) "
+                "VALUES (?, ?, ?)",
+                ((termo, doc_id, pos.tobytes())
+                 for termo, pos in posicoes.items())
+            )
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def _phrase_candidates(self, conn, frase: str):
+        """IDs dos documentos com os tokens de ``frase`` em sequência.
+
+        Retorna ``None`` quando a frase não tem tokens (não filtra).
+        """
+        termos = _TOKEN_RE.findall(_normalize(frase))
+        if not termos:
+            return None
+        por_termo = []
+        for termo in dict.fromkeys(termos):
+            postings = {}
+            for doc_id, blob in conn.execute(
+                "SELECT doc_id, posicoes FROM postings WHERE termo = ?",
+                (termo,)
+            ):
+                pos = array("I")
+                pos.frombytes(blob)
+                postings[doc_id] = pos
+            if not postings:
+                return set()
+            por_termo.append((termo, postings))
+        posicoes = dict(por_termo)
+        docs = set.intersection(*(set(p) for _, p in por_termo))
+        if len(termos) == 1:
+            return docs
+        encontrados = set()
+        for doc_id in docs:
+            seguintes = [set(posicoes[t][doc_id]) for t in termos[1:]]
+            for inicio in posicoes[termos[0]][doc_id]:
+                if all(inicio + i in seg
+                       for i, seg in enumerate(seguintes, 1)):
+                    encontrados.add(doc_id)
+                    break
+        return encontrados
+
+    def iter_documents(self):
+        """Gera ``(info, NormalizedDocument)`` de todos os documentos."""
+        with self._connect() as conn:
+            for chave, nome, ocr_usado, tamanho, meta, texto_norm in \
+                    conn.execute(
+                        "SELECT chave, nome, ocr_usado, tamanho_texto, meta, "
+                        "texto_norm FROM docs"):
+                info = json.loads(meta or "{}")
+                info.update({
+                    "arquivo": nome,
+                    "chave": chave,
+                    "tamanho_texto": tamanho,
+                    "ocr_usado": bool(ocr_usado),
+                })
+                yield info, NormalizedDocument.from_exact(texto_norm)
+
+    def rank(self, criterios, top_k: int):
+        """Os ``top_k`` documentos mais relevantes (BM25) do índice."""
+        ranking = RelevanceRanking(criterios, top_k)
+        for info, doc in self.iter_documents():
+            ranking.add(doc, info)
+        for score, formacoes, info in ranking.results():
+            info["formacoes_encontradas"] = formacoes
+            info["pontuacao"] = round(score, 4)
+            yield info
+
+    def search(self, criterios, exigir_formacao: bool = False):
+        """Avalia ``criterios`` (``CompiledCriteria``) sobre o índice.
+
+        Gera um dicionário por documento aprovado. É a regra de frases
+        inteiras da triagem de arquivos enviados; para a regra por
+        trechos do CLI use ``search_substrings``. Com ``exigir_formacao``,
+        havendo formações, ao menos uma precisa ser encontrada.
+        """
+        with self._connect() as conn:
+            candidatos = set()
+            for frase in criterios.positivas:
+                ids = self._phrase_candidates(conn, frase)
+                # O filtro por postings é exato; com fuzzy avalia todos
+                if ids is None or criterios.fuzzy:
+                    candidatos = None
+                    break
+                candidatos |= ids
+            if candidatos is None:
+                rows = conn.execute(
+                    "SELECT id, chave, nome, ocr_usado, tamanho_texto, "
+                    "meta, texto_norm FROM docs"
+                )
+            else:
+                rows = (
+                    conn.execute(
+                        "SELECT id, chave, nome, ocr_usado, tamanho_texto, "
+                        "meta, texto_norm FROM docs WHERE id = ?", (doc_id,)
+                    ).fetchone()
+                    for doc_id in sorted(candidatos)
+                )
+            for row in rows:
+                _, chave, nome, ocr_usado, tamanho, meta, texto_norm = row
+                pos_hit, neg_hit, formacoes_encontradas = criterios.evaluate(
+                    NormalizedDocument.from_exact(texto_norm)
+                )
+                if not pos_hit or neg_hit:
+                    continue
+                if (exigir_formacao and criterios.formacoes
+                        and not formacoes_encontradas):
+                    continue
+                info = json.loads(meta or "{}")
+                info.update({
+                    "arquivo": nome,
+                    "chave": chave,
+                    "formacoes_encontradas": formacoes_encontradas,
+                    "tamanho_texto": tamanho,
+                    "ocr_usado": bool(ocr_usado),
+                })
+                yield info
+
+    def search_substrings(self, positivas, negativas=(), formacoes=(),
+                          fuzzy: int = 0):
+        """A regra da triagem ao vivo do CLI sobre o índice.
+
+        Aprova quem passa em ``candidato_aprovado`` (trechos de
+        ``normalize_text``, formações com sinônimos) e não contém nenhuma
+        negativa como trecho: "farm" acha "farmácia" aqui também. A única
+        diferença é o texto guardado, já com a hifenização de fim de
+        linha desfeita (forma ``exact``).
+        """
+        termos = [normalize_text(p) for p in positivas]
+        negativas = [normalize_text(n) for n in negativas]
+        sql = ("SELECT chave, nome, ocr_usado, tamanho_texto, meta, "
+               "texto_norm FROM docs")
+        # O SQLite descarta quem não tem nenhuma positiva (instr, em C)
+        if termos and all(termos) and not fuzzy:
+            sql += " WHERE " + " OR ".join(
+                ["instr(texto_norm, ?) > 0"] * len(termos)
+            )
+        else:
+            termos = []
+        with self._connect() as conn:
+            for chave, nome, ocr_usado, tamanho, meta, texto_norm in \
+                    conn.execute(sql, termos):
+                doc = NormalizedDocument.from_exact(texto_norm)
+                aprovado, formacoes_encontradas = candidato_aprovado(
+                    doc, positivas, formacoes, fuzzy=fuzzy
+                )
+                if not aprovado or any(n in doc.normalized
+                                       for n in negativas):
+                    continue
+                info = json.loads(meta or "{}")
+                info.update({
+                    "arquivo": nome,
+                    "chave": chave,
+                    "formacoes_encontradas": sorted(formacoes_encontradas),
+                    "tamanho_texto": tamanho,
+                    "ocr_usado": bool(ocr_usado),
+                })
+                yield info
+
+
+class DeltaState:
+    """Estado da sincronização incremental (SQLite), por caixa e pasta.
+
+    Guarda o ``@odata.deltaLink`` da última rodada, o maior
+    ``receivedDateTime`` já triado e as mensagens que não puderam ser
+    triadas por inteiro (anexo que não baixou, extração que estourou o
+    prazo...): ``pending`` as devolve para a próxima rodada, até
+    ``DELTA_MAX_RETRIES`` tentativas. ``reset`` apaga o estado de uma
+    caixa (ou de todas) e a próxima rodada volta a ler a pasta inteira.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS delta (
+                    caixa TEXT NOT NULL,
+                    pasta TEXT NOT NULL,
+                    delta_link TEXT NOT NULL,
+                    recebido_ate TEXT,
+                    sincronizado_em TEXT,
+                    PRIMARY KEY (caixa, pasta)
+                );
+                CREATE TABLE IF NOT EXISTS pendentes (
+                    caixa TEXT NOT NULL,
+                    pasta TEXT NOT NULL,
+                    msg_id TEXT NOT NULL,
+                    tentativas INTEGER NOT NULL,
+                    PRIMARY KEY (caixa, pasta, msg_id)
+                );
+            """)
+
+    def _connect(self):
+        return _sqlite_connect(self.path)
+
+    def get(self, caixa: str, pasta: str = DELTA_FOLDER):
+        """``(delta_link, recebido_ate)`` ou ``(None, None)``."""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT delta_link, recebido_ate FROM delta "
+                "WHERE caixa = ? AND pasta = ?", (caixa.lower(), pasta)
+            ).fetchone()
+        return tuple(row) if row else (None, None)
+
+    def pending(self, caixa: str, pasta: str = DELTA_FOLDER) -> list:
+        """Ids das mensagens a triar de novo na próxima rodada."""
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT msg_id FROM pendentes WHERE caixa = ? AND pasta = ?",
+                (caixa.lower(), pasta)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def set(self, caixa: str, pasta: str, delta_link: str,
+            recebido_ate: str = None, falhas=()):
+        """Avança a caixa; ``falhas`` são os ids que ficaram incompletos
+        nesta rodada e substituem os pendentes anteriores."""
+        caixa = caixa.lower()
+        with self._connect() as conn:
+            tentativas = dict(conn.execute(
+                "SELECT msg_id, tentativas FROM pendentes "
+                "WHERE caixa = ? AND pasta = ?", (caixa, pasta)
+            ).fetchall())
+            conn.execute(
+                "DELETE FROM pendentes WHERE caixa = ? AND pasta = ?",
+                (caixa, pasta)
+            )
+            for msg_id in {f for f in falhas if f}:
+                n = tentativas.get(msg_id, 0) + 1
+                if n > DELTA_MAX_RETRIES:
+                    safe_print(f"[WARN] Mensagem {msg_id} de {caixa} "
+                               f"desistida após {DELTA_MAX_RETRIES} "
+                               f"tentativas")
+                    continue
+                conn.execute(
+                    "INSERT INTO pendentes (caixa, pasta, msg_id, "
+                    "tentativas) VALUES (?, ?, ?, ?)",
+                    (caixa, pasta, msg_id, n)
+                )
+            conn.execute(
+                "INSERT OR REPLACE INTO delta (caixa, pasta, delta_link, "
+                "recebido_ate, sincronizado_em) VALUES (?, ?, ?, ?, ?)",
+                (caixa, pasta, delta_link, recebido_ate,
+                 datetime.now().isoformat())
+            )
+
+    def reset(self, caixa: str = None) -> int:
+        """Apaga o estado de ``caixa`` (todas se ``None``); devolve
+        quantas pastas foram zeradas."""
+        with self._connect() as conn:
+            if caixa is None:
+                conn.execute("DELETE FROM pendentes")
+                cur = conn.execute("DELETE FROM delta")
+            else:
+                conn.execute(
+                    "DELETE FROM pendentes WHERE caixa = ?", (caixa.lower(),)
+                )
+                cur = conn.execute(
+                    "DELETE FROM delta WHERE caixa = ?", (caixa.lower(),)
+                )
+            return cur.rowcount
+
+    def __len__(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM delta").fetchone()[0]
+
+
 def teste_formacao():
     cvs = [
         "Graduado em farmácia pela USP, experiência em química",
@@ -441,13 +4029,13 @@ def main():
     parser.add_argument(
         "--http-timeout",
         type=int,
-        default=60,
+        default=GRAPH_READ_TIMEOUT,
         help="Timeout de leitura (segundos)"
     )
     parser.add_argument(
         "--max-retries",
         type=int,
-        default=5,
+        default=GRAPH_MAX_RETRIES,
         help="Máximo de tentativas em falha de rede"
     )
     parser.add_argument(
@@ -455,13 +4043,92 @@ def main():
         default="",
         help="Lista de formações separadas por vírgula"
     )
+    parser.add_argument(
+        "--sinonimos",
+        help="Dicionário extra de sinônimos de formação (JSON ou CSV)"
+    )
     parser.add_argument(
         "--teste-formacao",
         action="store_true",
         help="Executa teste de formação em memória"
     )
+    parser.add_argument(
+        "--indice",
+        help="Arquivo do índice de CVs (padrão: <base_dir>/indice_cvs.sqlite3)"
+    )
+    parser.add_argument(
+        "--usar-indice",
+        action="store_true",
+        help="Reavalia os critérios sobre o índice, sem Graph nem OCR"
+    )
+    parser.add_argument(
+        "--fuzzy",
+        type=int,
+        default=0,
+        help="Tolera até N erros de OCR por palavra (positivas e formações)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processos de extração (padrão: TRIAGEM_WORKERS ou nº de CPUs)"
+    )
+    parser.add_argument(
+        "--sem-cache",
+        action="store_true",
+        help="Não usa o cache de extração (TRIAGEM_CACHE)"
+    )
+    parser.add_argument(
+        "--max-paginas",
+        type=int,
+        default=None,
+        help="Máximo de páginas lidas por PDF (padrão: todas)"
+    )
+    parser.add_argument(
+        "--timeout-doc",
+        type=float,
+        default=None,
+        help="Segundos por documento (padrão: TRIAGEM_TIMEOUT_DOC ou 120)"
+    )
+    parser.add_argument(
+        "--memoria-doc-mb",
+        type=int,
+        default=None,
+        help="MB por documento (padrão: TRIAGEM_MEMORIA_DOC_MB ou 1024)"
+    )
+    parser.add_argument(
+        "--parar-cedo",
+        action="store_true",
+        help=("Para de ler o PDF quando a decisão já está definida "
+              "(o texto parcial não entra no índice)")
+    )
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=0,
+        help="Ordena por relevância (BM25) e mantém só os K melhores"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Só as mensagens recebidas desde a última execução (delta)"
+    )
+    parser.add_argument(
+        "--resetar-delta",
+        action="store_true",
+        help="Zera o estado incremental: a próxima leitura é completa"
+    )
+    parser.add_argument(
+        "--estado-delta",
+        help="Arquivo do estado incremental (padrão: <base_dir>/delta.sqlite3)"
+    )
 
     args = parser.parse_args()
+    if args.top_k < 0:
+        parser.error("--top-k deve ser pelo menos 1 (0 desliga o ranking)")
+
+    if args.sinonimos:
+        load_formacao_synonyms(args.sinonimos)
 
     if args.teste_formacao:
         # Executar teste inline
@@ -507,15 +4174,12 @@ def main():
     )
     safe_print(msg_formacao)
 
-    token = get_token(params)
     user_email = params["user_email"]
     endpoint = params["endpoint"]
     base_dir = Path(params.get("base_dir", "aprovados"))
     qual_dir = base_dir / "qualidade"
-    tmp_dir = base_dir / "__tmp"
 
     qual_dir.mkdir(parents=True, exist_ok=True)
-    tmp_dir.mkdir(parents=True, exist_ok=True)
 
     positivas = [args.vaga_desc.strip()] + [
         k.strip() for k in args.keywords.split(",") if k.strip()
@@ -525,6 +4189,42 @@ def main():
         if args.negativas else []
     )
 
+    positivas_norm = [normalize_text(k) for k in positivas]
+    negativas_norm = [normalize_text(k) for k in negativas]
+
+    indice = CVIndex(
+        args.indice or params.get("indice")
+        or base_dir / "indice_cvs.sqlite3"
+    )
+    criterios = compile_criteria(
+        positivas, negativas, sorted(formacoes), fuzzy=args.fuzzy
+    )
+    if args.usar_indice:
+        if args.top_k:
+            encontrados = indice.rank(criterios, args.top_k)
+        else:
+            # Mesma regra (por trechos) da triagem ao vivo abaixo
+            encontrados = indice.search_substrings(
+                positivas, negativas, formacoes, fuzzy=args.fuzzy
+            )
+        aprovados = []
+        for info in encontrados:
+            linha = {
+                "nome": info["arquivo"],
+                "from": info.get("email_origem", ""),
+                "subject": info.get("email_assunto", ""),
+                "formacoes_encontradas": ", ".join(
+                    info["formacoes_encontradas"]
+                ),
+                "aprovado": True
+            }
+            if "pontuacao" in info:
+                linha["pontuacao"] = info["pontuacao"]
+            aprovados.append(linha)
+        safe_print(f"[INFO] {len(indice)} CVs no índice {indice.path}")
+        _salvar_resultados(base_dir, aprovados)
+        return
+
     if not HAVE_OCR:
         msg_ocr = (
             "[WARN] OCR indisponível (instale Tesseract + pdf2image + "
@@ -532,63 +4232,123 @@ def main():
         )
         safe_print(msg_ocr)
 
-    messages = fetch_messages(
-        endpoint, token,
-        timeout=args.http_timeout,
-        max_retries=args.max_retries
-    )
+    estado = None
+    if args.incremental or args.resetar_delta:
+        estado = DeltaState(
+            args.estado_delta or params.get("estado_delta")
+            or base_dir / "delta.sqlite3"
+        )
+    if args.resetar_delta:
+        zeradas = estado.reset(user_email)
+        safe_print(f"[INFO] Estado incremental de {user_email} zerado "
+                   f"({zeradas} pastas)")
+
+    # Um provedor para a execução inteira: renova o token se a varredura
+    # passar da validade dele
+    token = get_token_provider(params)
+    # Ids das mensagens que não foram triadas por inteiro
+    falhas = set()
+    if args.incremental:
+        pasta = params.get("pasta", DELTA_FOLDER)
+        delta_link, desde = estado.get(user_email, pasta)
+        alteradas, novo_link = fetch_messages_delta(
+            user_email, token, delta_link, pasta,
+            timeout=args.http_timeout,
+            max_retries=args.max_retries
+        )
+        messages, recebido_ate = added_messages(alteradas, desde)
+        # Incompletas da rodada anterior voltam à triagem
+        vistas = {m["id"] for m in messages}
+        for msg_id in estado.pending(user_email, pasta):
+            if msg_id in vistas:
+                continue
+            try:
+                msg = fetch_message(user_email, msg_id, token)
+            except Exception as e:
+                safe_print(f"[ERRO] Mensagem pendente {msg_id}: {e}")
+                falhas.add(msg_id)
+                continue
+            if msg is not None:
+                messages.append(msg)
+        messages = [m for m in messages if m.get("hasAttachments")]
+        modo = "incremental" if delta_link else "completa"
+        safe_print(f"[INFO] Sincronização {modo} de {pasta}: "
+                   f"{len(alteradas)} alterações")
+    else:
+        messages = fetch_messages(
+            endpoint, token,
+            timeout=args.http_timeout,
+            max_retries=args.max_retries
+        )
 
     safe_print(f"[INFO] {len(messages)} mensagens obtidas")
 
     aprovados = []
-    for msg in messages:
-        try:
-            subj = msg.get("subject", "(sem assunto)")
-            msg_id = msg["id"]
-            msg_from = msg.get("from", {}).get(
-                "emailAddress", {}
-            ).get("address", "(desconhecido)")
-            safe_print(f"[MSG] De: {msg_from} | Assunto: {subj[:50]}")
-
-            atts = list_attachments(user_email, msg_id, token)
-            for att in atts:
+    ranking = (
+        RelevanceRanking(criterios, args.top_k) if args.top_k else None
+    )
+    # Anexos baixados nesta execução; o ranking guarda os arquivos até o
+    # fim, e nada sobra em disco depois
+    tmp_dir = Path(tempfile.mkdtemp(prefix="triagem_anexos_"))
+    try:
+        jobs = _iter_attachment_jobs(messages, user_email, token, tmp_dir,
+                                     falhas)
+        cache = None if args.sem_cache else default_cache()
+        # Parada antecipada não combina com o ranking, que conta ocorrências
+        parar_cedo = args.parar_cedo and ranking is None
+        with ExtractionEngine(args.workers, cache=cache,
+                              max_pages=args.max_paginas,
+                              timeout=args.timeout_doc,
+                              max_memory_mb=args.memoria_doc_mb) as engine:
+            for job, result in engine.map_unordered(
+                    jobs, criterios if parar_cedo else None):
+                ctx, fname, ctype, data, sha, _ = job
+                msg_id, msg_from, subj, received, local = ctx
+                text, ocr_used = result
+                if not result.complete:
+                    # Volta na próxima execução incremental
+                    falhas.add(msg_id)
+                if "status" in result.detalhes:
+                    # Estourou o tempo ou a memória por documento
+                    safe_print(f"[SKIP] {fname} - {result.detalhes['status']}")
+                    continue
                 try:
-                    att_name = att["name"]
-                    if any(att_name.lower().endswith(ext)
-                           for ext in UNSUPPORTED_EXT):
-                        safe_print(
-                            f"[SKIP] Extensão não suportada: {att_name}"
-                        )
-                        continue
-
-                    fname, data, ctype = download_attachment(
-                        user_email, msg_id, att['id'], token
-                    )
-                    if not data:
-                        continue
-
-                    local = save_bytes(tmp_dir, fname, data)
-                    text, ocr_used = extract_text_any(fname, ctype, data)
+                    doc = NormalizedDocument(text)
+                    if text and not parar_cedo:
+                        chave = sha or content_hash(data)
+                        indice.add(chave, fname, doc, ocr_used, {
+                            "email_origem": msg_from,
+                            "email_assunto": subj,
+                            "email_data": received,
+                        })
 
                     aprovado, formacoes_encontradas = candidato_aprovado(
-                        text, positivas, formacoes
+                        doc, positivas, formacoes, fuzzy=args.fuzzy
                     )
 
-                    pos_hit = any(
-                        normalize_text(k) in normalize_text(text)
-                        for k in positivas
-                    )
-                    neg_hit = any(
-                        normalize_text(k) in normalize_text(text)
-                        for k in negativas
-                    )
+                    pos_hit = any(k in doc.normalized for k in positivas_norm)
+                    neg_hit = any(k in doc.normalized for k in negativas_norm)
 
                     msg_scan = (
                         f"[SCAN] {local.name} chars={len(text)} "
                         f"ocr={ocr_used} pos_hit={pos_hit} neg_hit={neg_hit}"
                     )
+                    if "ocr_idioma" in result.detalhes:
+                        msg_scan += f" idioma={result.detalhes['ocr_idioma']}"
                     safe_print(msg_scan)
 
+                    if ranking is not None:
+                        # Decisão adiada: só os K melhores vão para
+                        # qualidade/ no fim
+                        descartado = ranking.add(doc, (local, {
+                            "nome": fname,
+                            "from": msg_from,
+                            "subject": subj,
+                        }))
+                        if descartado is not None:
+                            descartado[0].unlink(missing_ok=True)
+                        continue
+
                     if aprovado and not neg_hit:
                         qual_path = qual_dir / local.name
                         qual_path.write_bytes(data)
@@ -606,13 +4366,96 @@ def main():
                         safe_print(f"[OK] {fname} salvo em qualidade/")
                     else:
                         safe_print(f"[SKIP] {fname} - reprovado/negativas")
+                except Exception as e:
+                    safe_print(f"[ERRO] Anexo {fname}: {e}")
+                    falhas.add(msg_id)
+
+        if ranking is not None:
+            for score, formacoes_rank, (local, linha) in ranking.results():
+                (qual_dir / local.name).write_bytes(local.read_bytes())
+                linha["formacoes_encontradas"] = ", ".join(formacoes_rank)
+                linha["aprovado"] = True
+                linha["pontuacao"] = round(score, 4)
+                aprovados.append(linha)
+                safe_print(f"[OK] {linha['nome']} (pontuação {score:.3f})")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    _salvar_resultados(base_dir, aprovados)
+
+    if args.incremental and novo_link:
+        # Só avança depois da triagem: uma execução interrompida repete
+        # as mesmas mensagens na próxima, e as incompletas ficam
+        # pendentes para a seguinte
+        estado.set(user_email, pasta, novo_link, recebido_ate, falhas)
+        if falhas:
+            safe_print(f"[WARN] {len(falhas)} mensagens incompletas serão "
+                       f"triadas de novo na próxima execução")
+        safe_print(f"[INFO] Estado incremental salvo em {estado.path}")
+
+
+def _iter_attachment_jobs(messages, user_email, token, tmp_dir, falhas):
+    """Baixa os anexos e gera os trabalhos para o ``ExtractionEngine``.
+
+    O id de cada mensagem com anexo que não baixou entra em ``falhas``.
+    """
+    for msg in messages:
+        try:
+            subj = msg.get("subject", "(sem assunto)")
+            msg_id = msg["id"]
+            msg_from = msg.get("from", {}).get(
+                "emailAddress", {}
+            ).get("address", "(desconhecido)")
+            received = msg.get("receivedDateTime", "")
+            safe_print(f"[MSG] De: {msg_from} | Assunto: {subj[:50]}")
+
+            atts = list_attachments(user_email, msg_id, token)
+            if atts is None:
+                falhas.add(msg_id)
+                continue
+            for att in atts:
+                if att.get("@odata.type") != FILE_ATTACHMENT:
+                    continue
+                if unsupported_name(att.get("name")):
+                    safe_print(f"[SKIP] Extensão não suportada: "
+                               f"{att.get('name')}")
+                    continue
+                try:
+                    # Conteúdo cru em partes, com o hash pronto no fim
+                    fname, data, ctype, digest = stream_attachment(
+                        user_email, msg_id, att, token
+                    )
+                    if fname is None:
+                        falhas.add(msg_id)
+                        continue
+                    if not data:
+                        continue
+                    # O formato vem do conteúdo, não só da extensão, e é
+                    # farejado uma vez só: vai junto no trabalho
+                    kind = sniff_format(data, fname, ctype)
+                    if kind is None:
+                        safe_print(f"[SKIP] Formato não suportado: {fname}")
+                        continue
+
+                    # ZIP/EML/MSG viram um trabalho por documento interno
+                    for caminho, tipo, conteudo, formato in expand_attachment(
+                            fname, ctype, data, kind):
+                        # Nome próprio: o ranking guarda o arquivo até o fim
+                        local = save_bytes(tmp_dir, caminho, conteudo,
+                                           unique=True)
+                        ctx = (msg_id, msg_from, subj, received, local)
+                        # O hash do download só vale para o próprio anexo
+                        sha = digest if conteudo is data else None
+                        yield ctx, caminho, tipo, conteudo, sha, formato
                 except Exception as e:
                     safe_print(f"[ERRO] Anexo {att['name']}: {e}")
+                    falhas.add(msg_id)
         except Exception as e:
             safe_print(f"[ERRO] Mensagem {msg.get('id', '?')}: {e}")
+            falhas.add(msg.get("id"))
+
 
-    # Salvar resultados
-    import csv
+def _salvar_resultados(base_dir: Path, aprovados: list):
     csv_path = base_dir / "aprovados.csv"
     json_path = base_dir / "aprovados.json"
 